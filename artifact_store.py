@@ -0,0 +1,156 @@
+import hashlib
+import os
+import shutil
+
+from database import db_transaction, get_db_connection, after_commit
+
+
+# Files of songs and song versions (audio, midi, MusicXML, PDF, video) are stored once per content:
+# blobs/<ab>/<sha256><ext>. Every column pointing to a blob holds one reference, counted in the blobs table.
+BLOB_FOLDER = 'blobs'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+os.makedirs(BLOB_FOLDER, exist_ok=True)
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def blob_path(blob_hash, extension):
+    return os.path.join(BLOB_FOLDER, blob_hash[:2], f"{blob_hash}{extension}")
+
+
+def is_blob(path):
+    return bool(path) and os.path.normpath(path).startswith(BLOB_FOLDER + os.sep)
+
+
+def place_file(path, target, move):
+    # Written next to the final path and renamed; a copy is only made if the file can not be hard linked
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if move:
+        os.replace(path, target)
+        return
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def begin_write(conn):
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')  # take the write lock before reading the reference count
+
+
+### CREATE
+
+def put_file(path, extension=None, move=True, blob_hash=None):
+    """Add a file to the store, return the path of its blob with one new reference.
+
+    Content that is already stored is not written again: the existing blob gets the reference and the file is
+    deleted (move) or left alone. Otherwise the file is moved (or hard linked) into the store.
+    `blob_hash` is the sha256 of the file if the caller computed it already (e.g. while receiving it).
+    """
+    if extension is None:
+        extension = os.path.splitext(path)[1]
+    target = blob_path(blob_hash or hash_file(path), extension)
+    with db_transaction() as conn:
+        begin_write(conn)
+        row = conn.execute('SELECT refcount FROM blobs WHERE path = ?', (target,)).fetchone()
+        if row and os.path.exists(target):
+            conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE path = ?', (target,))
+            if move:
+                os.remove(path)
+            return target
+
+        size_bytes = os.path.getsize(path)
+        place_file(path, target, move)
+        conn.execute('''
+            INSERT INTO blobs (path, size_bytes, refcount) VALUES (?, ?, 1)
+            ON CONFLICT(path) DO UPDATE SET refcount = refcount + 1
+        ''', (target, size_bytes))
+    return target
+
+
+def share_file(path):
+    """Another reference to a stored file, e.g. for a copy of a song version. Returns the path to use.
+
+    Files from before the store existed are added to it first (hard linked), so the original owner may still
+    delete its own path.
+    """
+    if not path:
+        return path
+    if not is_blob(path):
+        return put_file(path, move=False)
+    with db_transaction() as conn:
+        conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE path = ?', (path,))
+    return path
+
+
+### DELETE
+
+def release_file(path):
+    """Drop one reference to a stored file, the blob is deleted together with its last reference.
+
+    Files outside the store (from before it existed) have a single owner and are deleted right away.
+    """
+    if not path:
+        return
+    if not is_blob(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+
+    with db_transaction() as conn:
+        begin_write(conn)
+        conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE path = ?', (path,))
+        row = conn.execute('SELECT refcount FROM blobs WHERE path = ?', (path,)).fetchone()
+        unreferenced = bool(row and row['refcount'] <= 0)
+        if unreferenced:
+            conn.execute('DELETE FROM blobs WHERE path = ?', (path,))
+    if unreferenced:
+        # The file goes once the row is gone for good: a rolled back request still finds its blobs
+        after_commit(lambda: delete_blob(path))
+
+
+def delete_blob(path):
+    # Under the write lock, so put_file can not store the same content again in the meantime
+    conn = get_db_connection()
+    try:
+        begin_write(conn)
+        if conn.execute('SELECT 1 FROM blobs WHERE path = ?', (path,)).fetchone():
+            return  # stored again since it was released
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        print(f"[release_file]: Deleted unreferenced blob {path}")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+### READ
+
+def get_store_stats():
+    with db_transaction() as conn:
+        row = conn.execute('''
+            SELECT COUNT(*) AS blobs, COALESCE(SUM(size_bytes), 0) AS size_bytes,
+                   COALESCE(SUM(size_bytes * refcount), 0) AS referenced_bytes, COALESCE(SUM(refcount), 0) AS refs
+            FROM blobs
+        ''').fetchone()
+    return {
+        'blobs': row['blobs'],
+        'references': row['refs'],
+        'size_bytes': row['size_bytes'],            # on disk
+        'referenced_bytes': row['referenced_bytes'],  # what one file per reference would take
+        'saved_bytes': row['referenced_bytes'] - row['size_bytes'],
+    }
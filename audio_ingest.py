@@ -0,0 +1,155 @@
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+
+import mutagen
+from flask import Request
+
+from artifact_store import put_file
+from metrics import timed
+
+
+INGEST_FOLDER = os.path.join('uploads', 'incoming')  # uploads are streamed here while the request is parsed
+
+# Formats kept as uploaded (mutagen type -> extension): the models decode them with ffmpeg and browsers play them.
+# Anything else is transcoded to mp3.
+CANONICAL_EXTENSIONS = {
+    'MP3': '.mp3',
+    'FLAC': '.flac',
+    'WAVE': '.wav',
+    'OggVorbis': '.ogg',
+    'OggOpus': '.opus',
+    'MP4': '.m4a',
+}
+CANONICAL_MP4_CODECS = ('mp4a',)  # AAC; ALAC and others in an mp4 container are transcoded
+TRANSCODE_EXTENSION = '.mp3'
+TRANSCODE_ARGS = ["-vn", "-c:a", "libmp3lame", "-q:a", "2"]  # VBR ~190 kbit/s, like the 192k of the YouTube downloads
+
+os.makedirs(INGEST_FOLDER, exist_ok=True)
+
+
+class HashingUpload:
+    """Writable temp file that hashes everything written into it.
+
+    The multipart parser streams the upload into it chunk by chunk, so the body is written to disk once and the
+    content hash is ready when the request is parsed. Deleted on close unless it was taken over with keep().
+    """
+
+    def __init__(self, filename=None):
+        extension = os.path.splitext(filename or '')[1].lower()
+        extension = extension if re.fullmatch(r'\.[a-z0-9]{1,5}', extension) else ''
+        # The extension is part of the name, mutagen uses it to recognize mp3 files without an ID3 tag
+        fd, self.path = tempfile.mkstemp(dir=INGEST_FOLDER, suffix=extension)
+        self.file = os.fdopen(fd, 'w+b')
+        self.sha = hashlib.sha256()
+        self.size_bytes = 0
+        self.kept = False
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size_bytes += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+    def keep(self):
+        self.file.flush()
+        self.kept = True
+        return self.path
+
+    def close(self):
+        self.file.close()
+        if not self.kept:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)  # read, seek, tell, ... for werkzeug's FileStorage
+
+
+class IngestRequest(Request):
+    # Flask request class streaming file uploads into HashingUpload instead of a spooled temp file
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUpload(filename)
+
+
+@timed('probe')
+def probe_audio(path):
+    """(duration, codec, canonical extension or None) from the container headers, without starting a process.
+
+    (None, None, None) if mutagen does not recognize the file.
+    """
+    try:
+        audio = mutagen.File(path)
+    except mutagen.MutagenError:
+        audio = None
+    if audio is None or audio.info is None:
+        return None, None, None
+    kind = type(audio).__name__
+    codec = getattr(audio.info, 'codec', None) or kind.lower()
+    extension = CANONICAL_EXTENSIONS.get(kind)
+    if kind == 'MP4' and not codec.startswith(CANONICAL_MP4_CODECS):
+        extension = None
+    return audio.info.length, codec, extension
+
+
+@timed('transcode')
+def transcode_audio(path):
+    output_path = os.path.splitext(path)[0] + '.transcoded' + TRANSCODE_EXTENSION
+    result = subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", path, *TRANSCODE_ARGS, output_path],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        try:
+            os.remove(output_path)
+        except FileNotFoundError:
+            pass
+        message = result.stderr.strip().splitlines()
+        raise ValueError(f"Not a supported audio file ({message[-1] if message else 'ffmpeg failed'})")
+    return output_path
+
+
+def ingest_upload(file_storage):
+    """Store an uploaded audio file, return {'audio_path', 'duration', 'codec', 'content_hash', 'size_bytes', 'transcoded'}.
+
+    Files in a canonical format are moved into the artifact store as uploaded (identical uploads share one file),
+    others are transcoded to mp3 first. The upload must have been parsed by IngestRequest.
+    """
+    upload = file_storage.stream
+    if not isinstance(upload, HashingUpload):
+        raise TypeError("The upload was not streamed by IngestRequest")
+    path = upload.keep()
+    try:
+        content_hash = upload.hexdigest()
+        duration, codec, extension = probe_audio(path)
+
+        transcoded = extension is None
+        if transcoded:
+            try:
+                transcoded_path = transcode_audio(path)
+            finally:
+                os.remove(path)
+            path = transcoded_path
+            duration, codec, extension = probe_audio(path)
+            audio_path = put_file(path, TRANSCODE_EXTENSION)
+        else:
+            audio_path = put_file(path, extension, blob_hash=content_hash)
+    except Exception:
+        if os.path.exists(path):  # the kept upload (or its transcoding) is not moved into the store
+            os.remove(path)
+        raise
+
+    print(f"[ingest_upload]: {file_storage.filename}: {codec}, {duration or 0:.1f}s, {upload.size_bytes} bytes"
+          f"{' (transcoded)' if transcoded else ''} -> {audio_path}")
+    return {
+        'audio_path': audio_path,
+        'duration': duration,
+        'codec': codec,
+        'content_hash': content_hash,
+        'size_bytes': upload.size_bytes,
+        'transcoded': transcoded,
+    }
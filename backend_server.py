@@ -1,89 +1,127 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file, render_template
+from flask import Flask, request, jsonify, send_from_directory, send_file, render_template, redirect
 from flask_cors import CORS
 import os
 import subprocess
-from basic_pitch.inference import predict
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from synthviz import create_video
 import json
 import re
-import yt_dlp
+import base64
+import hashlib
+import gzip
 import time
 import os, shutil
+import sys
+import signal
+import argparse
 
 
-from music21 import converter, stream, interval, key, midi
-
 import threading
 
-
-
-# download thumbnail
-import requests
-from PIL import Image
-from io import BytesIO
-
-import sqlite3
+import database
+from database import db_transaction
+from init_db import init_db, migrate_db
+from job_queue import JOB_QUEUED, JOB_RUNNING, enqueue_job, get_job, get_latest_job, get_queue_depths, requeue_expired_jobs, start_worker_pool, update_job_progress, set_job_stage
+from job_events import start_event_server, EVENTS_PORT
+import metrics
+from metrics import timed, db_helper, render_metrics
+from video_renderer import render_video, PLAYLIST_FILE
+from basic_pitch_service import load_model, transcribe_batch, get_inference_stats
+from segmented_transcription import SEGMENTED_MIN_DURATION
+from ensemble_transcription import transcribe_model, transcribe_models, ensemble_midi, ENSEMBLE_MODELS, ENSEMBLE_MODES
+from pcm_cache import get_pcm_cache_stats
+from artifact_store import is_blob, put_file, share_file, release_file, get_store_stats
+from audio_ingest import IngestRequest, ingest_upload
+from youtube_ingest import ingest_youtube
+from key_analysis import analyze_midi
+from midi_transpose import transpose_semitones, transpose_midi_file, precompute_transpositions
+from score_cache import get_score, get_score_cache_stats
+from note_events import get_note_events, note_events_window, get_note_events_stats
+from take_scoring import submit_take
+from thumbnail_cache import get_thumbnail, DEFAULT_THUMBNAIL_VARIANT, THUMBNAIL_MIMETYPE
+from transcription_cache import hash_decoded_audio, get_model_version, lookup_transcription, store_transcription, get_cache_stats
 
 
 
 
 
 app = Flask(__name__)
-CORS(app) # Let any domain to access the API
+app.request_class = IngestRequest # uploads are hashed while they are received (see audio_ingest.py)
+CORS(app, expose_headers=['X-Job-Id', 'X-Next-Cursor', 'ETag']) # Let any domain to access the API (and read the custom headers)
+database.init_app(app) # one pooled connection and transaction per request
+metrics.init_app(app) # request durations and trace ids, see /metrics
 
 
-DB_PATH = 'songs.db'
 UPLOAD_FOLDER = 'uploads'
 MIDI_FOLDER = 'midi'
 VIDEO_FOLDER = 'videos'
+VIDEO_STREAM_FOLDER = os.path.join(VIDEO_FOLDER, 'stream')  # HLS playlist + segments per song version, written while rendering
 XML_FOLDER ='xml'
 PDF_FOLDER = 'pdf'
 THUMBNAILS_FOLDER = 'thumbnails'
-SONGS_JSON = 'songs.json'
+
+SONGS_PAGE_SIZE = 100      # default page size of the song lists
+SONGS_MAX_PAGE_SIZE = 500
+
+PICTURE_MAX_AGE = 365 * 24 * 3600         # versioned picture urls (?v=) never change
+PICTURE_UNVERSIONED_MAX_AGE = 24 * 3600
+PICTURE_FALLBACK_MAX_AGE = 5 * 60         # the song may get a picture soon
+
+TRANSCRIPTION_WORKERS = int(os.environ.get('TRANSCRIPTION_WORKERS', 2))  # number of processes running transkun / basic_pitch jobs
+VIDEO_RENDER_WORKERS = int(os.environ.get('VIDEO_RENDER_WORKERS', 1))    # max number of synthviz videos rendered at the same time
+BASIC_PITCH_WORKERS = int(os.environ.get('BASIC_PITCH_WORKERS', 1))      # processes keeping the basic_pitch model loaded
+BASIC_PITCH_BATCH_SONGS = int(os.environ.get('BASIC_PITCH_BATCH_SONGS', 8)) # max queued songs transcribed together in one batch
+ARTIFACT_WORKERS = int(os.environ.get('ARTIFACT_WORKERS', 1))            # processes pre-rendering MusicXML / PDF files
+ARTIFACT_WORKER_NICENESS = int(os.environ.get('ARTIFACT_WORKER_NICENESS', 10)) # rendering must not slow down transcriptions
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 2))            # processes downloading songs from YouTube
+EVENTS_PUBLIC_URL = os.environ.get('EVENTS_PUBLIC_URL')  # event stream as browsers reach it, default: this host on EVENTS_PORT
+
+# Derived files of a song version, rendered in the background once the midi file exists
+ARTIFACTS = ('musicxml', 'pdf', 'video')
+ARTIFACT_PRIORITY = -10  # pre-rendering; files somebody is waiting for are queued with the default priority 0
+ARTIFACT_PENDING = 'pending'
+ARTIFACT_READY = 'ready'
+ARTIFACT_FAILED = 'failed'
+
+# songs.status while the audio of a song is downloaded (NULL once it is there)
+SONG_DOWNLOADING = 'downloading'
+SONG_FAILED = 'failed'
 
 
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(MIDI_FOLDER, exist_ok=True)
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
+os.makedirs(VIDEO_STREAM_FOLDER, exist_ok=True)
 os.makedirs(XML_FOLDER, exist_ok=True)
 os.makedirs(PDF_FOLDER, exist_ok=True)
 os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
 
 
 allowedFieldsSongs = {'song_id','user_id','title','audio_path', 'source','duration','picture_path', 
-                       'original_key_root','original_key_mode','uploaded_date',}
+                       'original_key_root','original_key_mode','uploaded_date', 'status'}
                 
 allowedFieldsSongVersions= {'version_id', 'song_id', 'model_name','title_version','key_root', 'key_mode','instrument' , 
                               'filename' ,'midi_path' ,'pdf_path', 'musicxml_path', 'video_path','picture_version_path',
-                              'description', 'created_at','is_public'}
+                              'description', 'created_at','is_public', 'musicxml_status', 'pdf_status', 'video_status'}
 allowedFields = allowedFieldsSongs | allowedFieldsSongVersions
 fieldsToDeleteOnMidiChange = ['pdf_path', 'musicxml_path', 'video_path']
-filesToDelete = ['pdf_path', 'musicxml_path', 'video_path', 'audio_path','midi_path']
+filesToDelete = ['pdf_path', 'musicxml_path', 'video_path', 'midi_path']  # of a version; the audio belongs to the song
 fieldsModal = ["version_id", "title", "key_root", "key_mode", "picture_path", "description", "is_public"]
+filterFieldsSongVersions = {'key_root', 'key_mode', 'model_name', 'is_public'}
+sortFieldsSongVersions = {  # sort parameter -> SQL expression (never NULL, so it can be compared in a cursor)
+    'version_id': 'song_versions.version_id',
+    'created_at': 'song_versions.created_at',
+    'title': "COALESCE(song_versions.title_version, songs.title, '')",
+}
 
 
 
-# Sync objects
-videoGenerationJobs = set()
-videoGenerationJobsLock = threading.Lock()  #Protects videoGenerationJobs set
-
-songUploadLock = threading.Lock()  # Ensures only one song upload is processed at a time
-uploadLockStartTime = None
-uploadLockTimeout = 60 * 5  
-
 ######################################## Database functions  ########################################
 
-def get_db_connection(): 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  
-    return conn
-
 ### CREATE
 
+@db_helper
 def add_new_song(**kwargs):
-    if not kwargs.get('audio_path'):
+    if not kwargs.get('audio_path') and kwargs.get('status') != SONG_DOWNLOADING:
         raise ValueError("Missing required field: audio_path")
     for f in kwargs.keys():
         if f not in allowedFieldsSongs and f != "uploaded_date": 
@@ -93,88 +131,78 @@ def add_new_song(**kwargs):
     placeholders = ', '.join(['?'] * len(kwargs))
     values = list(kwargs.values())
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(f'''
-        INSERT INTO songs ({fields})
-        VALUES ({placeholders})
-    ''', values)
-
-    song_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        cur = conn.execute(f'''
+            INSERT INTO songs ({fields})
+            VALUES ({placeholders})
+        ''', values)
+        song_id = cur.lastrowid
     return song_id
 
 
+@db_helper
 def add_new_song_version(song_id,model_name,key_root,key_mode,instrument,filename,midi_path):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('INSERT INTO song_versions (song_id,model_name,key_root,key_mode,instrument,filename,midi_path) VALUES (?,?,?,?,?,?,?)',
-                (song_id,model_name,key_root,key_mode,instrument,filename,midi_path))
-    song_version_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        cur = conn.execute('INSERT INTO song_versions (song_id,model_name,key_root,key_mode,instrument,filename,midi_path) VALUES (?,?,?,?,?,?,?)',
+                           (song_id,model_name,key_root,key_mode,instrument,filename,midi_path))
+        song_version_id = cur.lastrowid
     return song_version_id
 
 
 ### READ
 
+@db_helper
 def get_song(song_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM songs where song_id = ?',(song_id,))
-    row = cur.fetchone()
-    conn.close()
+    with db_transaction() as conn:
+        row = conn.execute('SELECT * FROM songs where song_id = ?',(song_id,)).fetchone()
     if row:
         return row
     else:
         return None #TODO
     
+@db_helper
 def get_song_version(song_version_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM song_versions WHERE version_id = ?',(song_version_id,))
-    row = cur.fetchone() 
-    conn.close()
+    with db_transaction() as conn:
+        row = conn.execute('SELECT * FROM song_versions WHERE version_id = ?',(song_version_id,)).fetchone()
     if row:
         return row
     else:
         return None #TODO 
     
 
+def song_versions_field_str(fields):
+    if not fields:
+        return '*'
+    # if field is a single element convert it to list
+    if isinstance(fields, str):
+        fields = [fields]
+    selected_fields = []
+    for f in fields:
+        if f not in allowedFields:
+            raise ValueError(f"Unrecognized field: {f}")
+        if f == 'title':
+            selected_fields.append("COALESCE(title_version, title) AS title")
+        elif f == 'picture_path':
+            selected_fields.append("COALESCE(picture_version_path, picture_path) AS picture_path")
+        elif f == 'song_id':
+            selected_fields.append("song_versions.song_id")
+        else:
+            selected_fields.append(f)
+    return ', '.join(selected_fields)
+
+
+@db_helper
 def get_song_versions(fields=None, version_id=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if fields:
-        # if field is a single element convert it to list
-        if isinstance(fields, str):
-            fields = [fields]
-        selected_fields = []
-        for f in fields:
-            if f not in allowedFields:
-                raise ValueError(f"Unrecognized field: {f}")
-            if f == 'title':
-                selected_fields.append("COALESCE(title_version, title) AS title")
-            elif f == 'picture_path':
-                selected_fields.append("COALESCE(picture_version_path, picture_path) AS picture_path")
-            else:
-                selected_fields.append(f)
-
-        field_str = ', '.join(selected_fields)
-    else:
-        field_str = '*'  
-
+    field_str = song_versions_field_str(fields)
     query = f'SELECT {field_str} FROM song_versions LEFT JOIN songs ON song_versions.song_id = songs.song_id'
 
-    if version_id is not None:
-        query += ' WHERE song_versions.version_id = ?'
-        cur.execute(query, (version_id,))
-    else:
-        cur.execute(query)
+    with db_transaction() as conn:
+        if version_id is not None:
+            query += ' WHERE song_versions.version_id = ?'
+            rows = conn.execute(query, (version_id,)).fetchall()
+        else:
+            rows = conn.execute(query).fetchall()
 
-    rows = cur.fetchall() 
-    conn.close()
     if not rows:
         return None
     if version_id is not None:
@@ -182,6 +210,67 @@ def get_song_versions(fields=None, version_id=None):
     return [dict(row) for row in rows]
 
 
+def encode_cursor(sort_value, version_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, version_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        sort_value, version_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return sort_value, int(version_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+@db_helper
+def get_song_versions_page(fields, filters=None, sort='version_id', order='asc', limit=SONGS_PAGE_SIZE, cursor=None):
+    # Keyset pagination: the cursor holds the sort value and version_id of the last row of the previous page,
+    # so every page is an index range scan no matter how deep into the list it is
+    if sort not in sortFieldsSongVersions:
+        raise ValueError(f"Unrecognized sort field: {sort}")
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"Unrecognized sort order: {order}")
+    sort_expr = sortFieldsSongVersions[sort]
+    comparison = '>' if order == 'asc' else '<'
+
+    conditions = []
+    values = []
+    for f, value in (filters or {}).items():
+        if f not in filterFieldsSongVersions:
+            raise ValueError(f"Unrecognized filter: {f}")
+        conditions.append(f"song_versions.{f} = ?")
+        values.append(value)
+    if cursor:
+        sort_value, last_version_id = decode_cursor(cursor)
+        conditions.append(f"({sort_expr}, song_versions.version_id) {comparison} (?, ?)")
+        values.extend([sort_value, last_version_id])
+
+    query = f'''SELECT {song_versions_field_str(fields)}, {sort_expr} AS sort_key, song_versions.version_id AS cursor_id
+                FROM song_versions LEFT JOIN songs ON song_versions.song_id = songs.song_id'''
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += f' ORDER BY {sort_expr} {order}, song_versions.version_id {order} LIMIT ?'
+    values.append(limit + 1) # one extra row tells whether there is a next page
+
+    with db_transaction() as conn:
+        rows = [dict(row) for row in conn.execute(query, values).fetchall()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['sort_key'], rows[-1]['cursor_id'])
+    for row in rows:
+        del row['sort_key'], row['cursor_id']
+    return rows, next_cursor
+
+
+@db_helper
+def get_data_version():
+    # Bumped by triggers on every change of songs / song_versions (see init_db)
+    with db_transaction() as conn:
+        row = conn.execute("SELECT version FROM data_version WHERE name = 'songs'").fetchone()
+    return row['version'] if row else 0
+
+
 @app.route('/api/get-song-version/<int:songVersionId>')
 def get_song_version_api(songVersionId):
     song_version = get_song_versions(fields=fieldsModal, version_id=songVersionId)
@@ -204,15 +293,13 @@ def get_song_version_title_api(songVersionId):
 
     
 
+@db_helper
 def get_table(table):
     if not table.isidentifier():
         raise ValueError("Invalid table name")  # SQL injection protection
-    conn = get_db_connection()
-    cur = conn.cursor()
     query = f'SELECT * FROM {table}'
-    cur.execute(query)
-    rows = cur.fetchall()
-    conn.close()
+    with db_transaction() as conn:
+        rows = conn.execute(query).fetchall()
     if rows:
         return rows    
     else: 
@@ -229,6 +316,7 @@ def map_song_versions_field_name(field): #this function is only used by update_s
         return 'title_version'
     return field
 
+@db_helper
 def update_song(songId, **kwargs):
     if not kwargs:
         return  # nothing to update
@@ -240,19 +328,16 @@ def update_song(songId, **kwargs):
     values = list(kwargs.values())
     values.append(songId)  
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(f'''
-        UPDATE songs
-        SET {fields}
-
-        WHERE song_id = ?
-    ''', values)
+    with db_transaction() as conn:
+        conn.execute(f'''
+            UPDATE songs
+            SET {fields}
 
-    conn.commit()
-    conn.close()
+            WHERE song_id = ?
+        ''', values)
 
 
+@db_helper
 def update_song_version(songVersionId, **kwargs):
     if not kwargs:
         return  
@@ -264,47 +349,61 @@ def update_song_version(songVersionId, **kwargs):
     fields = ', '.join(f"{map_song_versions_field_name(f)} = ?" for f in kwargs)
     values = list(kwargs.values())
     values.append(songVersionId)  
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(f'''
-        UPDATE song_versions
-        SET {fields}
+    with db_transaction() as conn:
+        conn.execute(f'''
+            UPDATE song_versions
+            SET {fields}
 
-        WHERE version_id = ?
-    ''', values)
-
-    conn.commit()
-    conn.close()
+            WHERE version_id = ?
+        ''', values)
 
 
 
 ### DELETE
+@db_helper
 def delete_song_version(songVersionId):
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    row = get_song_versions(fields=filesToDelete, version_id=songVersionId)
+    # The song (and its audio) goes with its last version
+    row = get_song_versions(fields=filesToDelete + ['song_id'], version_id=songVersionId)
     if row:
         for col in filesToDelete:
             file_path = row.get(col) 
-            if file_path and os.path.exists(file_path):
+            if file_path:
                 try:
-                    os.remove(file_path)
+                    release_file(file_path)  # shared files stay until their last version is deleted
                 except Exception as e:
                     print(f"[delete_song_version] Error while deleting {file_path}: {e}")
+    shutil.rmtree(video_stream_dir(songVersionId), ignore_errors=True)
 
-    cur.execute('DELETE FROM song_versions WHERE version_id = ?',(songVersionId,))
-    deleted_count = cur.rowcount
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        deleted_count = conn.execute('DELETE FROM song_versions WHERE version_id = ?',(songVersionId,)).rowcount
+        remaining = conn.execute('SELECT COUNT(*) FROM song_versions WHERE song_id = ?', (row['song_id'],)).fetchone()[0] if row else 1
 
+    if deleted_count and not remaining:
+        delete_song(row['song_id'])
     return deleted_count
+
+
+@db_helper
+def delete_song(songId):
+    song = get_song(songId)
+    if not song:
+        return 0
+    try:
+        release_file(song['audio_path'])  # identical uploads share the audio: deleted with its last song
+    except Exception as e:
+        print(f"[delete_song] Error while deleting {song['audio_path']}: {e}")
+    with db_transaction() as conn:
+        return conn.execute('DELETE FROM songs WHERE song_id = ?', (songId,)).rowcount
  
     
 
 
 ########################################################    Other      ###############################################
 
+def video_stream_dir(songVersionId):
+    return os.path.join(VIDEO_STREAM_FOLDER, str(songVersionId))
+
+
 def safe_filename_song(title):
     title = title.replace(' ', '_')  
     title = re.sub(r'[^a-zA-Z0-9_\-\.]', '', title)  
@@ -316,17 +415,9 @@ def safe_filename_version(title,model_name,key_root,key_mode):
     return f"{title}_{model_name}_{key_root}_{key_mode}"
 
 
-def transkun_predict(audio_path,midi_path):
-    try:
-        subprocess.run(['transkun', audio_path, midi_path], check=True)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Transkun failed: {e}")
-
-    return midi_path
-
-
 ################################################## Music functions  ##################################################
 
+@timed('ffprobe')
 def get_duration_ffmpeg(path):
     result = subprocess.run(
         ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", path],
@@ -335,41 +426,16 @@ def get_duration_ffmpeg(path):
     meta = json.loads(result.stdout)
     return float(meta["format"]["duration"])
 
-def get_instrument(score):
-    instruments = list(score.recurse().getElementsByClass('Instrument'))
-
-    instrument_name = None
-    for inst in instruments:
-        name = inst.instrumentName or inst.bestName()
-        if name:
-            instrument_name = name
-            break
-
-    if instrument_name:
-        print(f"[get_instrument]: Instrument {instrument_name}")
-    else:
-        instrument_name = "Unknown"
-        print("[get_instrument]: No instrument found — (saved as Unknown")
-    return instrument_name
-
 def transpose_key_root(midi_path, new_key, curr_key=None):
-    score = converter.parse(midi_path)
+    # The midi file may be shared with other versions, so the transposition is a new file: returns its path
     if not curr_key:
-       curr_key = score.analyze('key')
-    else:
-        curr_key=key.Key(curr_key)
-   # curr_key = score.analyze('key')
-
-    target_key = key.Key(new_key)
-    i = interval.Interval(curr_key.tonic, target_key.tonic)
-    print("[transpose_key_root]: key_root interval is: " + str(i))
+        curr_key = analyze_midi(midi_path)['key_root']
 
-    transposed_score = score.transpose(i)
-
-    mf = midi.translate.music21ObjectToMidiFile(transposed_score)
-    mf.open(midi_path, 'wb')
-    mf.write()
-    mf.close()
+    semitones = transpose_semitones(curr_key, new_key)
+    print(f"[transpose_key_root]: key_root interval is: {semitones} semitone(s)")
+    temp_midi_path = os.path.join(MIDI_FOLDER, f"transposed_{os.getpid()}_{threading.get_ident()}.mid")
+    transpose_midi_file(midi_path, semitones, temp_midi_path)
+    return put_file(temp_midi_path)
 
 
 #############################################################      API    ###################################################
@@ -382,17 +448,50 @@ def serve_index():
 def serve_static(path):
     return send_from_directory("static", path)
 
+def songs_list_response(fields):
+    # Paginated song list with ETag validation: parameters limit, cursor, sort, order and the filters
+    # key_root, key_mode, model (model_name), is_public. The next page cursor is sent in X-Next-Cursor.
+    etag = f"{get_data_version()}-{hashlib.sha1(request.query_string).hexdigest()[:16]}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    filters = {}
+    for param, field in (('key_root', 'key_root'), ('key_mode', 'key_mode'), ('model', 'model_name'), ('is_public', 'is_public')):
+        if request.args.get(param) not in (None, ''):
+            filters[field] = request.args.get(param)
+    if 'is_public' in filters:
+        if filters['is_public'] not in ('0', '1'):
+            return jsonify({'error': f"invalid is_public: {filters['is_public']} (0 or 1)"}), 400
+        filters['is_public'] = int(filters['is_public'])
+    limit = min(request.args.get('limit', SONGS_PAGE_SIZE, type=int), SONGS_MAX_PAGE_SIZE)
+
+    try:
+        songs, next_cursor = get_song_versions_page(fields, filters=filters,
+                                                    sort=request.args.get('sort', 'version_id'),
+                                                    order=request.args.get('order', 'asc'),
+                                                    limit=max(limit, 1),
+                                                    cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = jsonify(songs)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache' # the browser may keep the list but has to revalidate it
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
 @app.route('/api/get-songs-list-dropdown', methods=['GET'])
 def get_midi_files_dropdown():
-    songs = get_song_versions(('version_id','title'))
-
-    return jsonify(songs)
+    return songs_list_response(('version_id','title'))
 
 @app.route('/api/get-songs-list-gallery', methods=['GET'])
 def get_midi_files_gallery():
-    songs = get_song_versions(('version_id','title', 'source',
-                               'picture_path','uploaded_date','key_root', 'key_mode',  'duration', 'description'))
-    return jsonify(songs)
+    return songs_list_response(('version_id','title', 'source',
+                                'picture_path','uploaded_date','key_root', 'key_mode',  'duration', 'description'))
 
 
 
@@ -402,6 +501,17 @@ def update_save_version_song_api(songVersionId, songVersionDataMap):
     if not songVersion:
         return jsonify({'error': 'Song version not found'}), 404
 
+    currKey = songVersion.get('key_root')
+    newKey = songVersionDataMap.get('key_root')
+    keyChanged = bool(newKey and currKey != newKey)
+
+    # The new version references the same files (no copies); a transposition is stored as a file of its own
+    orig_midi = songVersion.get('midi_path')
+    if orig_midi and keyChanged:
+        new_midi = transpose_key_root(orig_midi, newKey, curr_key=currKey)
+    else:
+        new_midi = share_file(orig_midi)
+
     # create new record from the old one 
     newSongVersionId = add_new_song_version(
         songVersion.get('song_id'),
@@ -410,43 +520,51 @@ def update_save_version_song_api(songVersionId, songVersionDataMap):
         songVersion.get('key_mode'),
         songVersion.get('instrument'),
         songVersion.get('filename'),
-        songVersion.get('midi_path'),
+        new_midi,
     )
 
-    #copy midi, change filename/midi_path to be independent
-    try:
-        orig_midi = songVersion.get('midi_path')
-        if orig_midi:
-            base, ext = os.path.splitext(orig_midi)
-            new_midi = f"{base}-{newSongVersionId}{ext or ''}"
-            os.makedirs(os.path.dirname(new_midi), exist_ok=True)
-            try:
-                shutil.copy2(orig_midi, new_midi)
-            except FileNotFoundError:
-                new_midi = orig_midi  
-            songVersionDataMap['midi_path'] = new_midi
-
-        orig_filename = songVersion.get('filename')
-        if orig_filename:
-            fbase, fext = os.path.splitext(orig_filename)
-            songVersionDataMap['filename'] = f"{fbase}-{newSongVersionId}{fext or ''}"
-    except Exception as e:
-        print(f"[update_save_version_song_api] copy-midi-error: {e}")
-
-    currKey = songVersion.get('key_root')
-    newKey = songVersionDataMap.get('key_root')
-
-    if newKey and currKey != newKey:
-        midi_path = songVersionDataMap.get('midi_path') or get_song_versions(fields=['midi_path'], version_id=newSongVersionId).get('midi_path')
-        if midi_path:
-            transpose_key_root(midi_path, newKey, curr_key=currKey)
-        for f in fieldsToDeleteOnMidiChange:
-            songVersionDataMap[f] = ''
+    orig_filename = songVersion.get('filename')
+    if orig_filename:
+        fbase, fext = os.path.splitext(orig_filename)
+        songVersionDataMap['filename'] = f"{fbase}-{newSongVersionId}{fext or ''}"
+
+    # Same midi file: the rendered files are the same too
+    missingArtifacts = ARTIFACTS
+    if not keyChanged:
+        missingArtifacts = []
+        for artifact in ARTIFACTS:
+            artifact_path = songVersion.get(f"{artifact}_path")
+            if songVersion.get(f"{artifact}_status") == ARTIFACT_READY and artifact_path and os.path.exists(artifact_path):
+                songVersionDataMap[f"{artifact}_path"] = share_file(artifact_path)
+                songVersionDataMap[f"{artifact}_status"] = ARTIFACT_READY
+            else:
+                missingArtifacts.append(artifact)
 
     update_song_version(newSongVersionId, **songVersionDataMap)
+    schedule_artifacts(newSongVersionId, missingArtifacts)
     return '', 204
 
 
+@app.route('/api/get-key-analysis/<int:songVersionId>', methods=['GET'])
+def get_key_analysis(songVersionId):
+    # Key of the whole song plus one estimate per KEY_SECTION_SECONDS window (modulations)
+    row = get_song_versions(fields=['midi_path'], version_id=songVersionId)
+    if not row or not row.get('midi_path') or not os.path.exists(row['midi_path']):
+        return jsonify({'error': 'Song version not found'}), 404
+    return jsonify(analyze_midi(row['midi_path'])), 200
+
+
+@app.route('/api/precompute-transpositions/<int:songVersionId>', methods=['POST'])
+def precompute_transpositions_api(songVersionId):
+    # Transposes the version to all 12 keys at once, later key changes only copy the prepared file
+    row = get_song_versions(fields=['midi_path', 'key_root'], version_id=songVersionId)
+    if not row or not row.get('midi_path') or not os.path.exists(row['midi_path']):
+        return jsonify({'error': 'Song version not found'}), 404
+    curr_key = row.get('key_root') or analyze_midi(row['midi_path'])['key_root']
+    keys = precompute_transpositions(row['midi_path'], curr_key)
+    return jsonify({'key_root': curr_key, 'keys': sorted(keys)}), 200
+
+
 @app.route('/api/update-song', methods=['POST'])
 def update_version_song_api():
     data = request.get_json()
@@ -470,56 +588,26 @@ def update_version_song_api():
         songVersion = get_song_versions(fields=fieldsToDeleteOnMidiChange + ['midi_path'], version_id=songVersionId)
         midi_path = songVersion.get('midi_path')
 
-        transpose_key_root(midi_path, newKey, curr_key=currKey)
+        songVersionDataMap['midi_path'] = transpose_key_root(midi_path, newKey, curr_key=currKey)
 
-        for f in fieldsToDeleteOnMidiChange:
+        for f in fieldsToDeleteOnMidiChange + ['midi_path']:
             if songVersion.get(f):
                 try:
-                    os.remove(songVersion[f])
-                except FileNotFoundError:
-                    pass  
+                    release_file(songVersion[f])
                 except Exception as e:
                     print(f"[update_version_song_api]: Error deleting file {songVersion[f]}: {e}")
-            songVersionDataMap[f] = '' 
+            if f != 'midi_path':
+                songVersionDataMap[f] = '' 
+        shutil.rmtree(video_stream_dir(songVersionId), ignore_errors=True)
 
     update_song_version(songVersionId, **songVersionDataMap)
+    if newKey and currKey != newKey:
+        schedule_artifacts(songVersionId)
     return '', 204
 
 
-def release_upload_lock():
-    global uploadLockStartTime
-    if songUploadLock.locked():
-        songUploadLock.release()
-    uploadLockStartTime = None
-
-@app.route('/api/tupload', methods=['POST'])
-def unlock_upload():
-    global uploadLockStartTime
-    if songUploadLock.locked():
-        release_upload_lock()
-        return jsonify({'status': 'Lock released'}), 200
-    return jsonify({'status': 'Lock was not active'}), 200
-
-
-def force_unlock_upload_if_stuck():
-    global uploadLockStartTime
-    if songUploadLock.locked() and uploadLockStartTime:
-        if time.time() - uploadLockStartTime > uploadLockTimeout:
-            print("[force_unlock_upload_if_stuck]: Upload lock timeout reached — forcing release.")
-            release_upload_lock()
-
-
-
 @app.route('/api/upload-audio', methods=['POST'])
 def upload_audio():
-    force_unlock_upload_if_stuck() # Unlock if the previous job is processing for over 5 minutes
-
-    if not songUploadLock.acquire(blocking=False):  # try to acquire the lock without waiting (blocking=True would wait until the lock is released), if another upload is in progress return 429
-        return jsonify({"error": "Another upload job in progress"}), 429
-    
-    global uploadLockStartTime
-    uploadLockStartTime = time.time()
-
     try:
         if 'audio_file' not in request.files:
             return jsonify({'error': 'No file uploaded'}), 400
@@ -529,197 +617,578 @@ def upload_audio():
             return jsonify({'error': 'No selected file'}), 400
         user_id = 1 
         title = audio_file.filename 
-        filename = safe_filename_song(title) + '.mp3'
-        audio_path = os.path.join(UPLOAD_FOLDER, filename)
-        audio_file.save(audio_path)
-        duration_seconds = get_duration_ffmpeg(audio_path)
+        audio = ingest_upload(audio_file)
          
-        song_id = add_new_song(user_id=user_id, title=title,audio_path=audio_path,duration=duration_seconds)
+        song_id = add_new_song(user_id=user_id, title=title,audio_path=audio['audio_path'],duration=audio['duration'])
         return jsonify({'song_id': song_id}), 200 
+    except ValueError as e:
+        print("[upload_audio]: Rejected upload:", e)
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print("[upload_audio]: Upload audio  error:", e)
-        release_upload_lock()
         return jsonify({'error': str(e)}), 500 # Server-side error
 
 
 @app.route('/api/download-upload-audio', methods=['POST'])
 def download_audio_yt_dlp():
-    force_unlock_upload_if_stuck() #unlock if the previous job is processing for over 5 minutes
-
-    if not songUploadLock.acquire(blocking=False):  # try to acquire the lock without waiting (blocking=True would wait until the lock is released), if another upload is in progress return 429
-        return jsonify({"error": "Another upload job in progress"}), 429
-
-    global uploadLockStartTime
-    uploadLockStartTime = time.time()
-
-    data = request.get_json()
+    # The song is created right away and downloaded by a worker: 202 with the song_id and the download job
+    data = request.get_json(silent=True) or {}
     user_id = 1 
-    youtube_url = data.get('youtube_url')
+    youtube_url = (data.get('youtube_url') or '').strip()
 
     if not youtube_url:
         return jsonify({'error': 'Missing YouTube URL'}), 400
+    if not re.match(r'https?://', youtube_url):
+        return jsonify({'error': 'Not a http(s) URL'}), 400
 
     try:
-        # Download data (without audio - just to get the title)
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl_info:
-            info = ydl_info.extract_info(youtube_url, download=False)
-        video_title = info.get('title', 'unknown_title')
-        duration_seconds = info.get('duration',None)
-
-        title = video_title 
-        safe_filename = safe_filename_song(video_title) 
-        audio_path = os.path.join(UPLOAD_FOLDER, safe_filename) # without '.mp3' at the end because yt-dlp appends it 
-        thumbnail_url = info.get('thumbnail')  
-        image_path = None
-
-        if thumbnail_url:
-            try:
-                res = requests.get(thumbnail_url)
-                if res.status_code == 200:
-                    image_path = os.path.join(THUMBNAILS_FOLDER, safe_filename + '.jpg')
-                    with open(image_path, 'wb') as f:
-                        f.write(res.content)
-            except Exception as e:
-                print("[download_audio_yt_dlp]: Warning: Couldn't download thumbnail:", e)
-
-        # Download and convert to mp3 with yt-dlp
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': audio_path + '.%(ext)s',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'noplaylist': True,
-            'quiet': True
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([youtube_url])
-        song_id = add_new_song(user_id=user_id, title=title,audio_path=audio_path+'.mp3',source=youtube_url,picture_path=image_path,duration=duration_seconds)
-        return jsonify({'song_id': song_id, 'title':title}), 200
-     
+        song_id = add_new_song(user_id=user_id, title=youtube_url, audio_path='', source=youtube_url, status=SONG_DOWNLOADING)
+        job_id = enqueue_job('download_youtube', {'song_id': song_id, 'url': youtube_url})
+        return jsonify({'song_id': song_id, 'job_id': job_id, 'status': SONG_DOWNLOADING, 'title': youtube_url}), 202, \
+            {'X-Job-Id': str(job_id), 'Location': f"/api/jobs/{job_id}"}
     except Exception as e:
-        print("[download_audio_yt_dlp]: YouTube download error:", e)
-        release_upload_lock()
+        print("[download_audio_yt_dlp]: Could not queue the download:", e)
         return jsonify({'error': str(e)}), 500 # Server-side error
-    
+
+
+def run_youtube_download(job_id, song_id, url):
+    # Executed by a download worker: metadata, audio and thumbnail of the URL (see youtube_ingest.py)
+    def on_metadata(info):
+        update_song(song_id, title=info.get('title') or url, duration=info.get('duration'))
+
+    def on_progress(stage, done=None, total=None):
+        if done is None:
+            set_job_stage(job_id, stage)
+        else:
+            update_job_progress(job_id, done, total, stage)
+
+    try:
+        downloaded = ingest_youtube(url, os.path.join(THUMBNAILS_FOLDER, f"song_{song_id}.jpg"), on_metadata, on_progress)
+    except Exception:
+        update_song(song_id, status=SONG_FAILED)
+        raise
+    if downloaded['picture_path']:
+        try:
+            get_thumbnail(downloaded['picture_path']) # pre-generate the variants the gallery will ask for
+        except Exception as e:
+            print("[run_youtube_download]: Warning: Couldn't create the thumbnails:", e)
+    update_song(song_id, title=downloaded['title'], audio_path=downloaded['audio_path'], duration=downloaded['duration'],
+                picture_path=downloaded['picture_path'], source=downloaded['source'], status=None)
+    return {'song_id': song_id, 'title': downloaded['title']}
+
+
+def prepare_transcription(job_id, song_id, model_name, segmented=None):
+    song = get_song(song_id)
+    if not song:
+        raise ValueError("Song not found")
+    temp_midi_filename = f"temp_{song_id}_{model_name}_{job_id}.mid"
+    duration = song['duration'] or get_duration_ffmpeg(song['audio_path'])
+    transcription = {
+        'job_id': job_id,
+        'song_id': song_id,
+        'model_name': model_name,
+        'title': song['title'],
+        'audio_path': song['audio_path'],
+        'duration': duration,
+        'segmented': segmented if segmented is not None else duration >= SEGMENTED_MIN_DURATION, # long recordings are split into windows
+        'temp_midi_path': os.path.join(MIDI_FOLDER, temp_midi_filename),
+    }
+
+    # The same recording transcribed by the same model version is served from the cache
+    set_job_stage(job_id, 'decoding')
+    transcription['audio_hash'] = hash_decoded_audio(song['audio_path'])
+    transcription['model_version'] = get_model_version(model_name)
+    transcription['cached'] = lookup_transcription(transcription['audio_hash'], model_name, transcription['model_version'])
+    return transcription
+
+
+def save_transcription(transcription):
+    # Called once the midi file is at transcription['temp_midi_path']
+    song_id = transcription['song_id']
+    model_name = transcription['model_name']
+    title = transcription['title']
+    temp_midi_path = transcription['temp_midi_path']
+    cached = transcription['cached']
+    set_job_stage(transcription['job_id'], 'saving')
+
+    if cached:
+        shutil.copyfile(cached['midi_path'], temp_midi_path)
+        key_root = cached['key_root']
+        key_mode = cached['key_mode']
+        instrument = cached['instrument']
+    else:
+        # Song metadata analysis (basic_pitch hands over its midi in memory)
+        analysis = analyze_midi(transcription.get('midi_data') or temp_midi_path)
+        if not analysis['key_root']:
+            raise ValueError("No notes were transcribed")
+        key_root = analysis['key_root']
+        key_mode = analysis['key_mode']
+        instrument = analysis['instrument']
+        print(f"[save_transcription]: Key = {key_root} {key_mode}, instrument = {instrument}")
+        store_transcription(transcription['audio_hash'], model_name, transcription['model_version'],
+                            temp_midi_path, key_root, key_mode, instrument)
+
+    # Move the midi file into the store (a song transcribed again shares the file) and save to database
+    filename=safe_filename_version(title,model_name,key_root,key_mode) 
+    midi_path = put_file(temp_midi_path)
+    get_note_events(midi_path) # packed for the practice view while the worker is at it
+    song_version_id = add_new_song_version(song_id,model_name,key_root,key_mode,instrument,filename,midi_path)
+    update_song(song_id,original_key_root=key_root,original_key_mode=key_mode)
+    schedule_artifacts(song_version_id)
+
+    return {'title': title, 'song_version_id': song_version_id}
+
+
+def transcribe_audio(transcription):
+    # Audio to midi conversion (long recordings report their progress segment by segment)
+    job_id = transcription['job_id']
+    set_job_stage(job_id, 'transcribing')
+    transcribe_model(transcription['model_name'], transcription['audio_path'], transcription['temp_midi_path'],
+                     transcription['duration'], transcription['segmented'],
+                     on_progress=lambda done, total: update_job_progress(job_id, done, total))
+
+
+def run_transcription(job_id, song_id, model_name, segmented=None):
+    # Executed by a transcription worker process (see start_background_workers)
+    transcription = prepare_transcription(job_id, song_id, model_name, segmented)
+    if not transcription['cached']:
+        transcribe_audio(transcription)
+    return save_transcription(transcription)
+
+
+def prepare_ensemble_transcription(job_id, transcriptions, mode):
+    # Transcription of the combined notes, cached like a model of its own (its version names the models it combines)
+    first = next(iter(transcriptions.values()))
+    model_version = mode + ':' + '+'.join(f"{m}-{transcriptions[m]['model_version']}" for m in sorted(transcriptions))
+    ensemble = dict(first, model_name='ensemble', model_version=model_version, midi_data=None,
+                    temp_midi_path=os.path.join(MIDI_FOLDER, f"temp_{first['song_id']}_ensemble_{job_id}.mid"))
+    ensemble['cached'] = lookup_transcription(ensemble['audio_hash'], 'ensemble', model_version)
+    if not ensemble['cached']:
+        set_job_stage(job_id, 'combining')
+        ensemble_midi([t['cached']['midi_path'] if t['cached'] else t['temp_midi_path'] for t in transcriptions.values()],
+                      ensemble['temp_midi_path'], mode)
+    return ensemble
+
+
+def run_ensemble_transcription(job_id, song_id, models, ensemble=None, segmented=None):
+    # Executed by a transcription worker: the models run at the same time in their own processes and every model
+    # gets its own song version, plus one of the combined notes if `ensemble` names a mode
+    transcriptions = {model_name: prepare_transcription(job_id, song_id, model_name, segmented) for model_name in models}
+    first = next(iter(transcriptions.values()))
+    to_transcribe = {m: t['temp_midi_path'] for m, t in transcriptions.items() if not t['cached']}
+    failed = []
+    if to_transcribe:
+        set_job_stage(job_id, 'transcribing', len(to_transcribe))  # progress: models finished
+        failed = transcribe_models(first['audio_path'], to_transcribe, first['duration'], first['segmented'],
+                                   on_progress=lambda done, total: update_job_progress(job_id, done, total))
+    for model_name in failed:
+        del transcriptions[model_name]
+    if not transcriptions:
+        raise RuntimeError(f"All models failed: {', '.join(failed)}")
+
+    if ensemble and len(transcriptions) > 1:
+        transcriptions['ensemble'] = prepare_ensemble_transcription(job_id, transcriptions, ensemble)
+
+    song_version_ids = {}
+    for model_name, transcription in transcriptions.items():
+        try:
+            song_version_ids[model_name] = save_transcription(transcription)['song_version_id']
+        except ValueError as e:  # e.g. no note was transcribed, or the models did not agree on any
+            print(f"[run_ensemble_transcription]: {model_name}: {e}")
+            failed.append(model_name)
+    if not song_version_ids:
+        raise RuntimeError(f"No song version could be saved: {', '.join(failed)}")
+    return {
+        'title': first['title'],
+        'song_version_id': song_version_ids.get('ensemble', next(iter(song_version_ids.values()))),
+        'song_version_ids': song_version_ids,
+        'failed_models': failed,
+    }
+
+
+def run_basic_pitch_transcriptions(jobs):
+    # Executed by a basic_pitch worker: the resident model transcribes all claimed songs in shared forward passes
+    results = [None] * len(jobs)
+    transcriptions = {}
+    for i, job in enumerate(jobs):
+        try:
+            transcriptions[i] = prepare_transcription(job['job_id'], job['payload']['song_id'], job['payload']['model_name'],
+                                                      job['payload'].get('segmented'))
+        except Exception as e:
+            results[i] = e
+
+    # Long recordings are transcribed window by window on their own, the rest together in one batch
+    for i, transcription in list(transcriptions.items()):
+        if transcription['segmented'] and not transcription['cached']:
+            try:
+                transcribe_audio(transcription)
+            except Exception as e:
+                results[i] = e
+                del transcriptions[i]
+
+    to_transcribe = [i for i, t in transcriptions.items() if not t['cached'] and not t['segmented']]
+    if to_transcribe:
+        for i in to_transcribe:
+            set_job_stage(transcriptions[i]['job_id'], 'transcribing')
+        try:
+            outputs = transcribe_batch([transcriptions[i]['audio_path'] for i in to_transcribe])
+            for i, (midi_data, note_events) in zip(to_transcribe, outputs):
+                midi_data.write(transcriptions[i]['temp_midi_path'])
+                transcriptions[i]['midi_data'] = midi_data
+        except Exception as e:
+            for i in to_transcribe:
+                results[i] = e
+                del transcriptions[i]
+
+    for i, transcription in transcriptions.items():
+        try:
+            results[i] = save_transcription(transcription)
+        except Exception as e:
+            results[i] = e
+    return results
 
 
 @app.route('/api/convert-audio', methods=['POST'])
 def convert_audio():
     try: 
-        # Prepare metadata
         data = request.get_json()
         model_name = data.get('model_name', 'transkun') # transkun is the default model
         song_id = data.get('song_id')
+        segmented = data.get('segmented') # None - decided by the song duration
         song = get_song(song_id)
         if not song:
-            raise ValueError("Song not found")
-        title = song['title']
-        audio_path = song['audio_path']
-        temp_midi_filename = f"temp_{song_id}_{model_name}.mid"
-        temp_midi_path = os.path.join(MIDI_FOLDER, temp_midi_filename)
-
-        # Audio to midi conversion     
-        if model_name == 'transkun':
-            #midi_path = transkun_predict(song_id,midi_path) # transkun saves midi_data!
-            transkun_predict(audio_path,temp_midi_path) 
-        else: 
-            model_output, midi_data, note_events = predict(audio_path, model_or_model_path=ICASSP_2022_MODEL_PATH)
-            midi_data.write(temp_midi_path)
-
-        # Song metadata analysis
-        score = converter.parse(temp_midi_path)
-        key_signature_data = score.analyze('key')
-        print(f"[convert_audio]: Key = {key_signature_data.tonic.name} {key_signature_data.mode}")
-        key_root = key_signature_data.tonic.name
-        key_mode = key_signature_data.mode
-        instrument = get_instrument(score)
-
-        # Rename midi file and save to database 
-        filename=safe_filename_version(title,model_name,key_root,key_mode) 
-        midi_path = os.path.join(MIDI_FOLDER, f"{filename}.mid")
-        song_version_id = add_new_song_version(song_id,model_name,key_root,key_mode,instrument,filename,midi_path)
-        os.rename(temp_midi_path, midi_path)
-        update_song(song_id,original_key_root=key_root,original_key_mode=key_mode)
-    
-        return jsonify({'title': title, 'song_version_id': song_version_id}), 200
+            return jsonify({'error': 'Song not found'}), 404
+        if song['status']:
+            return jsonify({'error': f"The song audio is not available ({song['status']})", 'status': song['status']}), 409
+
+        # Several models at once: 'models' lists them, 'ensemble' (vote / union) adds a version of the combined notes.
+        # model_name 'ensemble' is short for all models voting.
+        models = data.get('models') or (list(ENSEMBLE_MODELS) if model_name == 'ensemble' else None)
+        ensemble = data.get('ensemble', 'vote' if model_name == 'ensemble' else None)
+        if models:
+            if any(m not in ENSEMBLE_MODELS for m in models) or len(set(models)) != len(models):
+                return jsonify({'error': f"models must be distinct values of {list(ENSEMBLE_MODELS)}"}), 400
+            if ensemble and ensemble not in ENSEMBLE_MODES:
+                return jsonify({'error': f"ensemble must be one of {list(ENSEMBLE_MODES)}"}), 400
+            job_id = enqueue_job('transcribe_ensemble', {'song_id': song_id, 'models': models, 'ensemble': ensemble,
+                                                         'segmented': segmented},
+                                 dedup_key=f"transcribe_ensemble:{song_id}:{'+'.join(models)}:{ensemble}:{segmented}")
+            return jsonify({'job_id': job_id, 'title': song['title']}), 202
+
+        job_type = 'transcribe' if model_name == 'transkun' else 'transcribe_basic_pitch'
+        # A second request (e.g. a double click, or another web worker) for the same conversion joins the queued one
+        job_id = enqueue_job(job_type, {'song_id': song_id, 'model_name': model_name, 'segmented': segmented},
+                             dedup_key=f"transcribe:{song_id}:{model_name}:{segmented}")
+        return jsonify({'job_id': job_id, 'title': song['title']}), 202 # Accepted: poll /api/jobs/<job_id> for the result
     
     except Exception as e:
-        print("[convert_audio]: Audio to midi converion failed:", e)
+        print("[convert_audio]: Could not queue the conversion:", e)
         return jsonify({'error': str(e)}), 500 # Server-side error
-    finally:
-        release_upload_lock()
 
-########################################################################################################################
 
+@app.route('/api/transcription-cache/stats', methods=['GET'])
+def get_transcription_cache_stats():
+    return jsonify(get_cache_stats()), 200
 
-def generate_video(songVersionId):
-    with videoGenerationJobsLock:
-        if songVersionId in videoGenerationJobs:
-            raise RuntimeError("Video already generating")
-        videoGenerationJobs.add(songVersionId)
 
-    try:
-        print(f"[generate_video]: Starting generation for version_id={songVersionId}")
-        song_version = get_song_version(songVersionId)
-        midi_path = song_version['midi_path']
+@app.route('/api/artifact-store/stats', methods=['GET'])
+def get_artifact_store_stats_api():
+    return jsonify(get_store_stats()), 200
 
-        if not os.path.exists(midi_path):
-            raise FileNotFoundError("MIDI file not found")
 
-        video_filename = song_version['filename'] + '.mp4'
-        new_video_path = os.path.join(VIDEO_FOLDER, video_filename)
+@app.route('/api/pcm-cache/stats', methods=['GET'])
+def get_pcm_cache_stats_api():
+    return jsonify(get_pcm_cache_stats()), 200
 
-        print(f"[generate_video] Generating video at: {new_video_path}")
-        create_video(input_midi=midi_path, video_filename=new_video_path)
-        update_song_version(songVersionId, video_path=new_video_path)
 
+@app.route('/api/note-events/stats', methods=['GET'])
+def get_note_events_stats_api():
+    return jsonify(get_note_events_stats()), 200
+
+
+@app.route('/api/score-cache/stats', methods=['GET'])
+def get_score_cache_stats_api():
+    return jsonify(get_score_cache_stats()), 200
+
+
+@app.route('/api/inference-stats', methods=['GET'])
+def get_inference_stats_api():
+    return jsonify(get_inference_stats()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format: stage and request durations of every process, plus the queue and cache state
+    depths = get_queue_depths()
+    counters = database.get_counters()
+    hit_ratios = []
+    for name in counters:
+        if name.endswith('_hits'):
+            cache = name[:-len('_hits')]
+            lookups = counters[name] + counters.get(cache + '_misses', 0)
+            if lookups:
+                hit_ratios.append(({'cache': cache}, counters[name] / lookups))
+    extra = [
+        ('jobs', 'gauge', 'Queued and running jobs.',
+         [({'job_type': d['job_type'], 'status': d['status']}, d['jobs']) for d in depths]),
+        ('oldest_job_age_seconds', 'gauge', 'Age of the oldest queued job.',
+         [({'job_type': d['job_type']}, d['oldest_age'] or 0) for d in depths if d['status'] == 'queued']),
+        ('events_total', 'counter', 'Cache and inference counters.',
+         [({'name': name}, value) for name, value in sorted(counters.items())]),
+        ('cache_hit_ratio', 'gauge', 'Hits per lookup since the counters were created.', hit_ratios),
+    ]
+    return app.response_class(render_metrics(extra), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    # The page opens the job event stream on the API's origin. A reverse proxy in front of the app routes /events to
+    # the event server (job_events.py); without one the browser is redirected to it.
+    target = EVENTS_PUBLIC_URL or f"{request.scheme}://{re.sub(r':[0-9]+$', '', request.host)}:{EVENTS_PORT}/events"
+    query = request.query_string.decode()
+    return redirect(f"{target}?{query}" if query else target, 307)
+
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job_api(job_id):
+    job = get_job(job_id)
+    if not job:
+        return {'error': 'Not found'}, 404
+    return jsonify({
+        'job_id': job['job_id'],
+        'job_type': job['job_type'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'stage': job['stage'],
+        'progress': {'done': job['progress_done'], 'total': job['progress_total']},
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+    }), 200
+
+########################################################################################################################
+
+
+def artifact_job_key(artifact, songVersionId):
+    return f"render_{artifact}:{songVersionId}"
+
+
+def schedule_artifact(artifact, songVersionId, priority=0):
+    # A request for a file that is already being rendered joins its job without writing anything: clients poll
+    # this, and every write would take the write lock and change the ETags of the song lists
+    status_field = f"{artifact}_status"
+    row = get_song_versions(fields=[status_field], version_id=songVersionId)
+    job = get_latest_job(artifact_job_key(artifact, songVersionId))
+    if (row and row[status_field] == ARTIFACT_PENDING and job and job['status'] in (JOB_QUEUED, JOB_RUNNING)
+            and job['priority'] >= priority):
+        return job['job_id']
+
+    # Status first: a job finishing in between still leaves the final status behind
+    if not row or row[status_field] != ARTIFACT_PENDING:
+        update_song_version(songVersionId, **{status_field: ARTIFACT_PENDING})
+    return enqueue_job(f"render_{artifact}", {'song_version_id': songVersionId}, priority=priority,
+                       dedup_key=artifact_job_key(artifact, songVersionId))
+
+
+def schedule_artifacts(songVersionId, artifacts=ARTIFACTS):
+    # Post-conversion stage: pre-render everything the user may open, behind new transcriptions
+    for artifact in artifacts:
+        schedule_artifact(artifact, songVersionId, priority=ARTIFACT_PRIORITY)
+
+
+def export_musicxml(job_id, song_version):
+    musicxml_path = os.path.join(XML_FOLDER, song_version['filename'] + '.musicxml')
+    set_job_stage(job_id, 'parsing')
+    score = get_score(song_version['midi_path'])
+    set_job_stage(job_id, 'writing')
+    with timed('musicxml_export'):
+        score.write('musicxml', musicxml_path)
+    return musicxml_path
+
+
+def export_pdf(job_id, song_version):
+    output_path = os.path.join(PDF_FOLDER, song_version['filename'])
+    set_job_stage(job_id, 'parsing')
+    score = get_score(song_version['midi_path'])
+    set_job_stage(job_id, 'engraving')  # LilyPond
+    with timed('lilypond_export'):
+        pdf_path = score.write('lily.pdf', output_path)
+    if os.path.exists(output_path): #music21 creates 2 files: 'pdf_path' and 'pdf_path'+'.pdf'
+        os.remove(output_path)
+    return str(pdf_path)
+
+
+def export_video(job_id, song_version):
+    new_video_path = os.path.join(VIDEO_FOLDER, song_version['filename'] + '.mp4')
+    work_dir = os.path.join(VIDEO_FOLDER, 'tmp', f"job_{job_id}")
+    stream_dir = video_stream_dir(song_version['version_id'])
+    shutil.rmtree(stream_dir, ignore_errors=True)  # segments of an older render (before a transposition)
+    playlist_path = os.path.join(stream_dir, PLAYLIST_FILE)
+    print(f"[export_video] Generating video at: {new_video_path}")
+
+    def on_progress(done, total):
+        # 'streaming' once the first segments can be played from the playlist
+        update_job_progress(job_id, done, total, 'streaming' if os.path.exists(playlist_path) else 'rendering')
+
+    set_job_stage(job_id, 'rendering')
+    try:
+        render_video(song_version['midi_path'], new_video_path, work_dir, stream_dir=stream_dir, on_progress=on_progress)
     finally:
-        with videoGenerationJobsLock:
-            videoGenerationJobs.pop(songVersionId)
-        print(f"[generate_video]: Finished generation for version_id={songVersionId}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return new_video_path
 
 
-@app.route('/api/get-video', methods=['GET', 'HEAD'])
-def get_video():
+artifactRenderers = {'musicxml': export_musicxml, 'pdf': export_pdf, 'video': export_video}
+
+
+def find_rendered_artifact(artifact, midi_path):
+    # Stored midi files are named by their content, so versions with the same midi_path can share what was rendered
+    if not is_blob(midi_path):
+        return None
+    with db_transaction() as conn:
+        rows = conn.execute(f'SELECT {artifact}_path AS path FROM song_versions WHERE midi_path = ? AND {artifact}_status = ?',
+                            (midi_path, ARTIFACT_READY)).fetchall()
+    for row in rows:
+        if is_blob(row['path']) and os.path.exists(row['path']):
+            return row['path']
+    return None
+
+
+def render_artifact(artifact, job_id, song_version_id):
+    print(f"[render_artifact]: Rendering {artifact} for version_id={song_version_id}")
+    song_version = get_song_version(song_version_id)
+    if not song_version:
+        raise ValueError("Song version not found")
+    midi_path = song_version['midi_path']
+    if not midi_path or not os.path.exists(midi_path):
+        raise FileNotFoundError("MIDI file not found")
+
+    artifact_path = find_rendered_artifact(artifact, midi_path)
+    if artifact_path:  # another version with the same midi file already has it
+        artifact_path = share_file(artifact_path)
+    else:
+        midi_mtime = os.stat(midi_path).st_mtime_ns
+        try:
+            rendered_path = artifactRenderers[artifact](job_id, song_version)
+            current = get_song_version(song_version_id)
+            if not current or current['midi_path'] != midi_path or os.stat(midi_path).st_mtime_ns != midi_mtime:
+                os.remove(rendered_path)
+                raise RuntimeError("The MIDI file was changed (transposed) while rendering")
+        except Exception:
+            update_song_version(song_version_id, **{f"{artifact}_status": ARTIFACT_FAILED})
+            raise
+        artifact_path = put_file(rendered_path)
+
+    previous_path = song_version[f"{artifact}_path"]
+    update_song_version(song_version_id, **{f"{artifact}_path": artifact_path, f"{artifact}_status": ARTIFACT_READY})
+    if previous_path:
+        release_file(previous_path)  # also when it is the same blob: this version held a reference already
+    print(f"[render_artifact]: Finished {artifact} for version_id={song_version_id}")
+    return {'song_version_id': song_version_id, f"{artifact}_path": artifact_path}
+
+
+# Job handlers, executed by the artifact and video worker processes (see start_background_workers)
+def render_musicxml(job_id, song_version_id):
+    return render_artifact('musicxml', job_id, song_version_id)
+
+
+def render_pdf(job_id, song_version_id):
+    return render_artifact('pdf', job_id, song_version_id)
+
+
+def generate_video(job_id, song_version_id):
+    return render_artifact('video', job_id, song_version_id)
+
+
+def artifact_response(artifact, extension, as_attachment=False):
+    # 200 with the file if it is rendered, otherwise 202 with the job rendering it (queued now if needed)
     def error_response(status, message):
         if request.method == 'HEAD':
             return '', status
         return jsonify({'error': message}), status
-    
-    video_was_generated = False
-    songVersionId = request.args.get('song_version_id')
+
+    songVersionId = request.args.get('song_version_id', type=int)
     if not songVersionId:
         return error_response(404, 'Song version not found')
 
-    row = get_song_versions(fields=['video_path'], version_id=songVersionId)
-    video_path = row.get('video_path') if row else None
+    path_field = f"{artifact}_path"
+    row = get_song_versions(fields=[path_field, f"{artifact}_status", 'filename'], version_id=songVersionId)
+    if not row:
+        return error_response(404, 'Song version not found')
+    artifact_path = row.get(path_field)
 
-    if not video_path or not os.path.exists(video_path):
-        try:
-            generate_video(songVersionId)
-            video_was_generated = True
+    if not artifact_path or not os.path.exists(artifact_path):
+        # Requests for a file that is already being rendered join the same job
+        job_id = schedule_artifact(artifact, songVersionId)
+        job = get_job(job_id)
+        headers = {'X-Job-Id': str(job_id), 'Location': f"/api/jobs/{job_id}"}
+        if request.method == 'HEAD':
+            return '', 202, headers
+        return jsonify({
+            'job_id': job_id,
+            'status': job['status'],
+            'stage': job['stage'],
+            'progress': {'done': job['progress_done'], 'total': job['progress_total']},
+        }), 202, headers
 
-        except RuntimeError as e:
-            return error_response(429, str(e))  # Conflict: another job is running
-        except Exception as e:
-            return error_response(500, f'Failed to generate video: {str(e)}') # Server-side error
- 
- 
-        row = get_song_versions(fields=['video_path'], version_id=songVersionId)
-        video_path = row.get('video_path') if row else None
+    if request.method == 'HEAD':
+        return '', 200
 
-    if not video_path or not os.path.exists(video_path): 
-        return error_response(404, 'Video file not found')
+    return send_file(artifact_path, as_attachment=as_attachment, download_name=row.get('filename') + extension)
+
+
+@app.route('/api/get-video', methods=['GET', 'HEAD'])
+def get_video():
+    return artifact_response('video', '.mp4')
 
-    if request.method == 'HEAD':
-        statusCode =  201 if video_was_generated else 200
-        return '', statusCode
 
-    return send_file(video_path)
+@app.route('/api/video-stream/<int:songVersionId>/playlist.m3u8', methods=['GET'])
+def get_video_stream_playlist(songVersionId):
+    # HLS playlist of the video while (and after) it is rendered; 202 with the rendering job until the first segment exists
+    playlist_path = os.path.join(video_stream_dir(songVersionId), PLAYLIST_FILE)
+    if not os.path.exists(playlist_path):
+        row = get_song_versions(fields=['video_path'], version_id=songVersionId)
+        if not row:
+            return jsonify({'error': 'Song version not found'}), 404
+        if row.get('video_path') and os.path.exists(row['video_path']):
+            return jsonify({'error': 'No stream, the video is available from /api/get-video'}), 404
+        job_id = schedule_artifact('video', songVersionId)
+        return jsonify({'job_id': job_id}), 202, {'X-Job-Id': str(job_id), 'Retry-After': '1'}
+    response = send_file(playlist_path, mimetype='application/vnd.apple.mpegurl', max_age=0)
+    response.headers['Cache-Control'] = 'no-cache'  # the playlist grows until #EXT-X-ENDLIST
+    return response
+
+
+@app.route('/api/video-stream/<int:songVersionId>/<segment>', methods=['GET'])
+def get_video_stream_segment(songVersionId, segment):
+    if not re.fullmatch(r'segment_\d+\.ts', segment):
+        return jsonify({'error': 'Not found'}), 404
+    return send_from_directory(video_stream_dir(songVersionId), segment, mimetype='video/mp2t')
+
+
+@app.route('/api/get-video-progress', methods=['GET'])
+def get_video_progress():
+    songVersionId = request.args.get('song_version_id', type=int)
+    job = get_latest_job(artifact_job_key('video', songVersionId)) if songVersionId else None
+    if not job:
+        return jsonify({'error': 'No video job for this song version'}), 404
+    return jsonify({
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'frames_rendered': job['progress_done'] or 0,
+        'frames_total': job['progress_total'],
+        'error': job['error'],
+    }), 200
+
+
+@app.route('/api/get-artifacts-status/<int:songVersionId>', methods=['GET'])
+def get_artifacts_status(songVersionId):
+    row = get_song_versions(fields=[f"{artifact}_status" for artifact in ARTIFACTS], version_id=songVersionId)
+    if not row:
+        return jsonify({'error': 'Song version not found'}), 404
+    return jsonify({artifact: row.get(f"{artifact}_status") for artifact in ARTIFACTS}), 200
 
 
 @app.route('/api/get-audio', methods=['GET'])
@@ -729,7 +1198,7 @@ def get_audio():
         return jsonify({'error': 'Song version not found'}), 404
     row = get_song_versions(fields=['audio_path','filename'], version_id=songVersionId)
     audio_path = row.get('audio_path') if row else None
-    filename = row.get('filename') + '.mp3'
+    filename = row.get('filename') + (os.path.splitext(audio_path)[1] or '.mp3')
     return send_file(audio_path, download_name = filename)
 
 @app.route('/api/get-midi', methods=['GET'])
@@ -742,60 +1211,70 @@ def get_midi():
     filename = row.get('filename') + '.mid'
     return send_file(midi_path, download_name = filename)
 
-@app.route('/api/get-musicxml', methods=['GET'])
-def get_musicxml():
-    songVersionId = request.args.get('song_version_id')
-    if not songVersionId:
+@app.route('/api/get-note-events/<int:songVersionId>', methods=['GET'])
+def get_note_events_api(songVersionId):
+    # Packed typed arrays of the notes (layout in note_events.py), gzip compressed. ?start= / ?end= (seconds)
+    # select the notes sounding in that window.
+    row = get_song_versions(fields=['midi_path'], version_id=songVersionId)
+    if not row or not row.get('midi_path') or not os.path.exists(row['midi_path']):
         return jsonify({'error': 'Song version not found'}), 404
-
-    row = get_song_versions(fields=['musicxml_path','midi_path','filename'], version_id=songVersionId)
-    musicxml_path = row.get('musicxml_path') if row else None
-    filename = row.get('filename') + '.musicxml'
-
-    if not musicxml_path or not os.path.exists(musicxml_path):
-        midi_path = row.get('midi_path') 
-        musicxml_path = os.path.join(XML_FOLDER, filename)
-        try:
-            s = converter.parse(midi_path)
-            s.write('musicxml', musicxml_path)
-            print(f"[get_musicxml]: Successfully converted {midi_path} to {musicxml_path}")
-            update_song_version(songVersionId, musicxml_path=musicxml_path)
-        except Exception as e:
-            print(f"[get_musicxml]: Error during conversion: {e}")
-            return jsonify({'error': 'Failed to convert MIDI to MusicXML', 'details': str(e)}), 500 # Server-side error
-        
-    return send_file(musicxml_path, download_name = filename)
-
-
-@app.route('/api/get-pdf', methods=['GET'])
-def get_pdf():
-    songVersionId = request.args.get('song_version_id')
-    if not songVersionId:
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+
+    midi_hash, data = get_note_events(row['midi_path'])
+    etag = f"{midi_hash[:16]}-{start}-{end}" # changes with the midi file (transposition)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    if start is not None or end is not None:
+        data = note_events_window(data, start, end)
+    response = app.response_class(data, mimetype='application/octet-stream')
+    if 'gzip' in request.accept_encodings:
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response.set_data(gzip.decompress(data))
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/api/score-take/<int:songVersionId>', methods=['POST'])
+def score_take_api(songVersionId):
+    # A practice take, recorded (multipart file 'take') or as the pitch frames detected in the browser
+    # (JSON {"times": [...], "pitches": [...]}), aligned to the notes of the version and scored
+    row = get_song_versions(fields=['midi_path'], version_id=songVersionId)
+    if not row or not row.get('midi_path') or not os.path.exists(row['midi_path']):
         return jsonify({'error': 'Song version not found'}), 404
+    _, data = get_note_events(row['midi_path'])
 
-    row = get_song_versions(fields=['pdf_path','midi_path','filename'], version_id=songVersionId)
-    pdf_path = row.get('pdf_path') if row else None
-    filename_base = row.get('filename') 
-    filename = filename_base + '.pdf'
-    
-    if not pdf_path or not os.path.exists(pdf_path):
-        midi_path = row.get('midi_path') 
+    try:
+        take = request.files.get('take')
+        if take:
+            take.stream.flush() # written by IngestRequest, deleted when the request ends
+            score = submit_take(gzip.decompress(data), take_path=take.stream.path)
+        else:
+            frames = request.get_json(silent=True) or {}
+            score = submit_take(gzip.decompress(data), times=frames.get('times'), pitches=frames.get('pitches'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print("[score_take_api]: Could not score the take:", e)
+        return jsonify({'error': str(e)}), 500
+    score['song_version_id'] = songVersionId
+    return jsonify(score), 200
 
-        output_path = os.path.join(PDF_FOLDER, filename_base) 
-        
-        try:
-            s = converter.parse(midi_path)
-            pdf_path = s.write('lily.pdf', output_path)
-            if os.path.exists(output_path): #music21 creates 2 files: 'pdf_path' and 'pdf_path'+'.pdf'
-                os.remove(output_path) 
 
-            print(f"[get_pdf]: Successfully converted {midi_path} to {pdf_path}")
-            update_song_version(songVersionId, pdf_path=str(pdf_path))
-        except Exception as e:
-            print(f"[get_pdf]: Error during conversion: {e}")
-            return jsonify({'error': 'Failed to convert MIDI to PDF', 'details': str(e)}), 500 # Server-side error
+@app.route('/api/get-musicxml', methods=['GET', 'HEAD'])
+def get_musicxml():
+    return artifact_response('musicxml', '.musicxml')
+
 
-    return send_file(pdf_path, as_attachment=True, download_name = filename)
+@app.route('/api/get-pdf', methods=['GET', 'HEAD'])
+def get_pdf():
+    return artifact_response('pdf', '.pdf', as_attachment=True)
 
 
 @app.route('/midi/<filename>', methods=['GET'])
@@ -815,24 +1294,19 @@ def delete_song_version_api(songVersionId):
 
 @app.route('/api/get-song-picture/<int:songVersionId>')
 def get_song_picture(songVersionId):
+    # ?size=card|card2x|modal, ?v= changes whenever the picture does (the gallery sends a hash of picture_path)
+    variant = request.args.get('size', DEFAULT_THUMBNAIL_VARIANT)
     row = get_song_versions(fields=['picture_path'], version_id=songVersionId)
 
-    if row and row["picture_path"]:
-        picture_path = row["picture_path"]
-        if picture_path.startswith("http://") or picture_path.startswith("https://"):
-            try: 
-                response = requests.get(picture_path)
-                if response.status_code == 200:
-                    return send_file(
-                        BytesIO(response.content),
-                        mimetype='image/png'
-                    )
-            except requests.exceptions.RequestException as e:
-                print(f"[get_song_picture]: Error while fetching image from the URL: {e}")
-        return send_file(row["picture_path"], mimetype='image/png')
-    
-    
-    return send_file("static/music2.png", mimetype='image/png')
+    thumbnail_path = get_thumbnail(row["picture_path"], variant) if row and row["picture_path"] else None
+    if not thumbnail_path:
+        return send_file("static/music2.png", mimetype='image/png', max_age=PICTURE_FALLBACK_MAX_AGE)
+
+    if request.args.get('v'):
+        response = send_file(thumbnail_path, mimetype=THUMBNAIL_MIMETYPE, max_age=PICTURE_MAX_AGE)
+        response.cache_control.immutable = True
+        return response
+    return send_file(thumbnail_path, mimetype=THUMBNAIL_MIMETYPE, max_age=PICTURE_UNVERSIONED_MAX_AGE)
 
 
 
@@ -842,5 +1316,45 @@ def game():
     return render_template('game.html')
 
 
+def lower_worker_priority():
+    os.nice(ARTIFACT_WORKER_NICENESS)
+
+
+def start_background_workers():
+    requeue_expired_jobs()
+    start_event_server()
+    start_worker_pool('transcription', {'transcribe': run_transcription, 'transcribe_ensemble': run_ensemble_transcription},
+                      TRANSCRIPTION_WORKERS)
+    start_worker_pool('basic_pitch', {}, BASIC_PITCH_WORKERS, batch_size=BASIC_PITCH_BATCH_SONGS, initializer=load_model,
+                      batch_handlers={'transcribe_basic_pitch': run_basic_pitch_transcriptions})
+    start_worker_pool('artifacts', {'render_musicxml': render_musicxml, 'render_pdf': render_pdf}, ARTIFACT_WORKERS,
+                      initializer=lower_worker_priority)
+    start_worker_pool('video', {'render_video': generate_video}, VIDEO_RENDER_WORKERS, initializer=lower_worker_priority)
+    start_worker_pool('downloads', {'download_youtube': run_youtube_download}, DOWNLOAD_WORKERS)
+
+
+def stop_background_services(signum, frame):
+    # Exit normally, so multiprocessing stops the worker processes too (they get SIGTERM once, like this process)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.exit(0)
+
+
+def run_background_services():
+    # Job workers and event server without the web server, e.g. next to gunicorn (gunicorn.conf.py) or on another host
+    signal.signal(signal.SIGTERM, stop_background_services)
+    start_background_workers()
+    while True:
+        time.sleep(3600)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Piano learning app server (development; gunicorn.conf.py for production)')
+    parser.add_argument('--services', action='store_true', help='run only the job workers and the event server')
+    args = parser.parse_args()
+    init_db()
+    migrate_db()
+    if args.services:
+        run_background_services()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true': # debug reloader: start workers only in the process that serves requests
+        start_background_workers()
     app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
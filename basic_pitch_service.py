@@ -0,0 +1,129 @@
+import os
+import time
+
+import numpy as np
+from basic_pitch import ICASSP_2022_MODEL_PATH
+from basic_pitch.constants import AUDIO_N_SAMPLES, AUDIO_SAMPLE_RATE, FFT_HOP
+from basic_pitch.inference import Model, unwrap_output
+import basic_pitch.note_creation as infer
+
+from database import increment_counter, get_counters
+from metrics import timed
+from pcm_cache import get_pcm
+
+
+# Same windowing and post-processing defaults as basic_pitch.inference.predict
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+ONSET_THRESHOLD = 0.5
+FRAME_THRESHOLD = 0.3
+MINIMUM_NOTE_LENGTH_MS = 127.70
+MIN_NOTE_LEN = int(np.round(MINIMUM_NOTE_LENGTH_MS / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+
+MAX_BATCH_WINDOWS = int(os.environ.get('BASIC_PITCH_MAX_BATCH_WINDOWS', 64))  # windows (~2 s of audio each) per forward pass
+
+model = None  # loaded once per process, see load_model
+
+
+def load_model():
+    global model
+    if model is None:
+        start = time.perf_counter()
+        model = Model(ICASSP_2022_MODEL_PATH)
+        load_seconds = time.perf_counter() - start
+        increment_counter('basic_pitch_model_loads')
+        increment_counter('basic_pitch_model_load_seconds', load_seconds)
+        print(f"[load_model]: basic_pitch model loaded in {load_seconds:.2f}s (pid {os.getpid()})")
+    return model
+
+
+def audio_windows(audio):
+    # Same windows as basic_pitch.inference.get_audio_input: (n_windows, AUDIO_N_SAMPLES, 1), the first one
+    # starting half an overlap before the audio, the last one padded with silence
+    padded = np.concatenate([np.zeros(OVERLAP_LEN // 2, dtype=np.float32), audio])
+    n_windows = max(-(-padded.shape[0] // HOP_SIZE), 1)
+    padded = np.pad(padded, (0, (n_windows - 1) * HOP_SIZE + AUDIO_N_SAMPLES - padded.shape[0]))
+    return np.lib.stride_tricks.sliding_window_view(padded, AUDIO_N_SAMPLES)[::HOP_SIZE][:n_windows, :, None]
+
+
+@timed('transcription_batch', model='basic_pitch')
+def transcribe_batch(audio_inputs):
+    """Transcribe several songs with one model, stacking the windows of all of them into shared forward passes.
+
+    Every input is an audio file (decoded through the shared PCM cache) or mono samples at AUDIO_SAMPLE_RATE.
+    Returns a list with one (midi_data, note_events) tuple per input.
+    """
+    load_model()
+    start = time.perf_counter()
+
+    windows = []
+    window_counts = []
+    original_lengths = []
+    for audio in audio_inputs:
+        if isinstance(audio, (str, os.PathLike)):
+            audio = get_pcm(audio, AUDIO_SAMPLE_RATE)
+        song_windows = audio_windows(audio)
+        windows.append(song_windows)
+        window_counts.append(song_windows.shape[0])
+        original_lengths.append(audio.shape[0])
+
+    stacked = np.concatenate(windows).astype(np.float32, copy=False)  # (n_windows, AUDIO_N_SAMPLES, 1)
+    outputs = {'note': [], 'onset': [], 'contour': []}
+    for i in range(0, stacked.shape[0], MAX_BATCH_WINDOWS):
+        for k, v in model.predict(stacked[i:i + MAX_BATCH_WINDOWS]).items():
+            outputs[k].append(v)
+    outputs = {k: np.concatenate(v) for k, v in outputs.items()}
+    inference_seconds = time.perf_counter() - start
+
+    results = []
+    offset = 0
+    for window_count, original_length in zip(window_counts, original_lengths):
+        model_output = {
+            k: unwrap_output(v[offset:offset + window_count], original_length, N_OVERLAPPING_FRAMES)
+            for k, v in outputs.items()
+        }
+        offset += window_count
+        midi_data, note_events = infer.model_output_to_notes(
+            model_output,
+            onset_thresh=ONSET_THRESHOLD,
+            frame_thresh=FRAME_THRESHOLD,
+            min_note_len=MIN_NOTE_LEN,
+        )
+        results.append((midi_data, note_events))
+
+    total_seconds = time.perf_counter() - start
+    increment_counter('basic_pitch_batches')
+    increment_counter('basic_pitch_songs', len(audio_inputs))
+    increment_counter('basic_pitch_windows', stacked.shape[0])
+    increment_counter('basic_pitch_audio_seconds', sum(original_lengths) / AUDIO_SAMPLE_RATE)
+    increment_counter('basic_pitch_inference_seconds', inference_seconds)
+    increment_counter('basic_pitch_total_seconds', total_seconds)
+    print(f"[transcribe_batch]: {len(audio_inputs)} song(s), {stacked.shape[0]} window(s) in {total_seconds:.2f}s")
+    return results
+
+
+def get_inference_stats():
+    counters = get_counters('basic_pitch_')
+    batches = counters.get('basic_pitch_batches', 0)
+    songs = counters.get('basic_pitch_songs', 0)
+    windows = counters.get('basic_pitch_windows', 0)
+    inference_seconds = counters.get('basic_pitch_inference_seconds', 0)
+    total_seconds = counters.get('basic_pitch_total_seconds', 0)
+    model_loads = counters.get('basic_pitch_model_loads', 0)
+    return {
+        'model_loads': int(model_loads),
+        'avg_model_load_seconds': counters.get('basic_pitch_model_load_seconds', 0) / model_loads if model_loads else None,
+        'batches': int(batches),
+        'songs': int(songs),
+        'windows': int(windows),
+        'avg_songs_per_batch': songs / batches if batches else None,
+        'avg_batch_latency_seconds': total_seconds / batches if batches else None,
+        'windows_per_second': windows / inference_seconds if inference_seconds else None,
+        'audio_seconds_per_second': counters.get('basic_pitch_audio_seconds', 0) / total_seconds if total_seconds else None,
+    }
+
+
+def transcribe_files(audio_inputs, midi_paths):
+    for (midi_data, note_events), midi_path in zip(transcribe_batch(audio_inputs), midi_paths):
+        midi_data.write(midi_path)
@@ -0,0 +1,91 @@
+import os
+import wave
+import zlib
+
+import numpy as np
+import pretty_midi
+
+
+FIXTURE_SAMPLE_RATE = 22050
+FIXTURE_TEMPO = 120
+FIXTURE_GRID = 0.125  # seconds; onsets on the same grid step sound as chords
+
+# name -> (seconds, notes per second)
+FIXTURES = {
+    'short_sparse': (20, 2),
+    'short_dense': (20, 10),
+    'medium_dense': (90, 10),
+    'long_sparse': (360, 3),  # longer than SEGMENTED_MIN_DURATION: transcribed window by window
+}
+QUICK_FIXTURES = ('short_sparse',)
+
+C_MAJOR = (0, 2, 4, 5, 7, 9, 11)
+
+
+def scale_pitch(degree, lowest):
+    return lowest + 12 * (degree // 7) + C_MAJOR[degree % 7]
+
+
+def make_midi(name, seconds, notes_per_second):
+    """A piano part in C major: a melody walking the scale in the right hand, bass notes in the left.
+
+    The notes only depend on the fixture name, so every run (and every machine) gets the same files.
+    """
+    rng = np.random.default_rng(zlib.crc32(name.encode()))
+    n_notes = int(seconds * notes_per_second)
+    onsets = np.sort(np.round(rng.uniform(0, seconds - 1, n_notes) / FIXTURE_GRID) * FIXTURE_GRID)
+
+    piano = pretty_midi.Instrument(program=0, name='Piano')
+    melody = 10
+    for onset in onsets:
+        if rng.random() < 0.7:
+            melody = int(np.clip(melody + rng.integers(-2, 3), 0, 20))
+            pitch = scale_pitch(melody, 60)
+        else:
+            pitch = scale_pitch(int(rng.integers(0, 10)), 36)
+        duration = float(rng.uniform(0.15, 0.8))
+        piano.notes.append(pretty_midi.Note(velocity=int(rng.integers(50, 110)), pitch=pitch,
+                                            start=float(onset), end=min(float(onset) + duration, seconds)))
+
+    midi = pretty_midi.PrettyMIDI(initial_tempo=FIXTURE_TEMPO)
+    midi.instruments.append(piano)
+    return midi
+
+
+def synthesize(midi, sample_rate=FIXTURE_SAMPLE_RATE):
+    # Decaying harmonics per note: no piano, but clear onsets and pitches for the transcription models
+    audio = np.zeros(int((midi.get_end_time() + 1) * sample_rate), dtype=np.float32)
+    for note in midi.instruments[0].notes:
+        frequency = pretty_midi.note_number_to_hz(note.pitch)
+        held = note.end - note.start
+        t = np.arange(int((held + 0.3) * sample_rate), dtype=np.float32) / sample_rate
+        tone = np.zeros_like(t)
+        for harmonic in (1, 2, 3, 4):
+            if frequency * harmonic < sample_rate / 2:
+                tone += np.sin(2 * np.pi * frequency * harmonic * t) / harmonic ** 1.5
+        envelope = np.exp(-3 * t) * np.minimum(1, t / 0.005) * np.exp(-20 * np.maximum(0, t - held))
+        start = int(note.start * sample_rate)
+        audio[start:start + len(t)] += note.velocity / 127 * tone * envelope
+    return audio * (0.9 / max(float(np.abs(audio).max()), 1e-9))
+
+
+def write_wav(path, audio, sample_rate=FIXTURE_SAMPLE_RATE):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((audio * 32767).astype('<i2').tobytes())
+
+
+def make_fixture(name, folder):
+    # (wav path, midi path) of a fixture, written to `folder` unless they are there already
+    seconds, notes_per_second = FIXTURES[name]
+    os.makedirs(folder, exist_ok=True)
+    wav_path = os.path.join(folder, f"{name}.wav")
+    midi_path = os.path.join(folder, f"{name}.mid")
+    if not (os.path.exists(wav_path) and os.path.exists(midi_path)):
+        midi = make_midi(name, seconds, notes_per_second)
+        midi.write(midi_path)
+        write_wav(wav_path, synthesize(midi))
+        print(f"[make_fixture]: {name}: {len(midi.instruments[0].notes)} notes, {seconds}s")
+    return wav_path, midi_path
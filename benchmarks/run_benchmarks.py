@@ -0,0 +1,434 @@
+"""Benchmarks of the conversion pipeline and the API hot paths. Offline and on the CPU only.
+
+    python benchmarks/run_benchmarks.py                  # all fixtures, compared with benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --quick          # the shortest fixture and fewer requests
+    python benchmarks/run_benchmarks.py --save-baseline  # the results become the new baseline
+
+Every run starts from an empty temporary directory (database, uploads, caches), so nothing is served from a cache
+of an earlier run. Jobs are run in this process as a worker would run them; the per-stage times come from the
+stage_duration_seconds metric (see metrics.py). The exit status is 1 if a result is more than --tolerance worse
+than the baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from fixtures import FIXTURES, QUICK_FIXTURES, make_fixture
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, 'benchmarks', 'results.json')
+
+BENCHMARKS = ('convert', 'transpose', 'musicxml', 'pdf', 'video', 'load')
+TRANSPOSE_KEYS = ('D', 'F#', 'A#')
+LOAD_SONG_VERSIONS = 300  # versions in the database during the load test
+LOAD_ENDPOINTS = ('gallery', 'dropdown', 'artifacts')
+
+# artifact -> (benchmark name, endpoint, job type)
+ARTIFACT_BENCHMARKS = {
+    'musicxml': ('get_musicxml', '/api/get-musicxml', 'render_musicxml'),
+    'pdf': ('get_pdf', '/api/get-pdf', 'render_pdf'),
+    'video': ('generate_video', '/api/get-video', 'render_video'),
+}
+
+# Compared with the baseline: metric -> 1 if lower is better, -1 if higher is better
+COMPARED_METRICS = {'seconds': 1, 'p50_ms': 1, 'p95_ms': 1, 'requests_per_second': -1}
+# Differences below these are noise, whatever the ratio
+NOISE_FLOORS = {'seconds': 0.01, 'p50_ms': 1.0, 'p95_ms': 2.0, 'requests_per_second': 5.0}
+
+WORKER_ID = f"benchmark@{socket.gethostname()}:{os.getpid()}"
+
+
+### Helpers
+
+def stage_totals():
+    # {stage: {'seconds', 'count'}} observed so far by this process and the model processes it started
+    from database import db_transaction
+    from metrics import flush_metrics
+
+    flush_metrics()
+    with db_transaction() as conn:
+        rows = conn.execute('''
+            SELECT labels, le, value FROM metric_samples
+            WHERE name = 'stage_duration_seconds' AND le IN ('sum', 'count')
+        ''').fetchall()
+    totals = {}
+    for row in rows:
+        labels = json.loads(row['labels'])
+        name = labels['stage'] + ''.join(f"[{labels[k]}]" for k in ('model', 'helper', 'job_type') if k in labels)
+        entry = totals.setdefault(name, {'seconds': 0.0, 'count': 0})
+        entry['seconds' if row['le'] == 'sum' else 'count'] += row['value']
+    return totals
+
+
+def stage_delta(before, after):
+    delta = {}
+    for name, entry in sorted(after.items()):
+        previous = before.get(name, {'seconds': 0.0, 'count': 0})
+        if entry['count'] > previous['count']:
+            delta[name] = {'seconds': round(entry['seconds'] - previous['seconds'], 4),
+                           'count': int(entry['count'] - previous['count'])}
+    return delta
+
+
+class Measurement:
+    # Wall time and stage breakdown of a block: with Measurement() as m: ...; m.result()
+
+    def __enter__(self):
+        self.stages = stage_totals()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.stages = stage_delta(self.stages, stage_totals())
+        return False
+
+    def result(self, **extra):
+        return dict(seconds=round(self.seconds, 4), stages=self.stages, **extra)
+
+
+def run_jobs(job_id, handlers, batch_job_types=()):
+    # Runs queued jobs of the handlers' types in this process until job_id is finished, returns it
+    from job_queue import JOB_DONE, JOB_FAILED, claim_jobs, get_job, run_job, run_job_batch
+
+    while True:
+        job = get_job(job_id)
+        if job['status'] in (JOB_DONE, JOB_FAILED):
+            return job
+        claimed = claim_jobs(list(handlers), WORKER_ID)
+        if not claimed:
+            raise RuntimeError(f"Job {job_id} is {job['status']} but there is no job to run")
+        if claimed[0]['job_type'] in batch_job_types:
+            run_job_batch(claimed, handlers, WORKER_ID)
+        else:
+            run_job(claimed[0], handlers, WORKER_ID)
+
+
+def job_error(job):
+    return {'error': job['error'] or job['status']}
+
+
+def latency_summary(latencies, errors, seconds):
+    ms = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'wall_seconds': round(seconds, 4),
+        'requests_per_second': round(len(latencies) / seconds, 1),
+        'mean_ms': round(float(ms.mean()), 2),
+        'p50_ms': round(float(np.percentile(ms, 50)), 2),
+        'p95_ms': round(float(np.percentile(ms, 95)), 2),
+        'p99_ms': round(float(np.percentile(ms, 99)), 2),
+    }
+
+
+### Benchmarks
+
+def bench_convert(bs, client, fixture, wav_path, model_name):
+    # Upload, then transcription job (decoding, transcribing, saving) with the model; again with the cache warm
+    handlers = {'transcribe': bs.run_transcription, 'transcribe_ensemble': bs.run_ensemble_transcription,
+                'transcribe_basic_pitch': bs.run_basic_pitch_transcriptions}
+    results = {}
+    with Measurement() as upload:
+        with open(wav_path, 'rb') as f:
+            response = client.post('/api/upload-audio', data={'audio_file': (f, os.path.basename(wav_path))},
+                                   content_type='multipart/form-data')
+    if response.status_code != 200:
+        return {f"upload_audio:{fixture}": {'error': response.get_json().get('error')}}
+    song_id = response.get_json()['song_id']
+    results[f"upload_audio:{fixture}"] = upload.result()
+
+    for case in ('convert_audio', 'convert_audio_cached'):
+        with Measurement() as m:
+            response = client.post('/api/convert-audio', json={'song_id': song_id, 'model_name': model_name})
+            job = run_jobs(response.get_json()['job_id'], handlers, batch_job_types={'transcribe_basic_pitch'})
+        name = f"{case}[{model_name}]:{fixture}"
+        if job['status'] != 'done':
+            results[name] = job_error(job)
+            break
+        results[name] = m.result(song_version_id=job['result']['song_version_id'])
+    return results
+
+
+def add_fixture_version(bs, fixture, midi_path, wav_path):
+    # A song version of the fixture's own notes: rendering does not depend on how well a model transcribed them
+    from artifact_store import put_file
+
+    audio_path = os.path.abspath(wav_path)
+    song_id = bs.add_new_song(user_id=1, title=fixture, audio_path=audio_path, duration=FIXTURES[fixture][0])
+    stored_midi = os.path.join(bs.MIDI_FOLDER, f"fixture_{fixture}.mid")
+    shutil.copyfile(midi_path, stored_midi)
+    return bs.add_new_song_version(song_id, 'fixture', 'C', 'major', 'Piano', f"{fixture}-C-major",
+                                   put_file(stored_midi))
+
+
+def bench_transpose(bs, fixture, version_id, repeat):
+    midi_path = bs.get_song_version(version_id)['midi_path']
+    runs = []
+    stages_before = stage_totals()
+    for _ in range(repeat):
+        for new_key in TRANSPOSE_KEYS:
+            start = time.perf_counter()
+            bs.transpose_key_root(midi_path, new_key, curr_key='C')
+            runs.append(time.perf_counter() - start)
+    return {f"transpose_key_root:{fixture}": {
+        'seconds': round(statistics.median(runs), 4),
+        'runs': len(runs),
+        'stages': stage_delta(stages_before, stage_totals()),
+    }}
+
+
+def bench_artifact(bs, client, fixture, version_id, artifact):
+    # The endpoint answers 202 and queues the render, the job runs, the endpoint then sends the file
+    benchmark, endpoint, job_type = ARTIFACT_BENCHMARKS[artifact]
+    handlers = {'render_musicxml': bs.render_musicxml, 'render_pdf': bs.render_pdf, 'render_video': bs.generate_video}
+    name = f"{benchmark}:{fixture}"
+    with Measurement() as m:
+        response = client.get(endpoint, query_string={'song_version_id': version_id})
+        if response.status_code == 202:
+            job = run_jobs(response.get_json()['job_id'], {job_type: handlers[job_type]})
+            if job['status'] != 'done':
+                return {name: job_error(job)}
+            response = client.get(endpoint, query_string={'song_version_id': version_id})
+        size = len(response.get_data())
+    if response.status_code != 200:
+        return {name: {'error': f"HTTP {response.status_code}"}}
+    return {name: m.result(bytes=size)}
+
+
+def seed_song_versions(bs, version_id, count):
+    # Copies of a rendered version (shared files), so the artifact endpoints find their files
+    from artifact_store import share_file
+
+    source = bs.get_song_versions(version_id=version_id)
+    version_ids = []
+    for i in range(count):
+        song_id = bs.add_new_song(user_id=1, title=f"Load test {i}", audio_path=share_file(source['audio_path']),
+                                  duration=source['duration'])
+        new_id = bs.add_new_song_version(song_id, 'fixture', 'C', 'major', 'Piano', f"load-{i}",
+                                         share_file(source['midi_path']))
+        fields = {}
+        for artifact in bs.ARTIFACTS:
+            if source[f"{artifact}_status"] == bs.ARTIFACT_READY:
+                fields[f"{artifact}_path"] = share_file(source[f"{artifact}_path"])
+                fields[f"{artifact}_status"] = bs.ARTIFACT_READY
+        if fields:
+            bs.update_song_version(new_id, **fields)
+        version_ids.append(new_id)
+    return version_ids
+
+
+def artifact_requests(bs, version_ids):
+    # The requests the practice view sends for a version
+    ready = bs.get_song_version(version_ids[0])
+    for version_id in version_ids:
+        yield 'GET', f"/api/get-artifacts-status/{version_id}"
+        yield 'GET', f"/api/get-note-events/{version_id}"
+        yield 'GET', f"/api/get-midi?song_version_id={version_id}"
+        if ready['musicxml_status'] == bs.ARTIFACT_READY:
+            yield 'HEAD', f"/api/get-musicxml?song_version_id={version_id}"
+
+
+def bench_load(bs, version_ids, clients, total_requests):
+    requests_by_endpoint = {
+        'gallery': [('GET', '/api/get-songs-list-gallery')],
+        'dropdown': [('GET', '/api/get-songs-list-dropdown')],
+        'artifacts': list(artifact_requests(bs, version_ids)),
+    }
+    results = {}
+    for endpoint in LOAD_ENDPOINTS:
+        requests = requests_by_endpoint[endpoint]
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+        local = threading.local()
+
+        def send(i):
+            nonlocal errors
+            if not hasattr(local, 'client'):
+                local.client = bs.app.test_client()
+            method, url = requests[i % len(requests)]
+            start = time.perf_counter()
+            response = local.client.open(url, method=method, headers={'Accept-Encoding': 'gzip'})
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(send, range(total_requests)))
+        results[f"load:{endpoint}[{clients} clients]"] = latency_summary(latencies, errors,
+                                                                         time.perf_counter() - start)
+    return results
+
+
+### Baseline
+
+def compare(results, baseline, tolerance):
+    changes = []
+    for case, metrics in results.items():
+        base = baseline.get('results', {}).get(case)
+        if not base or 'error' in metrics or 'error' in base:
+            continue
+        for metric, direction in COMPARED_METRICS.items():
+            if not base.get(metric) or metric not in metrics:
+                continue
+            change = (metrics[metric] - base[metric]) / base[metric]
+            noise = abs(metrics[metric] - base[metric]) < NOISE_FLOORS[metric]
+            changes.append({
+                'case': case,
+                'metric': metric,
+                'baseline': base[metric],
+                'current': metrics[metric],
+                'change': round(change, 4),
+                'regression': direction * change > tolerance and not noise,
+            })
+    return changes
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def print_report(results, changes):
+    for case, metrics in results.items():
+        if 'error' in metrics:
+            print(f"  {case:<48} ERROR {metrics['error']}")
+        elif 'requests_per_second' in metrics:
+            print(f"  {case:<48} {metrics['requests_per_second']:>8.1f} req/s  p50 {metrics['p50_ms']:.1f} ms"
+                  f"  p95 {metrics['p95_ms']:.1f} ms  errors {metrics['errors']}")
+        else:
+            print(f"  {case:<48} {metrics['seconds']:>8.4f} s")
+    for change in changes:
+        if change['regression']:
+            print(f"  REGRESSION {change['case']} {change['metric']}: {change['baseline']} -> {change['current']}"
+                  f" ({change['change']:+.0%})")
+
+
+### Main
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help="shortest fixture, fewer repetitions and requests")
+    parser.add_argument('--fixtures', nargs='+', choices=list(FIXTURES), help="default: all (--quick: short_sparse)")
+    parser.add_argument('--skip', nargs='+', choices=BENCHMARKS, default=[], help="benchmarks not to run")
+    parser.add_argument('--model', default='transkun', choices=('transkun', 'basic_pitch'),
+                        help="model of the conversion benchmark")
+    parser.add_argument('--repeat', type=int, help="transpositions per key (default 5, --quick 1)")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients of the load test")
+    parser.add_argument('--requests', type=int, help="requests per endpoint of the load test (default 2000, --quick 200)")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="write the results to --baseline as well")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary directory of the run")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    fixtures = args.fixtures or (QUICK_FIXTURES if args.quick else list(FIXTURES))
+    repeat = args.repeat or (1 if args.quick else 5)
+    total_requests = args.requests or (200 if args.quick else 2000)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+
+    # CPU only, no network: models must not look for a GPU, nothing is downloaded
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    work_dir = tempfile.mkdtemp(prefix='piano_benchmark_')
+    os.chdir(work_dir)  # the app keeps its database and files in the working directory
+    sys.path.insert(0, REPO_DIR)
+    from init_db import init_db, migrate_db
+    init_db()
+    migrate_db()
+    import backend_server as bs
+    bs.app.root_path = work_dir  # send_file() resolves the relative file paths against it
+
+    client = bs.app.test_client()
+    results = {}
+    rendered_version = None
+    try:
+        for fixture in fixtures:
+            wav_path, midi_path = make_fixture(fixture, os.path.join(work_dir, 'fixtures'))
+            print(f"[main]: Fixture {fixture}")
+            if 'convert' not in args.skip:
+                results.update(bench_convert(bs, client, fixture, wav_path, args.model))
+            version_id = add_fixture_version(bs, fixture, midi_path, wav_path)
+            if 'transpose' not in args.skip:
+                results.update(bench_transpose(bs, fixture, version_id, repeat))
+            for artifact in ARTIFACT_BENCHMARKS:
+                if artifact not in args.skip:
+                    results.update(bench_artifact(bs, client, fixture, version_id, artifact))
+            rendered_version = rendered_version or version_id
+
+        if 'load' not in args.skip:
+            print(f"[main]: Load test, {args.clients} clients")
+            version_ids = seed_song_versions(bs, rendered_version, LOAD_SONG_VERSIONS)
+            results.update(bench_load(bs, version_ids, args.clients, total_requests))
+    finally:
+        os.chdir(REPO_DIR)
+        if args.keep:
+            print(f"[main]: Files of the run are in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'environment': environment(),
+        'options': {'fixtures': list(fixtures), 'model': args.model, 'repeat': repeat, 'clients': args.clients,
+                    'requests': total_requests, 'skip': args.skip},
+        'results': results,
+    }
+    changes = []
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get('environment', {}).get('cpu_count') != os.cpu_count():
+            print(f"[main]: Warning: the baseline was measured on another machine ({baseline['environment']})")
+        changes = compare(results, baseline, args.tolerance)
+        report['comparison'] = {'baseline': baseline_path, 'tolerance': args.tolerance, 'changes': changes}
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        shutil.copyfile(output, baseline_path)
+        print(f"[main]: Saved the baseline to {baseline_path}")
+
+    print(f"[main]: Results in {output}")
+    print_report(results, changes)
+    regressions = [c for c in changes if c['regression']]
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
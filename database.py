@@ -0,0 +1,233 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+
+# Resolved once at import: a process that changes its working directory later still uses the same database, and
+# processes started from this one (workers, renderers) inherit it through the environment
+DB_PATH = os.path.abspath(os.environ.get('DB_PATH', 'songs.db'))
+os.environ['DB_PATH'] = DB_PATH
+DB_TIMEOUT = 30  # seconds to wait for a write lock held by another process (workers share the database)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))  # idle connections kept open per process
+DB_STATEMENT_CACHE_SIZE = 256  # prepared statements cached per connection
+
+# Applied to every new connection. WAL lets readers run while a worker writes, synchronous=NORMAL is safe with WAL.
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',    # 16 MB page cache
+    'PRAGMA mmap_size = 134217728',  # 128 MB
+    f'PRAGMA busy_timeout = {DB_TIMEOUT * 1000}',
+)
+
+pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+poolPid = os.getpid()  # connections must never be shared with forked worker processes
+knownTables = set()  # tables seen in the database (has_tables)
+
+
+class PooledConnection(sqlite3.Connection):
+    # close() hands the connection back to the pool instead of closing it
+
+    def close(self):
+        release_connection(self)
+
+    def close_for_real(self):
+        super().close()
+
+
+def new_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT, factory=PooledConnection,
+                           cached_statements=DB_STATEMENT_CACHE_SIZE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def acquire_connection():
+    global pool, poolPid
+    if poolPid != os.getpid():
+        pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)  # forked: start with an empty pool of our own
+        poolPid = os.getpid()
+    try:
+        return pool.get_nowait()
+    except queue.Empty:
+        return new_connection()
+
+
+def release_connection(conn):
+    if conn.in_transaction:
+        conn.rollback()  # never hand out a connection with someone else's half-finished transaction
+    try:
+        pool.put_nowait(conn)
+    except queue.Full:
+        conn.close_for_real()
+
+
+def get_db_connection():
+    # Independent connection, conn.close() returns it to the pool
+    return acquire_connection()
+
+
+def has_tables(*names):
+    # True once init_db has created the tables; never creates the database file itself
+    if not knownTables.issuperset(names):
+        if not os.path.exists(DB_PATH):
+            return False
+        conn = get_db_connection()
+        try:
+            rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        finally:
+            conn.close()
+        knownTables.update(row[0] for row in rows)
+    return knownTables.issuperset(names)
+
+
+### Request scope
+
+def get_request_connection():
+    if 'db_conn' not in g:
+        g.db_conn = acquire_connection()
+    return g.db_conn
+
+
+@contextmanager
+def db_transaction():
+    """Connection for the database helpers.
+
+    During a request every helper shares one connection and one transaction, committed once the response is ready
+    (commit_request_connection) or rolled back if the request failed. Outside of requests (workers) every block
+    commits on its own.
+    """
+    if has_request_context():
+        yield get_request_connection()
+        return
+
+    conn = acquire_connection()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+
+
+def after_commit(func):
+    # Calls func once the changes made so far are committed: at the end of the request (never, if it fails), or
+    # right away outside of requests, where every block has committed on its own
+    if has_request_context():
+        g.setdefault('after_commit', []).append(func)
+    else:
+        func()
+
+
+def commit_request_connection(response):
+    # after_request, also called with the 500 response of an exception: server errors are rolled back (teardown).
+    # A failing commit still turns into an error response.
+    callbacks = g.pop('after_commit', [])
+    if response.status_code >= 500:
+        return response
+    if 'db_conn' in g:
+        g.db_conn.commit()
+    for func in callbacks:
+        try:
+            func()
+        except Exception as e:
+            print(f"[commit_request_connection]: after_commit callback failed: {e}")
+    return response
+
+
+def close_request_connection(exception=None):
+    # teardown_request: anything not committed by now (the request failed) is rolled back by release_connection
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        release_connection(conn)
+
+
+def init_app(app):
+    app.after_request(commit_request_connection)
+    app.teardown_request(close_request_connection)
+
+
+### Counters (shared by all processes, e.g. cache hits / misses)
+
+# Increments are buffered per process and added by a background thread in short transactions of their own, so a
+# request that only reads (e.g. a cache hit) never takes the write lock for its statistics
+COUNTER_FLUSH_INTERVAL = 2  # seconds
+pendingCounters = {}
+countersLock = threading.Lock()
+countersPid = None
+
+
+def increment_counter(name, value=1):
+    global countersPid
+    if countersPid != os.getpid():
+        with countersLock:
+            if countersPid != os.getpid():
+                pendingCounters.clear()  # forked: the parent flushes its own
+                countersPid = os.getpid()
+                threading.Thread(target=flush_counters_loop, name='counters-flush', daemon=True).start()
+    with countersLock:
+        pendingCounters[name] = pendingCounters.get(name, 0) + value
+
+
+def flush_counters():
+    if not has_tables('counters'):
+        return  # not initialized (yet), kept for a later flush
+    with countersLock:
+        pending = list(pendingCounters.items())
+        pendingCounters.clear()
+    if not pending:
+        return
+    conn = get_db_connection()
+    try:
+        conn.executemany('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                         pending)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        with countersLock:  # kept for the next flush
+            for name, value in pending:
+                pendingCounters[name] = pendingCounters.get(name, 0) + value
+        raise
+    finally:
+        conn.close()
+
+
+def flush_counters_loop():
+    while True:
+        time.sleep(COUNTER_FLUSH_INTERVAL)
+        try:
+            flush_counters()
+        except Exception as e:  # e.g. database locked - the next flush adds them
+            print(f"[flush_counters_loop]: Could not write the counters: {e}")
+
+
+@atexit.register
+def flush_counters_at_exit():
+    if countersPid == os.getpid():
+        try:
+            flush_counters()
+        except Exception as e:
+            print(f"[flush_counters_at_exit]: Could not write the counters: {e}")
+
+
+def get_counters(prefix=''):
+    # Stored values plus what this process has not written yet
+    with db_transaction() as conn:
+        rows = conn.execute('SELECT name, value FROM counters WHERE name LIKE ?', (prefix + '%',)).fetchall()
+    counters = {row['name']: row['value'] for row in rows}
+    with countersLock:
+        for name, value in pendingCounters.items():
+            if name.startswith(prefix):
+                counters[name] = counters.get(name, 0) + value
+    return counters
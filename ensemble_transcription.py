@@ -0,0 +1,153 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import pretty_midi
+
+from metrics import timed
+from segmented_transcription import transcribe_segmented, transkun_segments, read_segment, SEGMENT_SAMPLE_RATE
+
+
+ENSEMBLE_MODELS = ('transkun', 'basic_pitch')  # models of a multi-model transcription if the request names none
+ENSEMBLE_MODES = ('vote', 'union')  # vote: notes most models agree on, union: every note any model found
+ENSEMBLE_ONSET_TOLERANCE = float(os.environ.get('ENSEMBLE_ONSET_TOLERANCE', 0.05))  # seconds between onsets of one note
+ENSEMBLE_PIN_CPUS = os.environ.get('ENSEMBLE_PIN_CPUS', '1') == '1'  # give every model process its own cores
+
+# Thread pools of the model processes are sized to their share of the cores
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'SEGMENT_PROCESSES')
+
+
+def transkun_predict(audio_path, midi_path):
+    try:
+        subprocess.run(['transkun', audio_path, midi_path], check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Transkun failed: {e}")
+    return midi_path
+
+
+def transcribe_model(model_name, audio_path, midi_path, duration, segmented, on_progress=None):
+    # One model, one recording. basic_pitch (TensorFlow) is only imported by the processes using it.
+    # on_progress(done, total) is called per group of segments of a segmented transcription.
+    with timed('transcription', model=model_name, segmented=str(bool(segmented)).lower()):
+        return run_model(model_name, audio_path, midi_path, duration, segmented, on_progress)
+
+
+def run_model(model_name, audio_path, midi_path, duration, segmented, on_progress):
+    if model_name == 'transkun':
+        if segmented:
+            transcribe_segmented(audio_path, midi_path, duration, transkun_segments, SEGMENT_SAMPLE_RATE, on_progress)
+        else:
+            transkun_predict(audio_path, midi_path)
+        return midi_path
+
+    from basic_pitch_service import transcribe_files, AUDIO_SAMPLE_RATE
+    if segmented:
+        transcribe_segmented(audio_path, midi_path, duration, transcribe_files, AUDIO_SAMPLE_RATE, on_progress)
+    else:
+        transcribe_files([audio_path], [midi_path])
+    return midi_path
+
+
+def cpu_sets(n):
+    # n disjoint sets of the cores this process may use (all cores for everyone if there are fewer than n)
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    if len(cpus) < n:
+        return [cpus] * n
+    return [cpus[i * len(cpus) // n:(i + 1) * len(cpus) // n] for i in range(n)]
+
+
+def transcribe_models(audio_path, midi_paths, duration, segmented, on_progress=None):
+    """Transcribe one recording with several models at the same time, each in its own process.
+
+    `midi_paths` maps model name -> output midi file. Every process is pinned to its own share of the cores and
+    all of them read the samples from the shared PCM cache, so the total time is about that of the slowest model.
+    on_progress(done, total) is called whenever a model has finished. Returns the names of the models that failed.
+    """
+    start = time.perf_counter()
+    processes = {}
+    for (model_name, midi_path), cpus in zip(midi_paths.items(), cpu_sets(len(midi_paths))):
+        cmd = [sys.executable, os.path.abspath(__file__), model_name, os.path.abspath(audio_path),
+               os.path.abspath(midi_path), '--duration', str(duration)]
+        if segmented:
+            cmd.append('--segmented')
+        if ENSEMBLE_PIN_CPUS and hasattr(os, 'sched_setaffinity'):
+            cmd += ['--cpus', ','.join(map(str, cpus))]
+        env = dict(os.environ, **{name: str(len(cpus)) for name in THREAD_ENV_VARS})
+        processes[model_name] = subprocess.Popen(cmd, env=env)
+
+    failed = []
+    for done, (model_name, proc) in enumerate(processes.items(), 1):
+        if proc.wait() != 0 or not os.path.exists(midi_paths[model_name]):
+            print(f"[transcribe_models]: {model_name} exited with code {proc.returncode}")
+            failed.append(model_name)
+        if on_progress:
+            on_progress(done, len(processes))
+    print(f"[transcribe_models]: {', '.join(processes)} finished in {time.perf_counter() - start:.1f}s")
+    return failed
+
+
+def ensemble_midi(midi_paths, midi_path, mode='vote'):
+    """Combine the transcriptions of one recording by several models note by note, write them to `midi_path`.
+
+    Notes of the same pitch from different models with onsets within ENSEMBLE_ONSET_TOLERANCE are one note.
+    'vote' keeps the notes found by most of the models, 'union' keeps all of them. A kept note gets the mean onset
+    and offset and the highest velocity of its matches; pedals are taken from the first model that has any.
+    """
+    if mode not in ENSEMBLE_MODES:
+        raise ValueError(f"Unknown ensemble mode: {mode}")
+    min_votes = len(midi_paths) // 2 + 1 if mode == 'vote' else 1
+
+    found = []
+    control_changes = []
+    for model_index, path in enumerate(midi_paths):
+        notes, model_control_changes = read_segment(path, 0)
+        found.extend((note.pitch, note.start, model_index, note) for note in notes)
+        control_changes = control_changes or model_control_changes
+    found.sort(key=lambda f: (f[0], f[1]))
+
+    clusters = []
+    for pitch, start, model_index, note in found:
+        cluster = clusters[-1] if clusters else None
+        if (cluster and cluster[0][0] == pitch and start - cluster[0][1] <= ENSEMBLE_ONSET_TOLERANCE
+                and all(model_index != m for _, _, m, _ in cluster)):
+            cluster.append((pitch, start, model_index, note))
+        else:
+            clusters.append([(pitch, start, model_index, note)])
+
+    notes = []
+    for cluster in clusters:
+        if len(cluster) < min_votes:
+            continue
+        matches = [note for _, _, _, note in cluster]
+        notes.append(pretty_midi.Note(velocity=max(n.velocity for n in matches), pitch=cluster[0][0],
+                                      start=sum(n.start for n in matches) / len(matches),
+                                      end=sum(n.end for n in matches) / len(matches)))
+    notes.sort(key=lambda n: (n.start, n.pitch))
+
+    midi_data = pretty_midi.PrettyMIDI()
+    piano = pretty_midi.Instrument(program=0, name='Piano')
+    piano.notes = notes
+    piano.control_changes = control_changes
+    midi_data.instruments.append(piano)
+    midi_data.write(midi_path)
+    print(f"[ensemble_midi]: {mode} of {len(midi_paths)} transcriptions: {len(notes)} of {len(clusters)} note(s)")
+    return midi_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transcribe an audio file with one model (started by transcribe_models)')
+    parser.add_argument('model_name', choices=ENSEMBLE_MODELS)
+    parser.add_argument('audio_file')
+    parser.add_argument('midi_file')
+    parser.add_argument('--duration', type=float, default=0)
+    parser.add_argument('--segmented', action='store_true')
+    parser.add_argument('--cpus', help='comma separated cores to pin this process to')
+    args = parser.parse_args()
+    if args.cpus:
+        os.sched_setaffinity(0, {int(cpu) for cpu in args.cpus.split(',')})
+    transcribe_model(args.model_name, args.audio_file, args.midi_file, args.duration, args.segmented)
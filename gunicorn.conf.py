@@ -0,0 +1,43 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+# Every core serves requests. The web workers share nothing in memory: jobs, their leases and deduplication are in
+# songs.db, so any number of workers (and servers sharing the database) can take requests.
+import os
+import subprocess
+import sys
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))  # requests per worker waiting on uploads, SQLite or the scoring pool
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))  # large uploads are written to disk while they are received
+graceful_timeout = 30
+preload_app = False  # every worker imports the app (and opens its database connections) after the fork
+
+RUN_SERVICES = os.environ.get('RUN_SERVICES', '1') == '1'  # 0 when the job workers run elsewhere (--services)
+
+services = None
+
+
+def on_starting(server):
+    from init_db import init_db, migrate_db
+    init_db()
+    migrate_db()
+
+
+def when_ready(server):
+    # Job workers and the event server, once per server (not once per web worker)
+    global services
+    if RUN_SERVICES:
+        services = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  'backend_server.py'), '--services'])
+        server.log.info("Started the background services (pid %s)", services.pid)
+
+
+def on_exit(server):
+    if services and services.poll() is None:
+        services.terminate()
+        try:
+            services.wait(timeout=graceful_timeout)
+        except subprocess.TimeoutExpired:
+            services.kill()
@@ -1,7 +1,9 @@
 import sqlite3
 
+import database
+
 def init_db():
-    conn = sqlite3.connect('songs.db')
+    conn = sqlite3.connect(database.DB_PATH)
     c = conn.cursor()
 
     c.execute('''
@@ -24,6 +26,7 @@ def init_db():
         original_key_root TEXT,
         original_key_mode TEXT,
         uploaded_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT,  -- downloading / failed while the audio is fetched from a URL, NULL once it is there
         FOREIGN KEY (user_id) REFERENCES users(user_id)
     )
     ''')
@@ -46,17 +49,126 @@ def init_db():
         description TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         is_public INTEGER DEFAULT 0,
+        musicxml_status TEXT,  -- pending / ready / failed, NULL if never rendered
+        pdf_status TEXT,
+        video_status TEXT,
         FOREIGN KEY (song_id) REFERENCES songs(song_id)
     )
     ''')
 
+    # Indexes for the song lists (join, filters, sort orders)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_song_versions_song_id ON song_versions (song_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_song_versions_created_at ON song_versions (created_at, version_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_song_versions_key ON song_versions (key_root, key_mode, version_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_song_versions_model ON song_versions (model_name, version_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_song_versions_public ON song_versions (is_public, version_id)')
+
+    # Change counter of the song lists, used as their ETag
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS data_version (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    c.execute("INSERT OR IGNORE INTO data_version (name, version) VALUES ('songs', 0)")
+    for table in ('songs', 'song_versions'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_version SET version = version + 1 WHERE name = 'songs';
+            END
+            ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_type TEXT NOT NULL,
+        payload TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',  -- queued / running / done / failed
+        priority INTEGER DEFAULT 0,
+        dedup_key TEXT,  -- identical work (e.g. rendering the same song version) shares one job
+        stage TEXT,  -- what the worker is doing right now (e.g. decoding / transcribing / saving)
+        progress_done INTEGER,  -- of the current stage
+        progress_total INTEGER,
+        result TEXT,
+        error TEXT,
+        worker_id TEXT,
+        lease_expires_at REAL,  -- unix time; a running job is requeued once its worker stopped renewing the lease
+        attempts INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        revision INTEGER,  -- bumped by every change (trigger), the event server streams jobs changed since its last look
+        song_version_id INTEGER  -- the version the job works on or created (payload / result), for the event server
+    )
+    ''')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_type, priority)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_dedup_key ON jobs (dedup_key, status)')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value REAL NOT NULL DEFAULT 0
+    )
+    ''')
+
+    # Histograms and in-flight gauges of all processes, see metrics.py
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS metric_samples (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,  -- json
+        le TEXT NOT NULL,      -- bucket upper bound, 'sum' or 'count'
+        value REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (name, labels, le)
+    )
+    ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS metric_gauges (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        process TEXT NOT NULL,  -- host:pid
+        value REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (name, labels, process)
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS transcription_cache (
+        audio_hash TEXT NOT NULL,  -- sha256 of the decoded audio, so the same recording in another file / container still hits
+        model_name TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        midi_path TEXT NOT NULL,
+        key_root TEXT,
+        key_mode TEXT,
+        instrument TEXT,
+        size_bytes INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_accessed REAL NOT NULL,
+        PRIMARY KEY (audio_hash, model_name, model_version)
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_transcription_cache_last_accessed ON transcription_cache (last_accessed)')
+
+    # Content addressed files of the song versions (see artifact_store.py)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS blobs (
+        path TEXT PRIMARY KEY,  -- blobs/<ab>/<sha256><extension>
+        size_bytes INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,  -- songs / song_versions columns pointing to the file
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
     conn.commit()
     conn.close()
     print("Database initialized.")
 
 
 def migrate_db():
-    conn = sqlite3.connect('songs.db')
+    conn = sqlite3.connect(database.DB_PATH)
     c = conn.cursor()
 
    # try:
@@ -69,6 +181,50 @@ def migrate_db():
    # except sqlite3.OperationalError:
    #     pass
 
+    for column in ('musicxml_status', 'pdf_status', 'video_status'):
+        try:
+            c.execute(f'ALTER TABLE song_versions ADD COLUMN {column} TEXT')
+        except sqlite3.OperationalError:
+            pass
+
+    try:
+        c.execute('ALTER TABLE songs ADD COLUMN status TEXT')
+    except sqlite3.OperationalError:
+        pass
+
+    for column, column_type in (('stage', 'TEXT'), ('revision', 'INTEGER'), ('lease_expires_at', 'REAL')):
+        try:
+            c.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+        except sqlite3.OperationalError:
+            pass
+
+    try:
+        c.execute('ALTER TABLE jobs ADD COLUMN song_version_id INTEGER')
+        c.execute('''
+            UPDATE jobs SET song_version_id = COALESCE(json_extract(payload, '$.song_version_id'),
+                                                       json_extract(result, '$.song_version_id'))
+        ''')
+    except sqlite3.OperationalError:
+        pass
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_song_version ON jobs (song_version_id, job_type, job_id)')
+
+    # Every insert / change of a job gets the next revision: writers are serialized, so a job committed later
+    # never has a lower revision than one the event server has already seen
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_revision ON jobs (revision)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs (status, lease_expires_at)')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_insert_revision AFTER INSERT ON jobs
+    BEGIN
+        UPDATE jobs SET revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM jobs) WHERE job_id = NEW.job_id;
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_update_revision AFTER UPDATE ON jobs WHEN NEW.revision IS OLD.revision
+    BEGIN
+        UPDATE jobs SET revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM jobs) WHERE job_id = NEW.job_id;
+    END
+    ''')
+
     conn.commit()
     conn.close()
     print("Migration complete.")
@@ -76,4 +232,4 @@ def migrate_db():
 
 if __name__ == "__main__":
     init_db()
- #   migrate_db()
+    migrate_db()
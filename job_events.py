@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+from database import db_transaction
+from job_queue import row_to_job
+
+
+EVENTS_PORT = int(os.environ.get('EVENTS_PORT', 8001))
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.25))  # seconds between two looks at the jobs table
+EVENTS_KEEPALIVE = 15          # seconds of silence before a comment keeps proxies from closing the stream
+EVENTS_RETRY_MS = 2000         # browser reconnect delay after a dropped stream
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 1000))
+EVENTS_MAX_BUFFER = 256 * 1024  # bytes a client may fall behind before it is dropped (it reconnects and gets a snapshot)
+EVENTS_MAX_IDS = 50            # jobs / versions one stream may watch
+
+# Server-sent events of the background jobs, e.g. GET :8001/events?job=12,13&version=7
+#   event: job
+#   data: {"job_id": 12, "job_type": "render_video", "status": "running", "stage": "rendering",
+#          "progress": {"done": 310, "total": 2400}, "result": null, "error": null, "song_version_id": 7}
+# One asyncio loop in one thread serves every subscriber. It looks for changed jobs (jobs.revision, bumped by a
+# trigger on every change) a few times a second, however many clients are connected, and pushes them to the
+# subscribers of the job or its song version. A new stream starts with the current state of everything it watches.
+
+subscribers = set()
+
+
+class Subscriber:
+
+    def __init__(self, writer, job_ids, version_ids):
+        self.writer = writer
+        self.job_ids = job_ids
+        self.version_ids = version_ids
+
+    def wants(self, event):
+        return event['job_id'] in self.job_ids or event['song_version_id'] in self.version_ids
+
+    def send(self, data):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > EVENTS_MAX_BUFFER:
+            print("[job_events]: Dropping a subscriber that does not keep up")
+            self.writer.close()
+            return
+        self.writer.write(data)
+
+
+def job_event(job):
+    result = job['result'] if isinstance(job['result'], dict) else {}
+    return {
+        'job_id': job['job_id'],
+        'job_type': job['job_type'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': {'done': job['progress_done'], 'total': job['progress_total']},
+        'result': job['result'],
+        'error': job['error'],
+        'song_version_id': job['payload'].get('song_version_id') or result.get('song_version_id'),
+    }
+
+
+def format_event(event):
+    return f"event: job\ndata: {json.dumps(event)}\n\n".encode()
+
+
+### READ
+
+def get_revision():
+    with db_transaction() as conn:
+        row = conn.execute('SELECT COALESCE(MAX(revision), 0) AS revision FROM jobs').fetchone()
+    return row['revision']
+
+
+def get_changed_jobs(revision):
+    with db_transaction() as conn:
+        rows = conn.execute('SELECT * FROM jobs WHERE revision > ? ORDER BY revision', (revision,)).fetchall()
+    return [row_to_job(row) for row in rows]
+
+
+def get_watched_jobs(job_ids, version_ids):
+    # Current state of the jobs and of the latest job of every type working on the versions
+    jobs = []
+    with db_transaction() as conn:
+        if job_ids:
+            placeholders = ', '.join(['?'] * len(job_ids))
+            jobs += conn.execute(f'SELECT * FROM jobs WHERE job_id IN ({placeholders})', list(job_ids)).fetchall()
+        for version_id in version_ids:
+            jobs += conn.execute('''
+                SELECT * FROM jobs WHERE job_id IN (
+                    SELECT MAX(job_id) FROM jobs WHERE song_version_id = ? GROUP BY job_type)
+            ''', (version_id,)).fetchall()
+    return [row_to_job(row) for row in jobs]
+
+
+### Server
+
+def parse_ids(values):
+    ids = set()
+    for value in values:
+        ids.update(int(part) for part in value.split(',') if part.strip())
+    return ids
+
+
+async def read_request(reader):
+    # (path, query) of the request line; the headers are read and ignored
+    request_line = (await reader.readline()).decode('latin-1').split()
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+    if len(request_line) != 3:
+        raise ValueError("Bad request line")
+    method, target, _ = request_line
+    url = urlsplit(target)
+    return method, url.path, parse_qs(url.query)
+
+
+def write_response(writer, status, body=b'', content_type='text/plain'):
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                 f"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n".encode() + body)
+
+
+async def handle_client(reader, writer):
+    subscriber = None
+    try:
+        try:
+            method, path, query = await asyncio.wait_for(read_request(reader), EVENTS_KEEPALIVE)
+            job_ids = parse_ids(query.get('job', []))
+            version_ids = parse_ids(query.get('version', []))
+        except (ValueError, UnicodeDecodeError, asyncio.TimeoutError):
+            write_response(writer, '400 Bad Request', b'Bad request')
+            return
+        if method != 'GET' or path != '/events':
+            write_response(writer, '404 Not Found', b'Not found')
+            return
+        if not job_ids and not version_ids or len(job_ids) + len(version_ids) > EVENTS_MAX_IDS:
+            write_response(writer, '400 Bad Request', f"Watch 1 to {EVENTS_MAX_IDS} jobs / versions".encode())
+            return
+        if len(subscribers) >= EVENTS_MAX_SUBSCRIBERS:
+            write_response(writer, '503 Service Unavailable', b'Too many subscribers')
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\nX-Accel-Buffering: no\r\nConnection: keep-alive\r\n\r\n"
+                     + f"retry: {EVENTS_RETRY_MS}\n\n".encode())
+        # Subscribed before the snapshot is read: a change in between is sent twice rather than never
+        subscriber = Subscriber(writer, job_ids, version_ids)
+        subscribers.add(subscriber)
+        jobs = await asyncio.get_running_loop().run_in_executor(None, get_watched_jobs, job_ids, version_ids)
+        for job in jobs:
+            subscriber.send(format_event(job_event(job)))
+
+        # Nothing is expected from the client: wait for it to hang up, keep the stream alive meanwhile
+        while not writer.is_closing():
+            try:
+                if not await asyncio.wait_for(reader.read(1024), EVENTS_KEEPALIVE):
+                    break
+            except asyncio.TimeoutError:
+                subscriber.send(b": keepalive\n\n")
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        subscribers.discard(subscriber)
+        writer.close()
+
+
+async def publish_changes():
+    loop = asyncio.get_running_loop()
+    revision = await loop.run_in_executor(None, get_revision)
+    while True:
+        await asyncio.sleep(EVENTS_POLL_INTERVAL)
+        try:
+            jobs = await loop.run_in_executor(None, get_changed_jobs, revision)
+        except Exception as e:  # e.g. database locked for longer than DB_TIMEOUT - try again later
+            print(f"[publish_changes]: Could not read the jobs: {e}")
+            continue
+        for job in jobs:
+            revision = max(revision, job['revision'])
+            event = job_event(job)
+            data = format_event(event)
+            for subscriber in list(subscribers):
+                if subscriber.wants(event):
+                    subscriber.send(data)
+
+
+async def serve(port):
+    server = await asyncio.start_server(handle_client, '0.0.0.0', port)
+    print(f"[job_events]: Streaming job events on port {port}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), publish_changes())
+
+
+def start_event_server(port=EVENTS_PORT):
+    # Runs in a daemon thread of the process serving the API
+    def run():
+        try:
+            asyncio.run(serve(port))
+        except OSError as e:  # e.g. the port is taken - the front end falls back to polling
+            print(f"[start_event_server]: Could not start the event server: {e}")
+
+    thread = threading.Thread(target=run, name='job-events', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,324 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+from database import get_db_connection, db_transaction
+from metrics import METRICS_TRACE, timed, set_trace_id, traceId
+
+
+# Job states
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOB_POLL_INTERVAL = 1.0  # seconds an idle worker sleeps before looking for a new job
+MAX_JOB_ATTEMPTS = 3     # a job interrupted more often than this (e.g. it keeps crashing the worker) is marked as failed
+
+# A claimed job is leased to its worker, which renews the lease while it runs the job. A job whose lease ran out
+# (the worker crashed or hangs, on this or another server sharing the database) is queued again by any worker.
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 60))
+JOB_HEARTBEAT_INTERVAL = JOB_LEASE_SECONDS / 4
+
+
+def row_to_job(row):
+    if not row:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+### CREATE
+
+def enqueue_job(job_type, payload, priority=0, dedup_key=None):
+    # With a dedup_key, a request for work that is already queued or running joins the existing job
+    # (raising its priority if needed). During a request the job is committed together with the request's changes.
+    with db_transaction() as conn:
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')  # take the write lock before the dedup check
+        if dedup_key:
+            row = conn.execute('SELECT job_id FROM jobs WHERE dedup_key = ? AND status IN (?, ?) ORDER BY job_id DESC LIMIT 1',
+                               (dedup_key, JOB_QUEUED, JOB_RUNNING)).fetchone()
+            if row:
+                conn.execute('UPDATE jobs SET priority = MAX(priority, ?) WHERE job_id = ? AND status = ?',
+                             (priority, row['job_id'], JOB_QUEUED))
+                return row['job_id']
+
+        cur = conn.execute('INSERT INTO jobs (job_type, payload, priority, status, dedup_key, song_version_id) VALUES (?,?,?,?,?,?)',
+                           (job_type, json.dumps(payload), priority, JOB_QUEUED, dedup_key, payload.get('song_version_id')))
+        job_id = cur.lastrowid
+    print(f"[enqueue_job]: Queued {job_type} job {job_id}")
+    return job_id
+
+
+### READ
+
+def get_job(job_id):
+    with db_transaction() as conn:
+        row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    return row_to_job(row)
+
+
+def get_latest_job(dedup_key):
+    with db_transaction() as conn:
+        row = conn.execute('SELECT * FROM jobs WHERE dedup_key = ? ORDER BY job_id DESC LIMIT 1', (dedup_key,)).fetchone()
+    return row_to_job(row)
+
+
+def get_queue_depths():
+    # [{job_type, status, jobs, oldest_age}] of the queued and running jobs, oldest_age in seconds since creation
+    with db_transaction() as conn:
+        rows = conn.execute('''
+            SELECT job_type, status, COUNT(*) AS jobs,
+                   (julianday('now') - julianday(MIN(created_at))) * 86400 AS oldest_age FROM jobs
+            WHERE status IN ('queued', 'running') GROUP BY job_type, status
+        ''').fetchall()
+    return [dict(row) for row in rows]
+
+
+### UPDATE
+
+def claim_jobs(job_types, worker_id, limit=1, lease_seconds=JOB_LEASE_SECONDS):
+    placeholders = ', '.join(['?'] * len(job_types))
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # BEGIN IMMEDIATE takes the write lock before the SELECT, so two workers can never claim the same job
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute(f'''
+            SELECT * FROM jobs
+            WHERE status = ? AND job_type IN ({placeholders})
+            ORDER BY priority DESC, job_id
+            LIMIT ?
+        ''', [JOB_QUEUED, *job_types, limit])
+        rows = cur.fetchall()
+        if not rows:
+            conn.rollback()
+            return []
+
+        cur.executemany('''
+            UPDATE jobs
+            SET status = ?, worker_id = ?, attempts = attempts + 1, started_at = CURRENT_TIMESTAMP, lease_expires_at = ?,
+                stage = NULL, progress_done = NULL, progress_total = NULL
+            WHERE job_id = ?
+        ''', [(JOB_RUNNING, worker_id, time.time() + lease_seconds, row['job_id']) for row in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()  # e.g. SQLITE_BUSY: release the write lock right away, other workers are waiting for it
+        raise
+    finally:
+        conn.close()
+    return [row_to_job(row) for row in rows]
+
+
+def claim_next_job(job_types, worker_id):
+    jobs = claim_jobs(job_types, worker_id, limit=1)
+    return jobs[0] if jobs else None
+
+
+def update_job_progress(job_id, progress_done, progress_total=None, stage=None):
+    # Unchanged progress is not written, so it does not show up as a new event (see job_events.py)
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE jobs SET progress_done = ?, progress_total = COALESCE(?, progress_total), stage = COALESCE(?, stage)
+        WHERE job_id = ? AND (progress_done IS NOT ? OR progress_total IS NOT COALESCE(?, progress_total)
+                              OR stage IS NOT COALESCE(?, stage))
+    ''', (progress_done, progress_total, stage, job_id, progress_done, progress_total, stage))
+    conn.commit()
+    conn.close()
+
+
+def set_job_stage(job_id, stage, progress_total=None):
+    # Start the next stage of a running job, its progress starts from 0
+    conn = get_db_connection()
+    conn.execute('UPDATE jobs SET stage = ?, progress_done = ?, progress_total = ? WHERE job_id = ?',
+                 (stage, 0 if progress_total else None, progress_total, job_id))
+    conn.commit()
+    conn.close()
+
+
+def renew_job_leases(job_ids, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    # Heartbeat of a worker: extends the leases it still holds, returns the ids of the jobs it lost
+    placeholders = ', '.join(['?'] * len(job_ids))
+    conn = get_db_connection()
+    conn.execute(f'''
+        UPDATE jobs SET lease_expires_at = ?
+        WHERE job_id IN ({placeholders}) AND worker_id = ? AND status = ?
+    ''', [time.time() + lease_seconds, *job_ids, worker_id, JOB_RUNNING])
+    rows = conn.execute(f'''
+        SELECT job_id FROM jobs WHERE job_id IN ({placeholders}) AND (worker_id IS NOT ? OR status != ?)
+    ''', [*job_ids, worker_id, JOB_RUNNING]).fetchall()
+    conn.commit()
+    conn.close()
+    return [row['job_id'] for row in rows]
+
+
+def complete_job(job_id, status, result, error, worker_id):
+    # Only the worker holding the lease may complete a job: one that lost it (the job was queued again) is ignored.
+    # A job creating a song version (a transcription) gets its song_version_id from the result.
+    conn = get_db_connection()
+    cur = conn.execute('''
+        UPDATE jobs SET status = ?, result = ?, error = ?, lease_expires_at = NULL, finished_at = CURRENT_TIMESTAMP,
+                        song_version_id = COALESCE(song_version_id, json_extract(?, '$.song_version_id'))
+        WHERE job_id = ? AND (? IS NULL OR (worker_id = ? AND status = ?))
+    ''', (status, result, error, result, job_id, worker_id, worker_id, JOB_RUNNING))
+    conn.commit()
+    conn.close()
+    if not cur.rowcount:
+        print(f"[complete_job]: Job {job_id} is no longer leased to {worker_id}, {status} result dropped")
+    return cur.rowcount > 0
+
+
+def finish_job(job_id, result=None, worker_id=None):
+    return complete_job(job_id, JOB_DONE, json.dumps(result), None, worker_id)
+
+
+def fail_job(job_id, error, worker_id=None):
+    return complete_job(job_id, JOB_FAILED, None, error, worker_id)
+
+
+def requeue_expired_jobs():
+    # Running jobs whose lease ran out were interrupted (crash, restart, hanging worker) - run them again
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute('''
+            UPDATE jobs SET status = ?, error = ?, lease_expires_at = NULL, finished_at = CURRENT_TIMESTAMP
+            WHERE status = ? AND COALESCE(lease_expires_at, 0) < ? AND attempts >= ?
+        ''', (JOB_FAILED, 'Interrupted too many times', JOB_RUNNING, now, MAX_JOB_ATTEMPTS))
+        failed_count = cur.rowcount
+        cur.execute('''
+            UPDATE jobs SET status = ?, worker_id = NULL, started_at = NULL, lease_expires_at = NULL
+            WHERE status = ? AND COALESCE(lease_expires_at, 0) < ?
+        ''', (JOB_QUEUED, JOB_RUNNING, now))
+        requeued_count = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()  # do not keep the write lock
+        raise
+    finally:
+        conn.close()
+    if failed_count or requeued_count:
+        print(f"[requeue_expired_jobs]: Requeued {requeued_count} job(s), failed {failed_count} job(s)")
+
+
+######################################################## Workers ########################################################
+
+class JobHeartbeat:
+    # Renews the leases of the jobs a worker runs every JOB_HEARTBEAT_INTERVAL, from a thread of its own
+
+    def __init__(self, job_ids, worker_id):
+        self.job_ids = job_ids
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"heartbeat-{worker_id}", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                lost = renew_job_leases(self.job_ids, self.worker_id)
+            except Exception as e:  # e.g. database locked - the lease has some time left
+                print(f"[JobHeartbeat]: Worker {self.worker_id} could not renew its leases: {e}")
+                continue
+            if lost:
+                print(f"[JobHeartbeat]: Worker {self.worker_id} lost the lease of job(s) {lost}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_job(job, handlers, worker_id=None):
+    handler = handlers[job['job_type']]
+    token = set_trace_id(f"job-{job['job_id']}") if METRICS_TRACE else None
+    try:
+        with timed('job', job_type=job['job_type']):
+            result = handler(job['job_id'], **job['payload'])
+        if finish_job(job['job_id'], result, worker_id):
+            print(f"[run_job]: {job['job_type']} job {job['job_id']} done")
+    except Exception as e:
+        traceback.print_exc()
+        if fail_job(job['job_id'], str(e), worker_id):
+            print(f"[run_job]: {job['job_type']} job {job['job_id']} failed: {e}")
+    finally:
+        if token:
+            traceId.reset(token)
+
+
+def run_job_batch(jobs, handlers, worker_id=None):
+    # Batch handlers get all claimed jobs at once and return one result (or exception) per job
+    handler = handlers[jobs[0]['job_type']]
+    try:
+        with timed('job', job_type=jobs[0]['job_type']):
+            results = handler(jobs)
+    except Exception as e:
+        traceback.print_exc()
+        results = [e] * len(jobs)
+
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            if fail_job(job['job_id'], str(result), worker_id):
+                print(f"[run_job_batch]: {job['job_type']} job {job['job_id']} failed: {result}")
+        elif finish_job(job['job_id'], result, worker_id):
+            print(f"[run_job_batch]: {job['job_type']} job {job['job_id']} done")
+
+
+def worker_loop(worker_name, handlers, batch_size=1, initializer=None, batch_handlers=None):
+    batch_handlers = batch_handlers or {}
+    job_types = list(handlers) + list(batch_handlers)
+    # Unique across processes and servers sharing the database, so a lease names exactly one worker
+    worker_id = f"{worker_name}@{socket.gethostname()}:{os.getpid()}"
+    if initializer:
+        initializer()  # e.g. load a model once for the whole lifetime of the worker
+    print(f"[worker_loop]: Worker {worker_id} waiting for {job_types} jobs")
+    next_expiry_check = 0.0
+    while True:
+        try:
+            if time.monotonic() >= next_expiry_check:
+                requeue_expired_jobs()
+                next_expiry_check = time.monotonic() + JOB_LEASE_SECONDS / 2
+            jobs = claim_jobs(job_types, worker_id, limit=batch_size)
+        except Exception as e:  # e.g. database locked for longer than DB_TIMEOUT - try again later
+            print(f"[worker_loop]: Worker {worker_id} could not claim a job: {e}")
+            jobs = []
+
+        if not jobs:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        with JobHeartbeat([job['job_id'] for job in jobs], worker_id):
+            for job_type in dict.fromkeys(job['job_type'] for job in jobs):
+                same_type = [job for job in jobs if job['job_type'] == job_type]
+                if job_type in batch_handlers:
+                    run_job_batch(same_type, batch_handlers, worker_id)
+                else:
+                    for job in same_type:
+                        run_job(job, handlers, worker_id)
+
+
+def start_worker_pool(pool_name, handlers, size, batch_size=1, initializer=None, batch_handlers=None):
+    """Start `size` worker processes executing jobs of the types in `handlers` and `batch_handlers`.
+
+    Handlers are called as handler(job_id, **payload), batch handlers as handler(jobs) with up to batch_size jobs
+    (also with one job, e.g. batch_size=1).
+    """
+    workers = []
+    for i in range(size):
+        worker_name = f"{pool_name}-{i}"
+        p = multiprocessing.Process(target=worker_loop, args=(worker_name, handlers, batch_size, initializer, batch_handlers),
+                                    name=worker_name, daemon=True)
+        p.start()
+        workers.append(p)
+    print(f"[start_worker_pool]: Started {size} {pool_name} worker(s)")
+    return workers
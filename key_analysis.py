@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pretty_midi
+from music21 import instrument as m21instrument
+
+from metrics import timed
+
+
+SECTION_SECONDS = float(os.environ.get('KEY_SECTION_SECONDS', 30))  # length of the windows of estimate_section_keys
+
+# Key profiles (major, minor) from https://extras.humdrum.org/man/keycor/, the same values music21 uses.
+# 'aarden' is what music21's score.analyze('key') runs.
+KEY_PROFILES = {
+    'aarden': ([17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587, 0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122],
+               [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362, 0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623]),
+    'krumhansl': ([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+                  [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]),
+    'temperley': ([0.748, 0.060, 0.488, 0.082, 0.670, 0.460, 0.096, 0.715, 0.104, 0.366, 0.057, 0.400],
+                  [0.712, 0.084, 0.474, 0.618, 0.049, 0.460, 0.105, 0.747, 0.404, 0.067, 0.133, 0.330]),
+    'bellman': ([16.80, 0.86, 12.95, 1.41, 13.49, 11.93, 1.25, 20.28, 1.80, 8.04, 0.62, 10.57],
+                [18.16, 0.69, 12.99, 13.34, 1.07, 11.15, 1.38, 21.07, 7.49, 1.53, 0.92, 10.21]),
+}
+DEFAULT_KEY_PROFILE = 'aarden'
+
+# Tonic names as music21 spells them (Pitch(pc).name, flipped to the enharmonic music21 accepts for the mode)
+MAJOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'A-', 'A', 'B-', 'B']
+MINOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+KEY_MODES = ('major', 'minor')
+
+
+def key_profile_matrix(profile=DEFAULT_KEY_PROFILE):
+    # (24, 12): row k is the profile rotated to tonic k % 12, major keys first
+    major, minor = KEY_PROFILES[profile]
+    rotations = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12  # [tonic, pitch class] -> profile index
+    return np.concatenate([np.asarray(major)[rotations], np.asarray(minor)[rotations]])
+
+
+def read_midi_notes(midi_data):
+    """Flat (pitches, starts, ends) arrays of all pitched notes of a PrettyMIDI object or midi file."""
+    if not isinstance(midi_data, pretty_midi.PrettyMIDI):
+        midi_data = pretty_midi.PrettyMIDI(midi_data)
+    notes = [(n.pitch, n.start, n.end) for inst in midi_data.instruments if not inst.is_drum for n in inst.notes]
+    if not notes:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    notes = np.asarray(notes, dtype=np.float64)
+    return notes[:, 0].astype(np.int64), notes[:, 1], notes[:, 2]
+
+
+def pitch_class_histograms(pitches, starts, ends, section_seconds=None):
+    """Duration weighted pitch class histograms, shape (12,) or (n_sections, 12) with section_seconds.
+
+    Notes crossing a section boundary count in both sections with the part they spend in each.
+    """
+    durations = np.maximum(ends - starts, 0.0)
+    pitch_classes = pitches % 12
+    if section_seconds is None:
+        return np.bincount(pitch_classes, weights=durations, minlength=12)
+
+    first = (starts // section_seconds).astype(np.int64)
+    last = np.maximum((np.maximum(ends, starts) // section_seconds).astype(np.int64), first)
+    spans = last - first + 1
+    note_index = np.repeat(np.arange(len(pitches)), spans)
+    section = first[note_index] + np.arange(len(note_index)) - np.repeat(np.cumsum(spans) - spans, spans)
+    overlap = (np.minimum(ends[note_index], (section + 1) * section_seconds)
+               - np.maximum(starts[note_index], section * section_seconds))
+    n_sections = int(last.max()) + 1 if len(last) else 0
+    return np.bincount(section * 12 + pitch_classes[note_index], weights=np.maximum(overlap, 0.0),
+                       minlength=n_sections * 12).reshape(n_sections, 12)
+
+
+def correlate_keys(histograms, profile=DEFAULT_KEY_PROFILE):
+    # Pearson correlation of every histogram with all 24 rotated profiles, shape (..., 24)
+    profiles = key_profile_matrix(profile)
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    histograms = np.asarray(histograms, dtype=np.float64)
+    centered = histograms - histograms.mean(axis=-1, keepdims=True)
+    numerator = centered @ profiles.T
+    denominator = np.linalg.norm(centered, axis=-1, keepdims=True) * np.linalg.norm(profiles, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, numerator / denominator, 0.0)
+
+
+def key_from_index(index):
+    mode = KEY_MODES[index // 12]
+    tonic = (MAJOR_TONICS if mode == 'major' else MINOR_TONICS)[index % 12]
+    return tonic, mode
+
+
+def estimate_key(pitches, starts, ends, profile=DEFAULT_KEY_PROFILE):
+    """(key_root, key_mode, correlation) of the whole piece, or (None, None, 0.0) without notes.
+
+    Same choice as music21's score.analyze('key') with the same profile: the best correlating of the 24 keys.
+    """
+    if not len(pitches):
+        return None, None, 0.0
+    correlations = correlate_keys(pitch_class_histograms(pitches, starts, ends), profile)
+    best = int(np.argmax(correlations))
+    return (*key_from_index(best), float(correlations[best]))
+
+
+def estimate_section_keys(pitches, starts, ends, section_seconds=SECTION_SECONDS, profile=DEFAULT_KEY_PROFILE):
+    # [{'start', 'end', 'key_root', 'key_mode', 'correlation'}] for consecutive windows, empty windows are skipped
+    if not len(pitches):
+        return []
+    histograms = pitch_class_histograms(pitches, starts, ends, section_seconds)
+    correlations = correlate_keys(histograms, profile)
+    best = np.argmax(correlations, axis=1)
+    sections = []
+    for i, index in enumerate(best):
+        if not histograms[i].any():
+            continue
+        key_root, key_mode = key_from_index(int(index))
+        sections.append({'start': i * section_seconds, 'end': min((i + 1) * section_seconds, float(ends.max())),
+                         'key_root': key_root, 'key_mode': key_mode, 'correlation': float(correlations[i, index])})
+    return sections
+
+
+def instrument_name(midi_data):
+    # Like get_instrument on a parsed score: the track name, otherwise music21's name for the midi program
+    for inst in midi_data.instruments:
+        if inst.is_drum:
+            continue
+        if inst.name:
+            return inst.name
+        try:
+            return m21instrument.instrumentFromMidiProgram(inst.program).instrumentName
+        except m21instrument.InstrumentException:
+            continue
+    return 'Unknown'
+
+
+@timed('key_analysis')
+def analyze_midi(midi_data, profile=DEFAULT_KEY_PROFILE, section_seconds=SECTION_SECONDS):
+    """Key, instrument and per-section keys of a PrettyMIDI object or midi file without building a music21 score."""
+    if not isinstance(midi_data, pretty_midi.PrettyMIDI):
+        midi_data = pretty_midi.PrettyMIDI(midi_data)
+    pitches, starts, ends = read_midi_notes(midi_data)
+    key_root, key_mode, correlation = estimate_key(pitches, starts, ends, profile)
+    return {
+        'key_root': key_root,
+        'key_mode': key_mode,
+        'correlation': correlation,
+        'instrument': instrument_name(midi_data),
+        'sections': estimate_section_keys(pitches, starts, ends, section_seconds, profile),
+    }
@@ -0,0 +1,292 @@
+import atexit
+import contextvars
+import functools
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+from database import get_db_connection, has_tables
+
+
+METRICS_PREFIX = 'piano_'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds between two writes of a process
+METRICS_STALE_SECONDS = 3 * METRICS_FLUSH_INTERVAL  # gauges of a process that stopped flushing (it exited) are ignored
+METRICS_TRACE = os.environ.get('METRICS_TRACE', '0') == '1'  # trace id per request / job, timed stages are logged with it
+
+# Upper bounds (seconds) of the histogram buckets, from a DB helper (ms) to a video render (minutes)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Every process (web worker, job worker, model subprocess) collects its observations in memory and adds them to the
+# metric_samples table every METRICS_FLUSH_INTERVAL, so /metrics shows the sum over all processes. In-flight gauges are
+# written per process to metric_gauges and summed over the processes that are still flushing.
+histograms = {}  # (name, labels json) -> [bucket counts..., +Inf count, sum] observed since the last flush
+gauges = {}      # (name, labels json) -> current value in this process
+metricsLock = threading.Lock()
+metricsPid = None
+processName = f"{socket.gethostname()}:{os.getpid()}"
+
+traceId = contextvars.ContextVar('traceId', default=None)
+
+
+def labels_key(labels):
+    return json.dumps(labels, sort_keys=True)
+
+
+def ensure_flusher():
+    # One flush thread per process; a forked worker starts its own and does not flush what its parent observed
+    global metricsPid, processName
+    if metricsPid == os.getpid():
+        return
+    with metricsLock:
+        if metricsPid == os.getpid():
+            return
+        histograms.clear()
+        gauges.clear()
+        metricsPid = os.getpid()
+        processName = f"{socket.gethostname()}:{os.getpid()}"
+    threading.Thread(target=flush_loop, name='metrics-flush', daemon=True).start()
+
+
+def observe(name, value, labels=None):
+    ensure_flusher()
+    key = (name, labels_key(labels or {}))
+    with metricsLock:
+        entry = histograms.get(key)
+        if entry is None:
+            entry = histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                entry[i] += 1
+                break
+        else:
+            entry[len(DURATION_BUCKETS)] += 1
+        entry[-1] += value
+
+
+def add_gauge(name, delta, labels=None):
+    ensure_flusher()
+    key = (name, labels_key(labels or {}))
+    with metricsLock:
+        gauges[key] = gauges.get(key, 0) + delta
+
+
+def get_trace_id():
+    return traceId.get()
+
+
+def set_trace_id(trace_id=None):
+    # A new id unless one is given (e.g. the client's X-Trace-Id); returns the token to reset it
+    return traceId.set(trace_id or uuid.uuid4().hex[:16])
+
+
+class StageTimer:
+    # See timed()
+
+    def __init__(self, stage, labels):
+        self.labels = dict(labels, stage=stage)
+        self.starts = threading.local()
+
+    def __enter__(self):
+        add_gauge('stage_in_flight', 1, self.labels)
+        self.starts.__dict__.setdefault('stack', []).append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.starts.stack.pop()
+        add_gauge('stage_in_flight', -1, self.labels)
+        labels = dict(self.labels, outcome='error' if exc_type else 'ok')
+        observe('stage_duration_seconds', seconds, labels)
+        trace_id = get_trace_id()
+        if trace_id and self.labels['stage'] != 'db':
+            extra = ''.join(f" {k}={v}" for k, v in self.labels.items() if k != 'stage')
+            print(f"[timed]: trace={trace_id} stage={self.labels['stage']}{extra} {labels['outcome']} {seconds:.3f}s")
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def timed(stage, **labels):
+    """Time a pipeline stage, as a context manager or a decorator:
+
+        with timed('musicxml_export'): ...
+        @timed('key_analysis')
+
+    The duration goes to the stage_duration_seconds histogram, the stage counts as in flight meanwhile. Keyword
+    arguments are labels (e.g. model='transkun').
+    """
+    return StageTimer(stage, labels)
+
+
+def db_helper(func):
+    # Times a database helper as the 'db' stage, labelled with its name
+    return timed('db', helper=func.__name__)(func)
+
+
+### Requests
+
+def start_request():
+    g.request_start = time.perf_counter()
+    add_gauge('http_requests_in_flight', 1)
+    trace_id = request.headers.get('X-Trace-Id')
+    if trace_id or METRICS_TRACE:
+        g.trace_token = set_trace_id(trace_id[:64] if trace_id else None)
+
+
+def tag_response(response):
+    g.response_status = response.status_code
+    if get_trace_id():
+        response.headers['X-Trace-Id'] = get_trace_id()
+    return response
+
+
+def finish_request(exception=None):
+    # teardown_request: also runs for requests that failed with an exception (500)
+    if 'request_start' not in g:
+        return
+    add_gauge('http_requests_in_flight', -1)
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe('http_request_duration_seconds', time.perf_counter() - g.request_start,
+            {'method': request.method, 'endpoint': endpoint, 'status': str(g.get('response_status', 500))})
+    if 'trace_token' in g:
+        traceId.reset(g.trace_token)
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(tag_response)
+    app.teardown_request(finish_request)
+
+
+### Storage
+
+def flush_metrics():
+    if not has_tables('metric_samples', 'metric_gauges'):
+        return  # no database (yet): e.g. a tool run elsewhere, the observations stay for a later flush
+    with metricsLock:
+        observed = list(histograms.items())
+        histograms.clear()
+        current = list(gauges.items())
+    if not observed and not current:
+        return
+
+    rows = []
+    for (name, labels), entry in observed:
+        cumulative = 0
+        for bound, count in zip((*DURATION_BUCKETS, '+Inf'), entry[:-1]):
+            cumulative += count
+            if cumulative:
+                rows.append((name, labels, str(bound), cumulative))
+        rows.append((name, labels, 'count', cumulative))
+        rows.append((name, labels, 'sum', entry[-1]))
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        conn.executemany('''
+            INSERT INTO metric_samples (name, labels, le, value) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name, labels, le) DO UPDATE SET value = value + excluded.value
+        ''', rows)
+        conn.executemany('''
+            INSERT INTO metric_gauges (name, labels, process, value, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(name, labels, process) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        ''', [(name, labels, processName, value, now) for (name, labels), value in current])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        with metricsLock:  # keep the observations for the next flush
+            for key, entry in observed:
+                merged = histograms.setdefault(key, [0] * len(entry))
+                for i, value in enumerate(entry):
+                    merged[i] += value
+        raise
+    finally:
+        conn.close()
+
+
+def flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except Exception as e:  # e.g. database locked - the next flush writes them
+            print(f"[flush_loop]: Could not write the metrics: {e}")
+
+
+@atexit.register
+def flush_at_exit():
+    # Short-lived processes (e.g. the model processes of an ensemble) exit before their first flush
+    if metricsPid == os.getpid():
+        try:
+            flush_metrics()
+        except Exception as e:
+            print(f"[flush_at_exit]: Could not write the metrics: {e}")
+
+
+### Exposition
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    parts = []
+    for k, v in sorted(labels.items()):
+        value = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def render_metrics(extra_series=()):
+    """All metrics in the Prometheus text format.
+
+    `extra_series` are (name, type, help, [(labels, value)]) read at scrape time, e.g. queue depths.
+    """
+    flush_metrics()  # this process' latest observations
+    conn = get_db_connection()
+    try:
+        samples = conn.execute('SELECT name, labels, le, value FROM metric_samples ORDER BY name, labels').fetchall()
+        live_gauges = conn.execute('''
+            SELECT name, labels, SUM(value) AS value FROM metric_gauges WHERE updated_at >= ?
+            GROUP BY name, labels ORDER BY name, labels
+        ''', (time.time() - METRICS_STALE_SECONDS,)).fetchall()
+        conn.execute('DELETE FROM metric_gauges WHERE updated_at < ?', (time.time() - 10 * METRICS_STALE_SECONDS,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    lines = []
+    series = {}
+    for row in samples:
+        series.setdefault(row['name'], {}).setdefault(row['labels'], {})[row['le']] = row['value']
+    for name, by_labels in series.items():
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# TYPE {full_name} histogram")
+        for labels, values in by_labels.items():
+            labels = json.loads(labels)
+            cumulative = 0
+            for bound in (*DURATION_BUCKETS, '+Inf'):
+                cumulative = max(cumulative, values.get(str(bound), 0))
+                lines.append(f"{full_name}_bucket{format_labels(labels, le=bound)} {cumulative:g}")
+            lines.append(f"{full_name}_sum{format_labels(labels)} {values.get('sum', 0):.6f}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {values.get('count', 0):g}")
+
+    gauge_series = {}
+    for row in live_gauges:
+        gauge_series.setdefault(row['name'], []).append((json.loads(row['labels']), row['value']))
+    for name, values in gauge_series.items():
+        lines.append(f"# TYPE {METRICS_PREFIX}{name} gauge")
+        lines += [f"{METRICS_PREFIX}{name}{format_labels(labels)} {value:g}" for labels, value in values]
+
+    for name, metric_type, help_text, values in extra_series:
+        lines.append(f"# HELP {METRICS_PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {METRICS_PREFIX}{name} {metric_type}")
+        lines += [f"{METRICS_PREFIX}{name}{format_labels(labels)} {value:g}" for labels, value in values]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+import hashlib
+import os
+
+from metrics import timed
+
+
+TRANSPOSITION_FOLDER = 'transpositions'
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']  # as used by the frontend
+LETTER_PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+DRUM_CHANNEL = 9
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+POLY_AFTERTOUCH = 0xA0
+META_EVENT = 0xFF
+META_KEY_SIGNATURE = 0x59
+SYSEX_EVENTS = (0xF0, 0xF7)
+
+os.makedirs(TRANSPOSITION_FOLDER, exist_ok=True)
+
+
+def tonic_semitone(key_name):
+    # 'C', 'C#', 'E-' (music21), 'Eb', 'b' (music21 minor key) -> semitones above C of the same octave
+    semitone = LETTER_PITCH_CLASSES[key_name[0].upper()]
+    for accidental in key_name[1:]:
+        if accidental == '#':
+            semitone += 1
+        elif accidental in '-b':
+            semitone -= 1
+        else:
+            raise ValueError(f"Invalid key name: {key_name}")
+    return semitone
+
+
+def transpose_semitones(curr_key, new_key):
+    # Same as music21's Interval(curr_tonic, new_tonic) used before: both tonics in one octave, so -11..11
+    return tonic_semitone(new_key) - tonic_semitone(curr_key)
+
+
+def shift_note(note, semitones):
+    note += semitones
+    while note > 127:  # keep notes pushed out of the midi range, an octave lower / higher
+        note -= 12
+    while note < 0:
+        note += 12
+    return note
+
+
+def shift_key_signature(sharps_flats, semitones):
+    # Key signature meta event: sharps (>0) / flats (<0); the minor flag stays, the relative keys move together
+    major_pc = (sharps_flats * 7) % 12
+    new_major_pc = (major_pc + semitones) % 12
+    new_sharps_flats = (new_major_pc * 7) % 12  # 7 is its own inverse modulo 12
+    if new_sharps_flats > 6:
+        new_sharps_flats -= 12
+    return new_sharps_flats
+
+
+def read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def transpose_track(data, start, end, semitones):
+    # Walks the events of one MTrk chunk in place: note numbers of note on/off and polyphonic aftertouch
+    # are shifted, everything else (timing, velocities, controllers, meta events) is left untouched
+    pos = start
+    running_status = None
+    while pos < end:
+        _, pos = read_varlen(data, pos)  # delta time
+        status = data[pos]
+        if status == META_EVENT:
+            meta_type = data[pos + 1]
+            length, pos = read_varlen(data, pos + 2)
+            if meta_type == META_KEY_SIGNATURE and length == 2:
+                sharps_flats = data[pos] - 256 if data[pos] > 127 else data[pos]
+                data[pos] = shift_key_signature(sharps_flats, semitones) & 0xFF
+            pos += length
+            running_status = None
+            continue
+        if status in SYSEX_EVENTS:
+            length, pos = read_varlen(data, pos + 1)
+            pos += length
+            running_status = None
+            continue
+
+        if status & 0x80:
+            running_status = status
+            pos += 1
+        elif running_status is None:
+            raise ValueError("Invalid MIDI file: data byte without a status")
+        message_type = running_status & 0xF0
+        channel = running_status & 0x0F
+        if message_type in (NOTE_OFF, NOTE_ON, POLY_AFTERTOUCH) and channel != DRUM_CHANNEL:
+            data[pos] = shift_note(data[pos], semitones)
+        pos += 1 if message_type in (0xC0, 0xD0) else 2
+
+
+def transpose_midi_bytes(midi_bytes, semitones):
+    data = bytearray(midi_bytes)
+    if data[:4] != b'MThd':
+        raise ValueError("Not a standard MIDI file")
+    pos = 8 + int.from_bytes(data[4:8], 'big')
+    while pos + 8 <= len(data):
+        chunk_type = bytes(data[pos:pos + 4])
+        length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        pos += 8
+        if chunk_type == b'MTrk' and semitones:
+            transpose_track(data, pos, min(pos + length, len(data)), semitones)
+        pos += length
+    return bytes(data)
+
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def transposition_path(midi_hash, semitones):
+    return os.path.join(TRANSPOSITION_FOLDER, f"{midi_hash}_{semitones:+d}.mid")
+
+
+@timed('transposition')
+def transpose_midi_file(midi_path, semitones, output_path=None):
+    """Transpose a midi file by `semitones` in a single pass over its events (in place if no output_path).
+
+    Transpositions precomputed by precompute_transpositions are reused.
+    """
+    with open(midi_path, 'rb') as f:
+        midi_bytes = f.read()
+    cached_path = transposition_path(hashlib.sha256(midi_bytes).hexdigest(), semitones)
+    if os.path.exists(cached_path):
+        with open(cached_path, 'rb') as f:
+            transposed = f.read()
+    else:
+        transposed = transpose_midi_bytes(midi_bytes, semitones)
+    write_atomic(output_path or midi_path, transposed)
+
+
+@timed('transposition_precompute')
+def precompute_transpositions(midi_path, curr_key):
+    # Writes the midi file transposed to all 12 keys, returns {key name: path}
+    with open(midi_path, 'rb') as f:
+        midi_bytes = f.read()
+    midi_hash = hashlib.sha256(midi_bytes).hexdigest()
+    paths = {}
+    for new_key in KEY_NAMES:
+        semitones = transpose_semitones(curr_key, new_key)
+        path = transposition_path(midi_hash, semitones)
+        if not os.path.exists(path):
+            write_atomic(path, transpose_midi_bytes(midi_bytes, semitones))
+        paths[new_key] = path
+    return paths
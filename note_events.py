@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import os
+import struct
+import time
+
+import numpy as np
+import pretty_midi
+
+from database import increment_counter, get_counters
+from metrics import timed
+
+
+NOTE_EVENTS_FOLDER = 'note_events'
+NOTE_EVENTS_MAX_BYTES = int(os.environ.get('NOTE_EVENTS_MAX_BYTES', 64 * 1024 * 1024))
+NOTE_EVENTS_COMPRESSION_LEVEL = 9  # written once per midi file, read many times
+HAND_SPLIT_PITCH = 60  # notes from middle C up are played with the right hand
+
+# Packed note events of a midi file (little endian). Every array starts 4 byte aligned, so the browser can view
+# the response as typed arrays without copying or parsing anything:
+#   header  'NEV1', uint32 note count, uint32 duration (ms) of the whole piece, uint32 reserved
+#   uint32  onset (ms)     x count, sorted
+#   uint32  duration (ms)  x count
+#   uint8   pitch          x count
+#   uint8   velocity       x count
+#   uint8   hand           x count, 0 = left, 1 = right
+FORMAT_MAGIC = b'NEV1'
+HEADER = struct.Struct('<4sIII')
+
+os.makedirs(NOTE_EVENTS_FOLDER, exist_ok=True)
+
+
+def hash_midi(midi_path):
+    with open(midi_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def cache_path(midi_hash):
+    return os.path.join(NOTE_EVENTS_FOLDER, f"{midi_hash}_{FORMAT_MAGIC.decode()}.bin.gz")
+
+
+def pack_note_events(onset, duration, pitch, velocity, hand, total_ms):
+    count = len(onset)
+    parts = [HEADER.pack(FORMAT_MAGIC, count, total_ms, 0),
+             np.asarray(onset, dtype='<u4').tobytes(), np.asarray(duration, dtype='<u4').tobytes(),
+             np.asarray(pitch, dtype='u1').tobytes(), np.asarray(velocity, dtype='u1').tobytes(),
+             np.asarray(hand, dtype='u1').tobytes()]
+    parts.append(b'\0' * (-3 * count % 4))  # whole buffer a multiple of 4 bytes
+    return b''.join(parts)
+
+
+def unpack_note_events(data):
+    # (onset, duration, pitch, velocity, hand, total_ms) views of a packed buffer
+    magic, count, total_ms, _ = HEADER.unpack_from(data)
+    if magic != FORMAT_MAGIC:
+        raise ValueError("Not a packed note events buffer")
+    offset = HEADER.size
+    arrays = []
+    for dtype, size in (('<u4', 4), ('<u4', 4), ('u1', 1), ('u1', 1), ('u1', 1)):
+        arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+        offset += count * size
+    return (*arrays, total_ms)
+
+
+@timed('note_events')
+def extract_note_events(midi_path):
+    midi_data = pretty_midi.PrettyMIDI(midi_path)
+    notes = [n for instrument in midi_data.instruments if not instrument.is_drum for n in instrument.notes]
+    notes.sort(key=lambda n: (n.start, n.pitch))
+    onset = np.round([n.start * 1000 for n in notes]).astype(np.int64)
+    end = np.round([n.end * 1000 for n in notes]).astype(np.int64)
+    pitch = np.array([n.pitch for n in notes], dtype=np.uint8)
+    velocity = np.array([n.velocity for n in notes], dtype=np.uint8)
+    hand = (pitch >= HAND_SPLIT_PITCH).astype(np.uint8)
+    total_ms = int(end.max()) if len(notes) else 0
+    return pack_note_events(onset, np.maximum(end - onset, 1), pitch, velocity, hand, total_ms)
+
+
+def get_note_events(midi_path):
+    """(content hash, gzip compressed packed note events) of a midi file.
+
+    Built once per midi content and kept in NOTE_EVENTS_FOLDER, so a transposed file gets its own entry while
+    copies of a song version share one.
+    """
+    midi_hash = hash_midi(midi_path)
+    path = cache_path(midi_hash)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)  # mtime is the last access for evict_note_events
+        increment_counter('note_events_hits')
+        return midi_hash, data
+    except FileNotFoundError:
+        pass
+
+    increment_counter('note_events_misses')
+    start = time.perf_counter()
+    data = gzip.compress(extract_note_events(midi_path), NOTE_EVENTS_COMPRESSION_LEVEL)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    print(f"[get_note_events]: Packed {midi_path} in {time.perf_counter() - start:.3f}s ({len(data)} bytes)")
+    evict_note_events()
+    return midi_hash, data
+
+
+def note_events_window(data, start=None, end=None):
+    # Compressed packed events of the notes sounding between start and end (seconds)
+    onset, duration, pitch, velocity, hand, total_ms = unpack_note_events(gzip.decompress(data))
+    mask = np.ones(len(onset), dtype=bool)
+    if start is not None:
+        mask &= onset.astype(np.int64) + duration > start * 1000
+    if end is not None:
+        mask &= onset < end * 1000
+    packed = pack_note_events(onset[mask], duration[mask], pitch[mask], velocity[mask], hand[mask], total_ms)
+    return gzip.compress(packed, 1)
+
+
+def evict_note_events(max_bytes=NOTE_EVENTS_MAX_BYTES):
+    # Least recently used files go first until the folder fits into max_bytes
+    entries = []
+    for entry in os.scandir(NOTE_EVENTS_FOLDER):
+        if entry.name.endswith('.bin.gz'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+    if evicted:
+        increment_counter('note_events_evictions', evicted)
+        print(f"[evict_note_events]: Evicted {evicted} packed file(s)")
+
+
+def get_note_events_stats():
+    entries = [entry.stat().st_size for entry in os.scandir(NOTE_EVENTS_FOLDER) if entry.name.endswith('.bin.gz')]
+    counters = get_counters('note_events_')
+    hits = int(counters.get('note_events_hits', 0))
+    misses = int(counters.get('note_events_misses', 0))
+    return {
+        'entries': len(entries),
+        'size_bytes': sum(entries),
+        'max_bytes': NOTE_EVENTS_MAX_BYTES,
+        'hits': hits,
+        'misses': misses,
+        'evictions': int(counters.get('note_events_evictions', 0)),
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+    }
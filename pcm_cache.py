@@ -0,0 +1,146 @@
+import hashlib
+import os
+import struct
+import subprocess
+import threading
+
+import numpy as np
+
+from database import increment_counter, get_counters
+from metrics import timed
+
+
+PCM_CACHE_FOLDER = 'pcm_cache'
+PCM_CACHE_MAX_BYTES = int(os.environ.get('PCM_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # ~3 hours of audio at 44.1 kHz
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+# Decoded audio is kept as mono 32-bit float WAVE files with a fixed 44 byte header: the samples can be memory-mapped
+# straight into a numpy array, and the files are still ordinary wav files for external tools.
+WAV_HEADER_BYTES = 44
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+os.makedirs(PCM_CACHE_FOLDER, exist_ok=True)
+
+keyLocks = {}  # cache file -> lock, so concurrent requests in one process decode a file only once
+keyLocksGuard = threading.Lock()
+
+
+def source_key(audio_path):
+    # Path, mtime and size: a replaced file is decoded again
+    st = os.stat(audio_path)
+    identity = f"{os.path.abspath(audio_path)}:{st.st_mtime_ns}:{st.st_size}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def pcm_path(key, sample_rate):
+    return os.path.join(PCM_CACHE_FOLDER, f"{key}_{sample_rate}.wav")
+
+
+def get_key_lock(path):
+    with keyLocksGuard:
+        return keyLocks.setdefault(path, threading.Lock())
+
+
+def wav_header(n_bytes, sample_rate):
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + n_bytes, b'WAVE', b'fmt ', 16, WAVE_FORMAT_IEEE_FLOAT, 1,
+                       sample_rate, sample_rate * 4, 4, 32, b'data', n_bytes)
+
+
+@timed('pcm_decode')
+def decode_to_cache(audio_path, path, sample_rate):
+    # ffmpeg decodes and resamples, the samples are streamed into the file behind a header patched at the end
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    proc = subprocess.Popen(["ffmpeg", "-v", "quiet", "-i", audio_path, "-ac", "1", "-ar", str(sample_rate),
+                             "-f", "f32le", "-"], stdout=subprocess.PIPE)
+    n_bytes = 0
+    with open(tmp_path, 'wb') as f:
+        f.write(wav_header(0, sample_rate))
+        for chunk in iter(lambda: proc.stdout.read(DECODE_CHUNK_SIZE), b''):
+            f.write(chunk)
+            n_bytes += len(chunk)
+        f.seek(0)
+        f.write(wav_header(n_bytes, sample_rate))
+    proc.stdout.close()
+    if proc.wait() != 0:
+        os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg could not decode {audio_path}")
+    os.replace(tmp_path, path)
+
+
+def open_pcm(path, sample_rate):
+    # Read-only memory map of a cache file, None if it is missing or was not written completely
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(WAV_HEADER_BYTES)
+            n_bytes = os.fstat(f.fileno()).st_size - WAV_HEADER_BYTES
+    except FileNotFoundError:
+        return None
+    if header != wav_header(n_bytes, sample_rate):
+        return None
+    if n_bytes == 0:
+        return np.zeros(0, dtype=np.float32)  # an empty file can not be mapped
+    return np.memmap(path, dtype='<f4', mode='r', offset=WAV_HEADER_BYTES)
+
+
+def get_pcm(audio_path, sample_rate):
+    """Mono float32 samples of an audio file at `sample_rate`, memory-mapped from the cache (read-only).
+
+    Every file is decoded once per sample rate; afterwards all processes read the same pages from the OS page cache,
+    so a second model or a re-processed segment does not decode anything.
+    """
+    path = pcm_path(source_key(audio_path), sample_rate)
+    pcm = open_pcm(path, sample_rate)
+    if pcm is None:
+        with get_key_lock(path):
+            pcm = open_pcm(path, sample_rate)  # decoded while we were waiting for the lock
+            if pcm is None:
+                increment_counter('pcm_cache_misses')
+                decode_to_cache(audio_path, path, sample_rate)
+                print(f"[get_pcm]: Decoded {audio_path} at {sample_rate} Hz")
+                evict_pcm(keep=path)
+                return open_pcm(path, sample_rate)
+    increment_counter('pcm_cache_hits')
+    os.utime(path)  # mtime is the last access for evict_pcm
+    return pcm
+
+
+def evict_pcm(max_bytes=PCM_CACHE_MAX_BYTES, keep=None):
+    # Least recently used files go first until the folder fits into max_bytes. Files still mapped by a process stay
+    # readable for it until it lets go of them.
+    entries = []
+    for entry in os.scandir(PCM_CACHE_FOLDER):
+        if entry.name.endswith('.wav') and entry.path != keep:
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    if keep and os.path.exists(keep):
+        total_bytes += os.path.getsize(keep)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+    if evicted:
+        increment_counter('pcm_cache_evictions', evicted)
+        print(f"[evict_pcm]: Evicted {evicted} decoded file(s)")
+
+
+def get_pcm_cache_stats():
+    entries = [entry.stat().st_size for entry in os.scandir(PCM_CACHE_FOLDER) if entry.name.endswith('.wav')]
+    counters = get_counters('pcm_cache_')
+    hits = int(counters.get('pcm_cache_hits', 0))
+    misses = int(counters.get('pcm_cache_misses', 0))
+    return {
+        'entries': len(entries),
+        'size_bytes': sum(entries),
+        'max_bytes': PCM_CACHE_MAX_BYTES,
+        'hits': hits,
+        'misses': misses,
+        'evictions': int(counters.get('pcm_cache_evictions', 0)),
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+    }
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from importlib import metadata
+
+from music21 import converter, freezeThaw
+
+from database import increment_counter, get_counters
+from metrics import timed
+
+
+SCORE_CACHE_FOLDER = 'score_cache'
+SCORE_CACHE_MAX_BYTES = int(os.environ.get('SCORE_CACHE_MAX_BYTES', 128 * 1024 * 1024))            # per process, in memory
+SCORE_CACHE_MAX_DISK_BYTES = int(os.environ.get('SCORE_CACHE_MAX_DISK_BYTES', 512 * 1024 * 1024))  # shared by all processes
+SCORE_COMPRESSION_LEVEL = 1  # frozen scores are very repetitive, level 1 already shrinks them ~15x
+
+# Pickles are only valid for the music21 version that wrote them
+MUSIC21_VERSION = metadata.version('music21')
+
+os.makedirs(SCORE_CACHE_FOLDER, exist_ok=True)
+
+scores = OrderedDict()  # content hash -> compressed frozen score, least recently used first
+scoresBytes = 0
+scoresLock = threading.Lock()
+
+
+def hash_midi(midi_path):
+    with open(midi_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def disk_path(midi_hash):
+    return os.path.join(SCORE_CACHE_FOLDER, f"{midi_hash}_{MUSIC21_VERSION}.pkl.z")
+
+
+def freeze_score(score):
+    # fastButUnsafe skips the deep copy, the score must not be used afterwards
+    return zlib.compress(freezeThaw.StreamFreezer(score, fastButUnsafe=True).writeStr(fmt='pickle'), SCORE_COMPRESSION_LEVEL)
+
+
+def thaw_score(data):
+    thawer = freezeThaw.StreamThawer()
+    thawer.openStr(zlib.decompress(data))
+    return thawer.stream
+
+
+def remember(midi_hash, data):
+    global scoresBytes
+    with scoresLock:
+        if midi_hash in scores:
+            scores.move_to_end(midi_hash)
+            return
+        scores[midi_hash] = data
+        scoresBytes += len(data)
+        while scoresBytes > SCORE_CACHE_MAX_BYTES and len(scores) > 1:
+            _, evicted = scores.popitem(last=False)
+            scoresBytes -= len(evicted)
+
+
+def recall(midi_hash):
+    with scoresLock:
+        data = scores.get(midi_hash)
+        if data is not None:
+            scores.move_to_end(midi_hash)
+            return data
+
+    path = disk_path(midi_hash)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)  # mtime is the last access for evict_scores
+    except FileNotFoundError:
+        return None
+    remember(midi_hash, data)
+    return data
+
+
+def store(midi_hash, data):
+    remember(midi_hash, data)
+    tmp_path = f"{disk_path(midi_hash)}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, disk_path(midi_hash))
+    evict_scores()
+
+
+def get_score(midi_path):
+    """Parsed (and quantized) music21 score of a midi file.
+
+    Scores are cached by the content of the file, so a transposed or replaced midi file is parsed again while a
+    copy of an unchanged one is not. Every call returns a new copy the caller may modify.
+    """
+    midi_hash = hash_midi(midi_path)
+    data = recall(midi_hash)
+    if data is not None:
+        increment_counter('score_cache_hits')
+        return thaw_score(data)
+
+    increment_counter('score_cache_misses')
+    start = time.perf_counter()
+    with timed('midi_parse'):
+        data = freeze_score(converter.parse(midi_path))
+    store(midi_hash, data)
+    print(f"[get_score]: Parsed {midi_path} in {time.perf_counter() - start:.2f}s ({len(data)} bytes cached)")
+    return thaw_score(data)
+
+
+def evict_scores(max_bytes=SCORE_CACHE_MAX_DISK_BYTES):
+    # Least recently used files go first until the folder fits into max_bytes
+    entries = []
+    for entry in os.scandir(SCORE_CACHE_FOLDER):
+        if entry.name.endswith('.pkl.z'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+    if evicted:
+        increment_counter('score_cache_evictions', evicted)
+        print(f"[evict_scores]: Evicted {evicted} cached score(s)")
+
+
+def get_score_cache_stats():
+    counters = get_counters('score_cache_')
+    hits = int(counters.get('score_cache_hits', 0))
+    misses = int(counters.get('score_cache_misses', 0))
+    with scoresLock:
+        memory_entries = len(scores)
+        memory_bytes = scoresBytes
+    return {
+        'memory_entries': memory_entries,
+        'memory_bytes': memory_bytes,
+        'max_bytes': SCORE_CACHE_MAX_BYTES,
+        'max_disk_bytes': SCORE_CACHE_MAX_DISK_BYTES,
+        'hits': hits,
+        'misses': misses,
+        'evictions': int(counters.get('score_cache_evictions', 0)),
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+    }
@@ -0,0 +1,166 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pretty_midi
+
+from pcm_cache import get_pcm
+
+
+SEGMENT_SECONDS = float(os.environ.get('SEGMENT_SECONDS', 60))
+SEGMENT_OVERLAP_SECONDS = float(os.environ.get('SEGMENT_OVERLAP_SECONDS', 4))
+SEGMENT_PROCESSES = int(os.environ.get('SEGMENT_PROCESSES', os.cpu_count() or 2))  # segments transcribed at the same time
+SEGMENTED_MIN_DURATION = float(os.environ.get('SEGMENTED_MIN_DURATION', 5 * 60))  # longer recordings are split automatically
+SEGMENT_SAMPLE_RATE = 44100  # transkun's rate
+
+if not 0 <= SEGMENT_OVERLAP_SECONDS < SEGMENT_SECONDS:
+    # plan_segments advances by SEGMENT_SECONDS - SEGMENT_OVERLAP_SECONDS and would never reach the end
+    raise ValueError(f"SEGMENT_OVERLAP_SECONDS ({SEGMENT_OVERLAP_SECONDS:g}) must be at least 0 and less than "
+                     f"SEGMENT_SECONDS ({SEGMENT_SECONDS:g})")
+
+DUPLICATE_ONSET_TOLERANCE = 0.05  # notes of the same pitch starting closer than this (seconds) are one note
+TRUNCATED_NOTE_TOLERANCE = 0.05   # a note ending this close to the end of its segment was cut off by the window
+
+
+def plan_segments(duration):
+    # [(start, end)] windows of SEGMENT_SECONDS overlapping by SEGMENT_OVERLAP_SECONDS
+    step = SEGMENT_SECONDS - SEGMENT_OVERLAP_SECONDS
+    segments = []
+    start = 0.0
+    while True:
+        end = min(start + SEGMENT_SECONDS, duration)
+        segments.append((start, end))
+        if end >= duration:
+            return segments
+        start += step
+
+
+def write_wav(samples, wav_path, sample_rate):
+    # 16 bit mono wav of float samples, for tools that read files
+    with wave.open(wav_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+
+
+def transkun_segments(windows, midi_paths):
+    # transkun reads files: every window is written next to its midi file. Every transkun run is its own process,
+    # the threads only wait for them.
+    def run(paths):
+        subprocess.run(['transkun', paths[0], paths[1]], check=True)
+    wav_paths = [os.path.splitext(midi_path)[0] + '.wav' for midi_path in midi_paths]
+    for window, wav_path in zip(windows, wav_paths):
+        write_wav(window, wav_path, SEGMENT_SAMPLE_RATE)
+    try:
+        with ThreadPoolExecutor(max_workers=SEGMENT_PROCESSES) as executor:
+            list(executor.map(run, zip(wav_paths, midi_paths)))
+    finally:
+        for wav_path in wav_paths:
+            os.remove(wav_path)
+
+
+def read_segment(midi_path, offset):
+    midi_data = pretty_midi.PrettyMIDI(midi_path)
+    notes = []
+    control_changes = []
+    for instrument in midi_data.instruments:
+        if instrument.is_drum:
+            continue
+        notes.extend(pretty_midi.Note(n.velocity, n.pitch, n.start + offset, n.end + offset) for n in instrument.notes)
+        control_changes.extend(pretty_midi.ControlChange(cc.number, cc.value, cc.time + offset) for cc in instrument.control_changes)
+    notes.sort(key=lambda n: (n.start, n.pitch))
+    return notes, control_changes
+
+
+def merge_segments(segments, segment_notes, segment_control_changes):
+    """Merge per-window notes into one timeline.
+
+    Each window owns the time between the midpoints of its overlaps with the neighbours; a note is taken
+    from the window owning its onset. A note cut off at the end of its window is extended with the matching
+    note the next window sees: at its start for a held note, at the same onset for a note starting in the overlap.
+    """
+    half_overlap = SEGMENT_OVERLAP_SECONDS / 2
+    merged_notes = []
+    merged_control_changes = []
+    for i, (start, end) in enumerate(segments):
+        owned_start = start + half_overlap if i > 0 else float('-inf')
+        owned_end = end - half_overlap if i < len(segments) - 1 else float('inf')
+
+        for note in segment_notes[i]:
+            if not owned_start <= note.start < owned_end:
+                continue
+            if i < len(segments) - 1 and note.end >= end - TRUNCATED_NOTE_TOLERANCE:
+                next_start = segments[i + 1][0]
+                for continued in segment_notes[i + 1]:
+                    if continued.pitch != note.pitch:
+                        continue
+                    if (abs(continued.start - next_start) <= TRUNCATED_NOTE_TOLERANCE
+                            or abs(continued.start - note.start) <= TRUNCATED_NOTE_TOLERANCE):
+                        note.end = max(note.end, continued.end)
+                        break
+            merged_notes.append(note)
+
+        merged_control_changes.extend(cc for cc in segment_control_changes[i] if owned_start <= cc.time < owned_end)
+
+    # Drop duplicates the two windows may both have reported close to a boundary
+    merged_notes.sort(key=lambda n: (n.pitch, n.start))
+    deduplicated = []
+    for note in merged_notes:
+        previous = deduplicated[-1] if deduplicated else None
+        if previous and previous.pitch == note.pitch and note.start - previous.start < DUPLICATE_ONSET_TOLERANCE:
+            previous.end = max(previous.end, note.end)
+            previous.velocity = max(previous.velocity, note.velocity)
+            continue
+        deduplicated.append(note)
+    deduplicated.sort(key=lambda n: (n.start, n.pitch))
+    merged_control_changes.sort(key=lambda cc: cc.time)
+    return deduplicated, merged_control_changes
+
+
+def transcribe_segmented(audio_path, midi_path, duration, transcribe_segments, sample_rate=SEGMENT_SAMPLE_RATE,
+                         on_progress=None):
+    """Transcribe a long recording window by window and write one merged midi file to `midi_path`.
+
+    `transcribe_segments(windows, midi_paths)` runs the model on a group of windows (mono float32 samples at
+    `sample_rate`). The windows are slices of the memory-mapped PCM cache, so nothing is decoded per segment and
+    only the pages of the SEGMENT_PROCESSES windows in work are in memory at a time. on_progress(done, total) is
+    called with the number of transcribed segments after every group.
+    """
+    segments = plan_segments(duration)
+    print(f"[transcribe_segmented]: {audio_path} ({duration:.0f}s) split into {len(segments)} segment(s)")
+    pcm = get_pcm(audio_path, sample_rate)
+    work_dir = tempfile.mkdtemp(prefix='segments_')
+    segment_notes = []
+    segment_control_changes = []
+    try:
+        for group_start in range(0, len(segments), SEGMENT_PROCESSES):
+            group = list(range(group_start, min(group_start + SEGMENT_PROCESSES, len(segments))))
+            windows = [pcm[int(segments[i][0] * sample_rate):int(segments[i][1] * sample_rate)] for i in group]
+            midi_paths = [os.path.join(work_dir, f"segment_{i}.mid") for i in group]
+
+            transcribe_segments(windows, midi_paths)
+
+            for i, segment_midi_path in zip(group, midi_paths):
+                notes, control_changes = read_segment(segment_midi_path, segments[i][0])
+                segment_notes.append(notes)
+                segment_control_changes.append(control_changes)
+                os.remove(segment_midi_path)
+            if on_progress:
+                on_progress(len(segment_notes), len(segments))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    notes, control_changes = merge_segments(segments, segment_notes, segment_control_changes)
+    midi_data = pretty_midi.PrettyMIDI()
+    piano = pretty_midi.Instrument(program=0, name='Piano')
+    piano.notes = notes
+    piano.control_changes = control_changes
+    midi_data.instruments.append(piano)
+    midi_data.write(midi_path)
+    print(f"[transcribe_segmented]: Merged {len(notes)} note(s) into {midi_path}")
+    return midi_path
@@ -0,0 +1,261 @@
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from note_events import unpack_note_events
+
+
+# Takes scored at the same time per web process: every web worker (WEB_WORKERS) has a pool of its own
+SCORING_PROCESSES = int(os.environ.get('SCORING_PROCESSES', 2))
+SCORING_TIMEOUT = 60  # seconds a request waits for its score
+
+# Pitch tracking of recorded takes, the same method as the pitchy detector of the practice page: McLeod's
+# normalized square difference function, first key maximum above PEAK_THRESHOLD of the highest one
+TAKE_SAMPLE_RATE = 22050
+PITCH_FRAME = 2048
+PITCH_HOP = 512           # ~23 ms
+PITCH_CHUNK_FRAMES = 256  # frames analyzed at once, bounds the memory used for long takes
+PEAK_THRESHOLD = 0.9
+MIN_CLARITY = 0.8         # like the practice page
+MIN_RMS = 0.005           # quieter frames are silence
+MIN_FREQUENCY = 27.5      # A0
+MAX_FREQUENCY = 4186.0    # C8
+MIN_NOTE_SECONDS = 0.04   # a pitch has to be stable this long to be a played note
+
+# Alignment
+CHORD_TOLERANCE = 0.03    # notes of the version starting closer than this (seconds) are played at once
+BAND_FRACTION = 0.1       # DTW band radius, share of the longer sequence
+BAND_MIN = 32
+OCTAVE_ERROR_COST = 0.5   # right pitch class in another octave (a common pitch tracker error)
+TIMING_TOLERANCE = 0.1    # seconds off the (tempo corrected) version that still count as on time
+TIMING_OUTLIER = 0.5      # matches further off are left out of the tempo fit
+
+scoring_pool = None  # created on first use, see submit_take
+scoring_pool_lock = threading.Lock()
+
+
+def decode_take(path):
+    result = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-ac", "1", "-ar", str(TAKE_SAMPLE_RATE),
+                             "-f", "f32le", "-"], capture_output=True)
+    if result.returncode != 0:
+        message = result.stderr.decode(errors='replace').strip().splitlines()
+        raise ValueError(f"Not a supported audio file ({message[-1] if message else 'ffmpeg failed'})")
+    return np.frombuffer(result.stdout, dtype='<f4')
+
+
+def fft_size(n):
+    # Smallest 2^a * 3^b * 5^c >= n, pocketfft is fastest for these sizes
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def track_pitch(samples, sample_rate=TAKE_SAMPLE_RATE):
+    """(frame times, midi pitches) of a mono recording, NaN where no clear pitch was found."""
+    if len(samples) < PITCH_FRAME:
+        return np.zeros(0), np.zeros(0)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, PITCH_FRAME)[::PITCH_HOP]
+    lag_min = int(sample_rate / MAX_FREQUENCY)
+    n_lags = int(sample_rate / MIN_FREQUENCY) + 2
+    lags = np.arange(n_lags)
+    n_fft = fft_size(PITCH_FRAME + n_lags - 1)  # enough zero padding for the linear autocorrelation up to n_lags
+    pitches = np.full(len(frames), np.nan)
+
+    for start in range(0, len(frames), PITCH_CHUNK_FRAMES):
+        chunk = frames[start:start + PITCH_CHUNK_FRAMES].astype(np.float64)
+        spectrum = np.fft.rfft(chunk, n_fft)
+        acf = np.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, n_fft)[:, :n_lags]
+        squares = np.cumsum(chunk ** 2, axis=1)
+        # m(tau) = sum of x[j]^2 for j < W - tau plus for j >= tau
+        head = squares[:, PITCH_FRAME - 1 - lags]
+        tail = squares[:, -1:] - np.concatenate([np.zeros((len(chunk), 1)), squares[:, :n_lags - 1]], axis=1)
+        nsdf = 2 * acf / np.maximum(head + tail, 1e-12)
+
+        # Skip the lobe around lag 0, then take the first maximum reaching PEAK_THRESHOLD of the highest one
+        negative = nsdf < 0
+        first_negative = np.where(negative.any(axis=1), negative.argmax(axis=1), n_lags)
+        nsdf[lags < np.maximum(first_negative, lag_min)[:, None]] = -1
+        highest = nsdf.max(axis=1)
+        candidate = (nsdf >= PEAK_THRESHOLD * highest[:, None]).argmax(axis=1)
+        lobe_end = (negative & (lags > candidate[:, None])).argmax(axis=1)
+        lobe_end = np.where(lobe_end > candidate, lobe_end, n_lags)
+        lobe = (lags >= candidate[:, None]) & (lags < lobe_end[:, None])
+        peak = np.clip(np.where(lobe, nsdf, -np.inf).argmax(axis=1), 1, n_lags - 2)
+
+        rows = np.arange(len(chunk))
+        a, b, c = nsdf[rows, peak - 1], nsdf[rows, peak], nsdf[rows, peak + 1]
+        denominator = a - 2 * b + c
+        shift = np.where(denominator < 0, 0.5 * (a - c) / np.where(denominator < 0, denominator, 1), 0)
+        frequency = sample_rate / (peak + shift)
+        rms = np.sqrt(squares[:, -1] / PITCH_FRAME)
+        valid = (b >= MIN_CLARITY) & (highest > 0) & (rms >= MIN_RMS) & (frequency >= MIN_FREQUENCY)
+        pitches[start:start + len(chunk)] = np.where(valid, 69 + 12 * np.log2(frequency / 440), np.nan)
+
+    times = (np.arange(len(frames)) * PITCH_HOP + PITCH_FRAME / 2) / sample_rate
+    return times, pitches
+
+
+def frames_to_notes(times, pitches):
+    # Runs of frames with the same (rounded) pitch lasting MIN_NOTE_SECONDS are notes: (onsets, pitches)
+    times = np.asarray(times, dtype=np.float64)
+    pitches = np.asarray(pitches, dtype=np.float64)
+    if len(times) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    order = np.argsort(times, kind='stable')
+    times, pitches = times[order], pitches[order]
+    rounded = np.where(np.isfinite(pitches), np.round(pitches), -1)
+    change = np.flatnonzero(np.diff(rounded) != 0) + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [len(rounded)]]) - 1
+    keep = (rounded[starts] >= 0) & (rounded[starts] < 128) & (times[ends] - times[starts] >= MIN_NOTE_SECONDS)
+    return times[starts[keep]], rounded[starts[keep]].astype(np.int64)
+
+
+def reference_events(note_events):
+    # Notes of the version grouped into events (chords), as pitch / pitch class masks per event
+    onset_ms, _, pitch, _, _, _ = unpack_note_events(note_events)
+    onsets = onset_ms / 1000
+    new_event = np.concatenate([[True], np.diff(onsets) > CHORD_TOLERANCE])  # onsets are sorted
+    note_event = np.cumsum(new_event) - 1
+    has_pitch = np.zeros((int(new_event.sum()), 128), dtype=bool)
+    has_pitch[note_event, pitch] = True
+    has_class = np.zeros((len(has_pitch), 12), dtype=bool)
+    has_class[note_event, pitch % 12] = True
+    return onsets[new_event], has_pitch, has_class, note_event, onset_ms, pitch
+
+
+def align(has_pitch, has_class, take_pitch):
+    """Banded DTW of the version's events against the played notes, returns the path as (event, note) pairs.
+
+    Only a band around the diagonal is computed. Within a row, D[i, j] = c[i, j] + min(A[j], D[i, j - 1]) with
+    A[j] = min(D[i - 1, j - 1], D[i - 1, j]) is solved for the whole band at once:
+    D[i, j] = S[j] + min over k <= j of (A[k] - S[k - 1]), S being the running sum of the row's costs.
+    """
+    n, m = len(has_pitch), len(take_pitch)
+    radius = max(BAND_MIN, int(BAND_FRACTION * max(n, m)), -(-m // n) + 1)
+    width = 2 * radius + 1
+    lo = np.maximum(np.round(np.arange(n + 1) * m / n).astype(np.int64) - radius, 0)  # first column of every row
+    D = np.full((n + 1, width), np.inf, dtype=np.float32)
+    D[0, 0] = 0
+    take_class = take_pitch % 12
+
+    for i in range(1, n + 1):
+        j0, j1 = max(lo[i], 1), min(lo[i] + width, m + 1)
+        if j0 >= j1:
+            continue
+        k = np.arange(j0 - 1, j1) - lo[i - 1]  # columns j0 - 1 .. j1 - 1 in the previous row
+        previous = np.full(len(k), np.inf, dtype=np.float32)
+        inside = (k >= 0) & (k < width)
+        previous[inside] = D[i - 1, k[inside]]
+        best_previous = np.minimum(previous[:-1], previous[1:])
+
+        played = take_pitch[j0 - 1:j1 - 1]
+        cost = np.where(has_pitch[i - 1, played], 0, np.where(has_class[i - 1, take_class[j0 - 1:j1 - 1]],
+                                                              OCTAVE_ERROR_COST, 1)).astype(np.float32)
+        running = np.cumsum(cost)
+        D[i, j0 - lo[i]:j1 - lo[i]] = running + np.minimum.accumulate(best_previous - (running - cost))
+
+    def value(i, j):
+        k = j - lo[i]
+        return D[i, k] if 0 <= k < width else np.inf
+
+    if not np.isfinite(value(n, m)):
+        raise RuntimeError("The alignment left the band")
+    path = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        path.append((i - 1, j - 1))
+        # min keeps the first of equal candidates: the diagonal
+        _, i, j = min(((value(i - 1, j - 1), i - 1, j - 1), (value(i - 1, j), i - 1, j), (value(i, j - 1), i, j - 1)),
+                      key=lambda candidate: candidate[0])
+    path.reverse()
+    return np.array(path, dtype=np.int64).reshape(-1, 2)
+
+
+def score_take(note_events, take_path=None, times=None, pitches=None):
+    """Align a take to the notes of a version and score it.
+
+    The take is a recording (`take_path`) or the pitch frames detected while playing (`times` in seconds,
+    `pitches` as midi numbers, None / NaN for no pitch). Timing errors are measured after fitting the tempo and
+    start of the take to the version, so a slower take is not late on every note.
+    """
+    start = time.perf_counter()
+    if take_path:
+        times, pitches = track_pitch(decode_take(take_path))
+    elif times is None or pitches is None or len(times) != len(pitches):
+        raise ValueError("A take needs a recording or frames with as many times as pitches")
+    else:
+        pitches = [np.nan if p is None else p for p in pitches]
+    take_onsets, take_pitch = frames_to_notes(times, pitches)
+
+    event_onsets, has_pitch, has_class, note_event, onset_ms, pitch = reference_events(note_events)
+    n = len(event_onsets)
+    if n == 0:
+        raise ValueError("The version has no notes")
+
+    hit_pitch = np.zeros_like(has_pitch)  # pitches of every event that were played where the alignment put it
+    event_take_onset = np.full(n, np.nan)
+    if len(take_pitch):
+        path = align(has_pitch, has_class, take_pitch)
+        event, note = path[:, 0], path[:, 1]
+        hit = has_pitch[event, take_pitch[note]]
+        hit_pitch[event[hit], take_pitch[note[hit]]] = True
+        played_events, first = np.unique(event[hit], return_index=True)
+        event_take_onset[played_events] = take_onsets[note[hit][first]]
+        extra_notes = len(take_pitch) - len(np.unique(note[hit]))
+    else:
+        extra_notes = 0
+
+    # Tempo and start of the take: least squares fit of the correctly played events, without outliers
+    played = np.isfinite(event_take_onset)
+    tempo, offset = 1.0, float(np.median(event_take_onset[played] - event_onsets[played])) if played.any() else 0.0
+    if played.sum() >= 2 and np.ptp(event_onsets[played]) > 0:
+        tempo, offset = np.polyfit(event_onsets[played], event_take_onset[played], 1)
+        inliers = played & (np.abs(event_take_onset - (tempo * event_onsets + offset)) < TIMING_OUTLIER)
+        if inliers.sum() >= 2 and np.ptp(event_onsets[inliers]) > 0:
+            tempo, offset = np.polyfit(event_onsets[inliers], event_take_onset[inliers], 1)
+        if tempo <= 0:
+            tempo, offset = 1.0, float(np.median(event_take_onset[played] - event_onsets[played]))
+    timing_error = (event_take_onset - offset) / tempo - event_onsets  # in the version's time
+
+    note_correct = hit_pitch[note_event, pitch]
+    note_timing_ms = np.where(note_correct, timing_error[note_event] * 1000, np.nan)
+    played_errors = np.abs(timing_error[played])
+    return {
+        'events': n,
+        'notes': len(pitch),
+        'take_notes': len(take_pitch),
+        'event_accuracy': float(played.mean()),    # onsets (chords) played with a right pitch
+        'note_accuracy': float(note_correct.mean()),
+        'extra_notes': int(extra_notes),
+        'tempo_ratio': float(tempo),                # take seconds per version second
+        'offset_seconds': float(offset),            # where the version's start is in the take
+        'timing_mean_abs_ms': float(played_errors.mean() * 1000) if len(played_errors) else None,
+        'on_time_ratio': float((played_errors <= TIMING_TOLERANCE).mean()) if len(played_errors) else None,
+        'per_note': {
+            'onset_ms': onset_ms.tolist(),
+            'pitch': pitch.tolist(),
+            'correct': note_correct.tolist(),
+            'timing_error_ms': [None if np.isnan(e) else round(float(e)) for e in note_timing_ms],
+        },
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def submit_take(note_events, take_path=None, times=None, pitches=None):
+    # Scores are computed by a pool of processes, so takes of many users are scored in parallel
+    global scoring_pool
+    if scoring_pool is None:
+        with scoring_pool_lock:  # threads of a web worker (gthread) may get here at once
+            if scoring_pool is None:
+                scoring_pool = ProcessPoolExecutor(max_workers=SCORING_PROCESSES)
+    return scoring_pool.submit(score_take, note_events, take_path, times, pitches).result(timeout=SCORING_TIMEOUT)
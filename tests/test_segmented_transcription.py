@@ -0,0 +1,45 @@
+"""merge_segments on hand-made windows, no model needed.
+
+    python -m unittest tests.test_segmented_transcription
+"""
+import os
+import sys
+import unittest
+
+import pretty_midi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from segmented_transcription import merge_segments  # noqa: E402
+
+SEGMENTS = [(0, 60), (56, 116)]  # SEGMENT_SECONDS=60, SEGMENT_OVERLAP_SECONDS=4: window 0 owns up to 58
+
+
+def note(pitch, start, end):
+    return pretty_midi.Note(velocity=80, pitch=pitch, start=start, end=end)
+
+
+def merged(window_0, window_1):
+    notes, _ = merge_segments(SEGMENTS, [window_0, window_1], [[], []])
+    return [(n.pitch, n.start, n.end) for n in notes]
+
+
+class MergeSegmentsTest(unittest.TestCase):
+
+    def test_note_held_over_the_end_is_continued_from_the_next_start(self):
+        self.assertEqual(merged([note(60, 50, 60)], [note(60, 56, 65)]), [(60, 50, 65)])
+
+    def test_note_starting_in_the_overlap_is_continued_from_its_onset(self):
+        # window 1 reports the note at its real onset, past next_start, after other notes
+        self.assertEqual(merged([note(60, 57, 60)], [note(64, 56, 57), note(60, 57, 65)]), [(60, 57, 65)])
+
+    def test_other_pitches_are_not_continued(self):
+        self.assertEqual(merged([note(60, 57, 60)], [note(62, 57, 65)]), [(60, 57, 60)])
+
+    def test_notes_are_taken_from_the_owning_window(self):
+        self.assertEqual(merged([note(60, 10, 11), note(60, 57, 57.5), note(62, 59, 59.5)],
+                                [note(60, 57, 57.5), note(62, 59, 59.5)]),
+                         [(60, 10, 11), (60, 57, 57.5), (62, 59, 59.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""ingest_youtube against a local stand-in for the video site: an HTTP server and a yt-dlp extractor for its pages.
+
+    python -m unittest tests.test_youtube_ingest
+
+Runs offline; needs yt-dlp and ffmpeg (for the mp3 conversion).
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+from yt_dlp.extractor.common import InfoExtractor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_wav(seconds=2, sample_rate=22050):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.sin(2 * np.pi * 440 * t) * 10000).astype('<i2').tobytes())
+    return buf.getvalue()
+
+
+def make_jpeg():
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 36), (200, 30, 30)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+class LocalSite:
+    # Serves /audio.wav and /thumb.jpg, counts the requests per path; /watch?v=<id> pages are resolved by LocalIE
+
+    def __init__(self):
+        self.files = {'/audio.wav': make_wav(), '/thumb.jpg': make_jpeg()}
+        self.hits = {}
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.hits[self.path] = site.hits.get(self.path, 0) + 1
+                body = site.files.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def local_extractor(site, resolved, thumbnail='/thumb.jpg', audio='/audio.wav'):
+    # The InfoExtractor of the site's watch pages; `resolved` gets every URL it extracts
+
+    class LocalIE(InfoExtractor):
+        _VALID_URL = r'https?://127\.0\.0\.1:\d+/watch\?v=(?P<id>\w+)'
+
+        def _real_extract(self, url):
+            resolved.append(url)
+            return {
+                'id': self._match_id(url),
+                'title': 'Local Song',
+                'duration': 2,
+                'thumbnail': site.url + thumbnail,
+                'webpage_url': url,
+                'formats': [{'url': site.url + audio, 'ext': 'wav', 'acodec': 'pcm_s16le', 'vcodec': 'none',
+                             'format_id': 'wav'}],
+            }
+
+    return LocalIE
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), "ffmpeg is needed for the mp3 conversion")
+class IngestYoutubeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp(prefix='youtube_ingest_test_')
+        cls.previous_dir = os.getcwd()
+        os.chdir(cls.work_dir)  # database, blobs and uploads of the app are relative to the working directory
+        sys.path.insert(0, REPO_DIR)
+        import database
+        database.DB_PATH = os.path.join(cls.work_dir, 'songs.db')  # another test may have imported it elsewhere
+        from init_db import init_db, migrate_db
+        init_db()
+        migrate_db()
+        import youtube_ingest
+        cls.youtube_ingest = youtube_ingest
+        cls.site = LocalSite()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.site.close()
+        os.chdir(cls.previous_dir)
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.site.hits.clear()
+
+    def test_resolves_once_and_stores_audio_and_thumbnail(self):
+        resolved, metadata, stages = [], [], []
+        url = self.site.url + '/watch?v=abc'
+        result = self.youtube_ingest.ingest_youtube(url, 'thumb.jpg', on_metadata=metadata.append,
+                                                    on_progress=lambda stage, *_: stages.append(stage),
+                                                    extractors=[local_extractor(self.site, resolved)])
+
+        self.assertEqual(resolved, [url])
+        self.assertEqual([info['title'] for info in metadata], ['Local Song'])
+        self.assertEqual(self.site.hits, {'/audio.wav': 1, '/thumb.jpg': 1})
+        self.assertEqual(result['title'], 'Local Song')
+        self.assertEqual(result['source'], url)
+        self.assertTrue(result['audio_path'].startswith('blobs' + os.sep) and result['audio_path'].endswith('.mp3'))
+        self.assertTrue(os.path.exists(result['audio_path']))
+        self.assertAlmostEqual(result['duration'], 2, delta=0.2)
+        self.assertEqual(result['picture_path'], 'thumb.jpg')
+        self.assertTrue(os.path.exists('thumb.jpg'))
+        self.assertEqual(stages[0], 'resolving')
+        self.assertIn('converting', stages)
+        self.assertEqual(stages[-1], 'saving')
+
+    def test_missing_thumbnail_is_no_error(self):
+        result = self.youtube_ingest.ingest_youtube(self.site.url + '/watch?v=nothumb', 'none.jpg',
+                                                    extractors=[local_extractor(self.site, [], thumbnail='/nope.jpg')])
+        self.assertIsNone(result['picture_path'])
+        self.assertEqual(self.site.hits['/nope.jpg'], 1)  # a 404 is not retried
+        self.assertTrue(os.path.exists(result['audio_path']))
+
+    def test_missing_audio_fails(self):
+        with self.assertRaises(Exception):
+            self.youtube_ingest.ingest_youtube(self.site.url + '/watch?v=noaudio', 'noaudio.jpg',
+                                               extractors=[local_extractor(self.site, [], audio='/nope.wav')])
+        self.assertEqual(os.listdir(self.youtube_ingest.INGEST_FOLDER), [])  # the work directory was removed
+
+
+if __name__ == '__main__':
+    unittest.main()
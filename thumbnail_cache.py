@@ -0,0 +1,163 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+import requests
+from PIL import Image, ImageOps
+
+
+THUMBNAIL_CACHE_FOLDER = 'thumbnail_cache'
+
+# name -> (width, height). Images are cropped to fill the box like the gallery's object-fit: cover.
+THUMBNAIL_VARIANTS = {
+    'card': (400, 225),
+    'card2x': (800, 450),
+    'modal': (1280, 720),
+}
+DEFAULT_THUMBNAIL_VARIANT = 'card'
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_MIMETYPE = 'image/webp'
+THUMBNAIL_QUALITY = 80
+
+FETCH_TIMEOUT = (3.05, 10)          # (connect, read) seconds for remote pictures
+FAILED_FETCH_RETRY_SECONDS = 10 * 60  # a picture that could not be fetched is not tried again before this
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+os.makedirs(THUMBNAIL_CACHE_FOLDER, exist_ok=True)
+
+keyLocks = {}  # source key -> lock, so concurrent requests for the same picture fetch it only once
+keyLocksGuard = threading.Lock()
+
+
+def is_remote(picture_path):
+    return picture_path.startswith("http://") or picture_path.startswith("https://")
+
+
+def source_key(picture_path):
+    # Remote pictures are identified by their URL, local ones also by mtime and size so a replaced file is picked up
+    if is_remote(picture_path):
+        identity = picture_path
+    else:
+        st = os.stat(picture_path)
+        identity = f"{os.path.abspath(picture_path)}:{st.st_mtime_ns}:{st.st_size}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def variant_path(key, variant):
+    return os.path.join(THUMBNAIL_CACHE_FOLDER, f"{key}_{variant}.webp")
+
+
+def failed_marker_path(key):
+    return os.path.join(THUMBNAIL_CACHE_FOLDER, f"{key}.failed")
+
+
+def get_key_lock(key):
+    with keyLocksGuard:
+        return keyLocks.setdefault(key, threading.Lock())
+
+
+def fetch_source(picture_path):
+    if not is_remote(picture_path):
+        with open(picture_path, 'rb') as f:
+            return f.read()
+    response = requests.get(picture_path, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def write_variants(key, data):
+    image = Image.open(BytesIO(data))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    for variant, size in THUMBNAIL_VARIANTS.items():
+        resized = ImageOps.fit(image, size, method=Image.LANCZOS)
+        # Written next to the final path and renamed, so other processes never serve a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=THUMBNAIL_CACHE_FOLDER, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            resized.save(f, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, method=4)
+        os.replace(tmp_path, variant_path(key, variant))
+
+
+def recently_failed(key):
+    try:
+        return time.time() - os.path.getmtime(failed_marker_path(key)) < FAILED_FETCH_RETRY_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def get_thumbnail(picture_path, variant=DEFAULT_THUMBNAIL_VARIANT):
+    """Path of the cached `variant` of a song picture, or None if the picture can not be loaded.
+
+    The source is fetched (or read) once and all variants are generated from it, later requests only hit the disk.
+    """
+    if variant not in THUMBNAIL_VARIANTS:
+        variant = DEFAULT_THUMBNAIL_VARIANT
+    try:
+        key = source_key(picture_path)
+    except OSError:
+        return None
+
+    path = variant_path(key, variant)
+    if touch(path):
+        return path
+    if recently_failed(key):
+        return None
+
+    with get_key_lock(key):
+        if os.path.exists(path):  # generated while we were waiting for the lock
+            return path
+        try:
+            write_variants(key, fetch_source(picture_path))
+        except (OSError, requests.exceptions.RequestException, Image.DecompressionBombError) as e:
+            print(f"[get_thumbnail]: Could not load picture {picture_path}: {e}")
+            with open(failed_marker_path(key), 'w'):
+                pass
+            return None
+    print(f"[get_thumbnail]: Cached {len(THUMBNAIL_VARIANTS)} variant(s) of {picture_path}")
+    evict_thumbnails(keep=key)
+    return path
+
+
+def touch(path):
+    # True if the file is cached; its mtime is the last access for evict_thumbnails
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def evict_thumbnails(max_bytes=THUMBNAIL_CACHE_MAX_BYTES, keep=None):
+    # Least recently used variants go first until the folder fits into max_bytes; the variants of `keep` (the
+    # picture just cached) stay. Failure markers past their retry time are removed as well.
+    entries = []
+    total_bytes = 0
+    now = time.time()
+    for entry in os.scandir(THUMBNAIL_CACHE_FOLDER):
+        st = entry.stat()
+        if entry.name.endswith('.failed'):
+            if now - st.st_mtime >= FAILED_FETCH_RETRY_SECONDS:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            continue
+        if not entry.name.endswith('.webp'):
+            continue
+        total_bytes += st.st_size
+        if keep is None or not entry.name.startswith(f"{keep}_"):
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+    if evicted:
+        print(f"[evict_thumbnails]: Evicted {evicted} thumbnail(s)")
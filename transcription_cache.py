@@ -0,0 +1,134 @@
+import hashlib
+import os
+import re
+import shutil
+import time
+from importlib import metadata
+
+from database import get_db_connection, increment_counter, get_counters
+from pcm_cache import get_pcm
+
+
+TRANSCRIPTION_CACHE_FOLDER = 'transcription_cache'
+TRANSCRIPTION_CACHE_MAX_BYTES = int(os.environ.get('TRANSCRIPTION_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# The hash is computed from the decoded samples, so the same recording hits the cache regardless of the
+# file name, container or tags. All files are decoded with the same parameters to make hashes comparable;
+# 22050 Hz is also basic_pitch's rate, so its transcription reuses the decoded file.
+HASH_SAMPLE_RATE = 22050
+
+MODEL_PACKAGES = {'transkun': 'transkun', 'basic_pitch': 'basic-pitch'}
+
+os.makedirs(TRANSCRIPTION_CACHE_FOLDER, exist_ok=True)
+
+
+def hash_decoded_audio(audio_path):
+    return hashlib.sha256(get_pcm(audio_path, HASH_SAMPLE_RATE)).hexdigest()
+
+
+def get_model_version(model_name):
+    try:
+        return metadata.version(MODEL_PACKAGES.get(model_name, model_name))
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def cached_midi_path(audio_hash, model_name, model_version):
+    safe_version = re.sub(r'[^a-zA-Z0-9_\-\.]', '', model_version)
+    return os.path.join(TRANSCRIPTION_CACHE_FOLDER, f"{audio_hash}_{model_name}_{safe_version}.mid")
+
+
+### READ
+
+def lookup_transcription(audio_hash, model_name, model_version):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT midi_path, key_root, key_mode, instrument FROM transcription_cache
+        WHERE audio_hash = ? AND model_name = ? AND model_version = ?
+    ''', (audio_hash, model_name, model_version))
+    row = cur.fetchone()
+    if row and os.path.exists(row['midi_path']):
+        cur.execute('UPDATE transcription_cache SET last_accessed = ? WHERE audio_hash = ? AND model_name = ? AND model_version = ?',
+                    (time.time(), audio_hash, model_name, model_version))
+        conn.commit()
+    conn.close()
+
+    if not row or not os.path.exists(row['midi_path']):
+        increment_counter('transcription_cache_misses')
+        return None
+    increment_counter('transcription_cache_hits')
+    print(f"[lookup_transcription]: Cache hit for {audio_hash[:12]} ({model_name} {model_version})")
+    return dict(row)
+
+
+def get_cache_stats():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size_bytes FROM transcription_cache')
+    row = cur.fetchone()
+    conn.close()
+
+    counters = get_counters('transcription_cache_')
+    hits = int(counters.get('transcription_cache_hits', 0))
+    misses = int(counters.get('transcription_cache_misses', 0))
+    return {
+        'entries': row['entries'],
+        'size_bytes': row['size_bytes'],
+        'max_bytes': TRANSCRIPTION_CACHE_MAX_BYTES,
+        'hits': hits,
+        'misses': misses,
+        'evictions': int(counters.get('transcription_cache_evictions', 0)),
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+    }
+
+
+### CREATE
+
+def store_transcription(audio_hash, model_name, model_version, midi_path, key_root, key_mode, instrument):
+    cache_path = cached_midi_path(audio_hash, model_name, model_version)
+    shutil.copyfile(midi_path, cache_path)
+    size_bytes = os.path.getsize(cache_path)
+
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT OR REPLACE INTO transcription_cache
+            (audio_hash, model_name, model_version, midi_path, key_root, key_mode, instrument, size_bytes, last_accessed)
+        VALUES (?,?,?,?,?,?,?,?,?)
+    ''', (audio_hash, model_name, model_version, cache_path, key_root, key_mode, instrument, size_bytes, time.time()))
+    conn.commit()
+    conn.close()
+
+    evict_transcriptions()
+
+
+### DELETE
+
+def evict_transcriptions(max_bytes=TRANSCRIPTION_CACHE_MAX_BYTES):
+    # Least recently used entries go first until the cache fits into max_bytes
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    cur.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM transcription_cache')
+    total_bytes = cur.fetchone()[0]
+    evicted = []
+    if total_bytes > max_bytes:
+        cur.execute('SELECT audio_hash, model_name, model_version, midi_path, size_bytes FROM transcription_cache ORDER BY last_accessed')
+        for row in cur.fetchall():
+            if total_bytes <= max_bytes:
+                break
+            conn.execute('DELETE FROM transcription_cache WHERE audio_hash = ? AND model_name = ? AND model_version = ?',
+                         (row['audio_hash'], row['model_name'], row['model_version']))
+            total_bytes -= row['size_bytes']
+            evicted.append(row['midi_path'])
+    conn.commit()
+    conn.close()
+
+    for path in evicted:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    if evicted:
+        increment_counter('transcription_cache_evictions', len(evicted))
+        print(f"[evict_transcriptions]: Evicted {len(evicted)} cached transcription(s)")
@@ -0,0 +1,333 @@
+import argparse
+import math
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pretty_midi
+from synthviz.main import pixel_range, is_white_key
+
+from metrics import timed
+
+
+# Quality ladder: frame size, frame rate and x264 settings. 'full' is the synthviz default look.
+VIDEO_QUALITIES = {
+    'preview': {'width': 640, 'height': 360, 'fps': 15, 'crf': 30, 'preset': 'veryfast'},
+    'full': {'width': 1280, 'height': 720, 'fps': 20, 'crf': 20, 'preset': 'medium'},
+}
+VIDEO_QUALITY = os.environ.get('VIDEO_QUALITY', 'full')
+VIDEO_RENDER_PROCESSES = int(os.environ.get('VIDEO_RENDER_PROCESSES', os.cpu_count() or 2))  # frame renderers per video
+VIDEO_CHUNK_SECONDS = float(os.environ.get('VIDEO_CHUNK_SECONDS', 10))  # part of the timeline encoded by one process
+VIDEO_FIRST_CHUNK_SECONDS = float(os.environ.get('VIDEO_FIRST_CHUNK_SECONDS', 2))  # short, so the stream starts quickly
+PROGRESS_POLL_INTERVAL = 1.0
+PROGRESS_FILE = 'progress.txt'
+PLAYLIST_FILE = 'playlist.m3u8'
+SEGMENT_NAME = 'segment_{:05d}.ts'
+
+# Same drawing parameters as synthviz create_video
+BLACK_KEY_HEIGHT = 2 / 3
+FALLING_NOTE_COLOR = (75, 105, 177)
+PRESSED_KEY_COLOR = (197, 208, 231)
+VERTICAL_SPEED = 1 / 4  # main-image-heights per second
+LOWEST_KEY = 21
+HIGHEST_KEY = 108
+
+
+def load_notes(midi_path):
+    # (pitches, starts, ends) of all notes on the 88 keys, sorted by start
+    midi_data = pretty_midi.PrettyMIDI(midi_path)
+    notes = sorted((n.start, n.end, n.pitch) for inst in midi_data.instruments if not inst.is_drum
+                   for n in inst.notes if LOWEST_KEY <= n.pitch <= HIGHEST_KEY)
+    notes = np.asarray(notes, dtype=np.float64).reshape(-1, 3)
+    return notes[:, 2].astype(np.int64), notes[:, 0], notes[:, 1]
+
+
+def video_timeline(starts, ends, fps):
+    # Same timeline as synthviz: one second of silence before the first note and one after the last one
+    frame_start = starts.min() - 1
+    end_t = ends.max() + 1
+    return frame_start, 1 + math.ceil((end_t - frame_start) * fps)
+
+
+def count_video_frames(midi_path, fps=None):
+    _, starts, ends = load_notes(midi_path)
+    if not len(starts):
+        return 0
+    return video_timeline(starts, ends, fps or VIDEO_QUALITIES[VIDEO_QUALITY]['fps'])[1]
+
+
+def build_layout(width, height):
+    # Everything about a frame that does not depend on time, drawn like synthviz does
+    piano_height = round(height / 6)
+    key_start = height - piano_height
+    layout = {
+        'width': width,
+        'height': height,
+        'main_height': key_start,
+        'key_start': key_start,
+        'white_key_end': height - 1,
+        'black_key_end': round(height - (1 - BLACK_KEY_HEIGHT) * piano_height),
+        'key_ranges': {note: pixel_range(note, width) for note in range(LOWEST_KEY, HIGHEST_KEY + 1)},
+    }
+
+    piano = np.zeros((height, width, 3), dtype=np.uint8)
+    line_row = np.zeros((width, 3), dtype=np.uint8)
+    for note, (x0, x1) in layout['key_ranges'].items():
+        if is_white_key(note):
+            piano[key_start:layout['white_key_end'], x0:x1] = 255
+            if note % 12 == 0:
+                line_row[x0 - 2:x0 - 1] = 20  # grey line left of every C in the falling notes area
+    for note, (x0, x1) in layout['key_ranges'].items():
+        if not is_white_key(note):
+            piano[key_start:layout['black_key_end'], x0:x1] = 0
+    layout['piano'] = piano[key_start:]
+    layout['line_row'] = line_row
+    return layout
+
+
+def draw_keyboard(frame, layout, pressed):
+    # White keys first, then the black keys next to them again, then the black keys (as synthviz)
+    key_start, white_key_end, black_key_end = layout['key_start'], layout['white_key_end'], layout['black_key_end']
+    key_ranges = layout['key_ranges']
+    frame[key_start:] = layout['piano']
+    for note in pressed:
+        if is_white_key(note):
+            x0, x1 = key_ranges[note]
+            frame[key_start:white_key_end, x0:x1] = PRESSED_KEY_COLOR
+    for note in pressed:
+        if is_white_key(note):
+            for neighbour in (note - 1, note + 1):
+                if LOWEST_KEY <= neighbour <= HIGHEST_KEY and not is_white_key(neighbour):
+                    x0, x1 = key_ranges[neighbour]
+                    frame[key_start:black_key_end, x0:x1] = 0
+    for note in pressed:
+        if not is_white_key(note):
+            x0, x1 = key_ranges[note]
+            frame[key_start:black_key_end, x0:x1] = PRESSED_KEY_COLOR
+
+
+def chunk_frames(first_frame, last_frame, frame_start, pitches, starts, ends, quality):
+    """Frames [first_frame, last_frame) of the video as RGB arrays (the same array is reused for every frame).
+
+    Frames are computed independently of each other: the falling notes of the whole chunk are drawn once into a
+    tall strip (one row per `time_per_pixel`) and every frame is a window of it, moved down by the scroll offset.
+    """
+    q = VIDEO_QUALITIES[quality]
+    width, height, fps = q['width'], q['height'], q['fps']
+    layout = build_layout(width, height)
+    main_height = layout['main_height']
+    time_per_pixel = 1 / (main_height * VERTICAL_SPEED)
+    pixels_per_frame = main_height * VERTICAL_SPEED / fps
+
+    offsets = np.round(np.arange(first_frame, last_frame) * pixels_per_frame).astype(np.int64)
+    strip_start = int(offsets[0])
+    strip = np.empty((int(offsets[-1]) + main_height - strip_start, width, 3), dtype=np.uint8)
+    strip[:] = layout['line_row']
+    for pitch, start, end in zip(pitches, starts, ends):
+        row0 = max(math.ceil((start - frame_start) / time_per_pixel) - strip_start, 0)
+        row1 = min(math.floor((end - frame_start) / time_per_pixel) - strip_start + 1, strip.shape[0])
+        if row0 < row1:
+            x0, x1 = layout['key_ranges'][int(pitch)]
+            strip[row0:row1, x0:x1] = FALLING_NOTE_COLOR
+
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    for k, offset in zip(range(first_frame, last_frame), offsets):
+        row = offset - strip_start
+        frame[:main_height] = strip[row:row + main_height][::-1]  # the bottom row is "now"
+        t = frame_start + k / fps
+        draw_keyboard(frame, layout, pitches[(starts <= t) & (t <= ends)])
+        yield frame
+
+
+def render_chunk(chunk_path, first_frame, last_frame, frame_start, pitches, starts, ends, quality):
+    # Encodes one chunk straight from memory (raw frames piped into ffmpeg), returns the number of frames
+    q = VIDEO_QUALITIES[quality]
+    proc = subprocess.Popen(["ffmpeg", "-v", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                             "-s", f"{q['width']}x{q['height']}", "-r", str(q['fps']), "-i", "-",
+                             "-c:v", "libx264", "-preset", q['preset'], "-crf", str(q['crf']), "-pix_fmt", "yuv420p",
+                             chunk_path], stdin=subprocess.PIPE)
+    for frame in chunk_frames(first_frame, last_frame, frame_start, pitches, starts, ends, quality):
+        proc.stdin.write(frame.tobytes())
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to encode {chunk_path}")
+    return last_frame - first_frame
+
+
+def write_progress(done, total):
+    with open(PROGRESS_FILE + '.tmp', 'w') as f:
+        f.write(f"{done} {total}")
+    os.replace(PROGRESS_FILE + '.tmp', PROGRESS_FILE)
+
+
+def count_rendered_frames(work_dir):
+    try:
+        with open(os.path.join(work_dir, PROGRESS_FILE)) as f:
+            return int(f.read().split()[0])
+    except (FileNotFoundError, ValueError, IndexError):
+        return 0
+
+
+def chunk_boundaries(frames_total, fps):
+    # [(first_frame, last_frame)]: a short first chunk (time to first segment), VIDEO_CHUNK_SECONDS after it
+    chunk_length = max(int(VIDEO_CHUNK_SECONDS * fps), 1)
+    first_frames = min(max(int(VIDEO_FIRST_CHUNK_SECONDS * fps), 1), chunk_length)
+    bounds = [0] + list(range(first_frames, frames_total, chunk_length)) + [frames_total]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def write_segment(chunk_path, segment_path, t0, duration, audio_offset):
+    """Mux an encoded chunk (video time t0..t0+duration) into an MPEG-TS segment of the HLS stream.
+
+    The video is copied; the audio of the segment is cut from output.wav, which starts at video time
+    `audio_offset`. Timestamps continue where the previous segment ended, so players need no discontinuities.
+    """
+    cmd = ["ffmpeg", "-v", "error", "-y", "-i", chunk_path]
+    if audio_offset is not None:
+        lead = audio_offset - t0  # silence before the audio starts (only in the first segments)
+        if lead > 0:
+            delay_ms = round(lead * 1000)
+            audio_filter = f"[1:a]adelay={delay_ms}|{delay_ms},apad,atrim=0:{duration:.3f}[aud]"
+            cmd += ["-i", "output.wav"]
+        else:
+            audio_filter = f"[1:a]apad,atrim=0:{duration:.3f}[aud]"
+            cmd += ["-ss", f"{-lead:.3f}", "-i", "output.wav"]
+        cmd += ["-filter_complex", audio_filter, "-map", "0:v", "-map", "[aud]", "-c:v", "copy", "-c:a", "aac"]
+    else:
+        cmd += ["-c", "copy"]
+    tmp_path = segment_path + '.tmp'
+    subprocess.run(cmd + ["-output_ts_offset", f"{t0:.3f}", "-f", "mpegts", tmp_path], check=True)
+    os.replace(tmp_path, segment_path)
+
+
+def write_playlist(stream_dir, durations, finished):
+    # Event playlist of the segments rendered so far; players reload it until #EXT-X-ENDLIST appears
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{math.ceil(VIDEO_CHUNK_SECONDS)}",
+             "#EXT-X-PLAYLIST-TYPE:EVENT", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for i, duration in enumerate(durations):
+        lines += [f"#EXTINF:{duration:.3f},", SEGMENT_NAME.format(i)]
+    if finished:
+        lines.append("#EXT-X-ENDLIST")
+    path = os.path.join(stream_dir, PLAYLIST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + '.tmp', path)
+
+
+def create_video(midi_path, video_path, quality=VIDEO_QUALITY, processes=VIDEO_RENDER_PROCESSES, stream_dir=None):
+    """Render the video into the current working directory (chunks, audio, progress file) and join it at video_path.
+
+    With `stream_dir`, every chunk is also published as an HLS segment as soon as it and all chunks before it
+    are encoded, so playback can start long before the whole video is rendered.
+    """
+    fps = VIDEO_QUALITIES[quality]['fps']
+    pitches, starts, ends = load_notes(midi_path)
+    if not len(pitches):
+        raise ValueError("The MIDI file has no notes to show")
+    frame_start, frames_total = video_timeline(starts, ends, fps)
+    write_progress(0, frames_total)
+    if stream_dir:
+        os.makedirs(stream_dir, exist_ok=True)
+
+    try:  # the audio is synthesized while the frames are rendered
+        audio_proc = subprocess.Popen(["timidity", midi_path, "-Ow", "--output-24bit", "-A120", "-o", "output.wav"],
+                                      stdout=subprocess.DEVNULL)
+    except FileNotFoundError:
+        audio_proc = None
+
+    boundaries = chunk_boundaries(frames_total, fps)
+    seconds_on_screen = 1 / VERTICAL_SPEED
+    chunks = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {}
+        for i, (first_frame, last_frame) in enumerate(boundaries):
+            t0 = frame_start + first_frame / fps
+            t1 = frame_start + last_frame / fps + seconds_on_screen
+            visible = (ends >= t0) & (starts <= t1)  # only the notes this chunk can show
+            chunk_path = f"chunk_{i:05d}.mp4"
+            chunks.append(chunk_path)
+            future = executor.submit(render_chunk, chunk_path, first_frame, last_frame, frame_start,
+                                     pitches[visible], starts[visible], ends[visible], quality)
+            futures[future] = i  # chunks are queued in timeline order, so the first ones finish first
+        frames_done = 0
+        segments_done = set()
+        published = 0
+        audio_ready = None
+        for future in as_completed(futures):
+            frames_done += future.result()
+            write_progress(frames_done, frames_total)
+            if stream_dir is None:
+                continue
+            if audio_ready is None:  # decided once, so either all segments have sound or none
+                audio_ready = bool(audio_proc) and audio_proc.wait() == 0 and os.path.exists('output.wav')
+            i = futures[future]
+            first_frame, last_frame = boundaries[i]
+            write_segment(chunks[i], os.path.join(stream_dir, SEGMENT_NAME.format(i)), first_frame / fps,
+                          (last_frame - first_frame) / fps, -frame_start if audio_ready else None)
+            segments_done.add(i)
+            if published in segments_done:
+                while published in segments_done:
+                    published += 1
+                write_playlist(stream_dir, [(b - a) / fps for a, b in boundaries[:published]],
+                               published == len(boundaries))
+
+    with open('chunks.txt', 'w') as f:
+        f.writelines(f"file '{chunk_path}'\n" for chunk_path in chunks)
+
+    # Chunks are joined without re-encoding; the audio starts at midi time 0, i.e. -frame_start into the video
+    cmd = ["ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", "chunks.txt"]
+    if audio_proc and audio_proc.wait() == 0 and os.path.exists('output.wav'):
+        audio_offset = -frame_start
+        if audio_offset >= 0:
+            delay_ms = round(audio_offset * 1000)
+            audio_filter = f"[1:a]adelay={delay_ms}|{delay_ms}[aud]"
+        else:
+            audio_filter = f"[1:a]atrim=start={-audio_offset:.3f},asetpts=PTS-STARTPTS[aud]"
+        cmd += ["-i", "output.wav", "-filter_complex", audio_filter, "-map", "0:v", "-map", "[aud]", "-c:v", "copy", "-c:a", "aac"]
+    else:
+        print("[create_video]: timidity failed, the video has no sound")
+        cmd += ["-c", "copy"]
+    subprocess.run(cmd + [video_path], check=True)
+
+
+@timed('video_render')
+def render_video(midi_path, video_path, work_dir, on_progress=None, quality=VIDEO_QUALITY, stream_dir=None):
+    """Render `midi_path` to `video_path` in a separate process (which starts the chunk renderers).
+
+    All intermediate files are kept in `work_dir`, so several renders can run at the same time. With `stream_dir`
+    the video is also streamed there as HLS segments and a playlist while it is rendered (see create_video).
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    frames_total = count_video_frames(midi_path, VIDEO_QUALITIES[quality]['fps'])
+
+    cmd = [sys.executable, os.path.abspath(__file__), os.path.abspath(midi_path), os.path.abspath(video_path),
+           '--quality', quality]
+    if stream_dir:
+        cmd += ['--stream-dir', os.path.abspath(stream_dir)]
+    proc = subprocess.Popen(cmd, cwd=work_dir)
+    while proc.poll() is None:
+        if on_progress:
+            on_progress(min(count_rendered_frames(work_dir), frames_total), frames_total)
+        time.sleep(PROGRESS_POLL_INTERVAL)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"video renderer exited with code {proc.returncode}")
+    if not os.path.exists(video_path):
+        raise RuntimeError("video renderer did not create the video file")
+    if on_progress:
+        on_progress(frames_total, frames_total)
+    return video_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a piano roll video from a midi file')
+    parser.add_argument('midi_file')
+    parser.add_argument('video_file')
+    parser.add_argument('--quality', choices=sorted(VIDEO_QUALITIES), default=VIDEO_QUALITY)
+    parser.add_argument('--processes', type=int, default=VIDEO_RENDER_PROCESSES)
+    parser.add_argument('--stream-dir', help='also write HLS segments and a playlist to this folder while rendering')
+    args = parser.parse_args()
+    create_video(args.midi_file, args.video_file, args.quality, args.processes, args.stream_dir)
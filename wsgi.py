@@ -0,0 +1,3 @@
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+# The web workers only serve requests; jobs and job events run in the services process started by gunicorn.conf.py.
+from backend_server import app
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import yt_dlp
+
+from artifact_store import put_file
+from audio_ingest import INGEST_FOLDER, probe_audio
+from metrics import timed
+from thumbnail_cache import FETCH_TIMEOUT
+
+
+YTDLP_SOCKET_TIMEOUT = float(os.environ.get('YTDLP_SOCKET_TIMEOUT', 20))  # seconds without data before a read fails
+YTDLP_RETRIES = int(os.environ.get('YTDLP_RETRIES', 3))                  # per request / fragment, on top of the first try
+THUMBNAIL_RETRIES = 3
+THUMBNAIL_RETRY_DELAY = 1.0            # seconds before the first retry, doubled for every further one
+THUMBNAIL_MAX_BYTES = 10 * 1024 * 1024
+PROGRESS_INTERVAL = 0.5                # seconds between two download progress reports
+
+YTDLP_OPTIONS = {
+    'format': 'bestaudio/best',
+    'postprocessors': [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'mp3',
+        'preferredquality': '192',
+    }],
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'socket_timeout': YTDLP_SOCKET_TIMEOUT,
+    'retries': YTDLP_RETRIES,
+    'fragment_retries': YTDLP_RETRIES,
+    'extractor_retries': YTDLP_RETRIES,
+}
+
+
+def youtube_dl(extractors=(), **options):
+    # `extractors` (InfoExtractor classes) are tried before the built-in ones, e.g. a local fixture in tests
+    ydl = yt_dlp.YoutubeDL(dict(YTDLP_OPTIONS, **options), auto_init=False)
+    for extractor in extractors:
+        ydl.add_info_extractor(extractor())  # an instance: classes are looked up in the global registry
+    ydl.add_default_info_extractors()
+    return ydl
+
+
+@timed('thumbnail_fetch')
+def fetch_thumbnail(url, path):
+    # Written to `path` if it could be fetched within THUMBNAIL_RETRIES retries, None otherwise (a song needs no picture)
+    delay = THUMBNAIL_RETRY_DELAY
+    for attempt in range(THUMBNAIL_RETRIES + 1):
+        try:
+            with requests.get(url, timeout=FETCH_TIMEOUT, stream=True) as response:
+                if 400 <= response.status_code < 500:
+                    print(f"[fetch_thumbnail]: Warning: {url} answered {response.status_code}")
+                    return None
+                response.raise_for_status()
+                data = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > THUMBNAIL_MAX_BYTES:
+                        print(f"[fetch_thumbnail]: Warning: {url} is larger than {THUMBNAIL_MAX_BYTES} bytes")
+                        return None
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            return path
+        except requests.RequestException as e:
+            print(f"[fetch_thumbnail]: Warning: attempt {attempt + 1} for {url} failed: {e}")
+            if attempt < THUMBNAIL_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+    return None
+
+
+def ingest_youtube(url, thumbnail_path, on_metadata=None, on_progress=None, extractors=()):
+    """Download the audio of a YouTube (or any other yt-dlp supported) URL into the artifact store.
+
+    The URL is resolved once: the extracted metadata goes to on_metadata(info) right away and the formats selected
+    there are downloaded without asking the site again. The thumbnail is fetched to `thumbnail_path` at the same time.
+    on_progress(stage, done=None, total=None) reports 'resolving', 'downloading' (bytes), 'converting' and 'saving'.
+    Returns {'title', 'duration', 'audio_path', 'picture_path', 'source'}.
+    """
+    report = on_progress or (lambda stage, done=None, total=None: None)
+    last_report = 0.0
+
+    def progress_hook(d):
+        nonlocal last_report
+        if d['status'] != 'downloading' or time.monotonic() - last_report < PROGRESS_INTERVAL:
+            return
+        last_report = time.monotonic()
+        report('downloading', d.get('downloaded_bytes') or 0, d.get('total_bytes') or d.get('total_bytes_estimate'))
+
+    def postprocessor_hook(d):
+        if d['status'] == 'started' and d.get('postprocessor') == 'ExtractAudio':
+            report('converting')
+
+    os.makedirs(INGEST_FOLDER, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='youtube_', dir=INGEST_FOLDER)
+    try:
+        report('resolving')
+        with youtube_dl(extractors, outtmpl=os.path.join(work_dir, 'audio.%(ext)s'), progress_hooks=[progress_hook],
+                        postprocessor_hooks=[postprocessor_hook]) as ydl:
+            with timed('ytdlp_resolve'):
+                info = ydl.extract_info(url, download=False)
+            if info.get('_type', 'video') != 'video':
+                raise ValueError("Not a single video")
+            if on_metadata:
+                on_metadata(info)
+
+            report('downloading')
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                thumbnail = executor.submit(fetch_thumbnail, info['thumbnail'], thumbnail_path) if info.get('thumbnail') else None
+                with timed('ytdlp_download'):
+                    ydl.process_ie_result(info, download=True)
+                picture_path = thumbnail.result() if thumbnail else None
+
+        report('saving')
+        downloaded = [name for name in os.listdir(work_dir) if name.startswith('audio.') and name.endswith('.mp3')]
+        if not downloaded:
+            raise RuntimeError("yt-dlp did not create the audio file")
+        path = os.path.join(work_dir, downloaded[0])
+        duration, codec, extension = probe_audio(path)
+        audio_path = put_file(path, extension or '.mp3')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"[ingest_youtube]: {url}: {codec}, {duration or 0:.1f}s -> {audio_path}")
+    return {
+        'title': info.get('title') or url,
+        'duration': duration or info.get('duration'),
+        'audio_path': audio_path,
+        'picture_path': picture_path,
+        'source': info.get('webpage_url') or url,
+    }